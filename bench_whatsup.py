@@ -0,0 +1,232 @@
+"""
+bench_whatsup.py
+
+Benchmark suite for whatsup.py on synthetic data. For every Device table size it
+builds a data folder (relations.csv, Device.csv and N child CSVs) in a temp
+directory, generates matching inputs and times:
+
+    load            DeviceSchema construction from CSV (no cache)
+    load_cached     DeviceSchema construction from a warm table cache
+    detect_defaults detected defaults over every loaded table
+    refresh         refresh() after one child CSV changed on disk
+    insert, update, upsert, delete   BulkEngine operations
+
+    python bench_whatsup.py --sizes 10000 100000 1000000 --rows 50000
+    python bench_whatsup.py update delete --sizes 5000000 --children 6 --width 20 --json out.json
+
+--shards N stores every child table as N hash shards (see whatsup.shard_table),
+so the same operations can be compared against the single-file layout.
+
+Each line reports the Device table size, the seconds taken, rows per second and
+the peak memory traced during the operation. --json writes the same results
+(plus the environment) as JSON so runs can be compared over time. Mutating
+operations each run on a fresh copy of the generated folder.
+"""
+
+import os, sys, json, time, shutil, argparse, platform, tempfile, tracemalloc
+import numpy as np
+import pandas as pd
+
+import whatsup
+
+OPS = ['load', 'load_cached', 'detect_defaults', 'refresh', 'insert', 'update', 'upsert', 'delete']
+
+
+def make_data_folder(folder, n_devices, n_children=2, child_rows_per_device=2, width=0, seed=0):
+    """Write relations.csv, Device.csv and n_children child CSVs under `folder`.
+
+    `width` adds that many extra text columns to every table.
+    """
+    rng = np.random.default_rng(seed)
+    data = os.path.join(folder, 'data'); os.makedirs(data, exist_ok=True)
+    rel_rows = []
+    ids = np.arange(1, n_devices + 1)
+
+    def extra(n):
+        return {f'sExtra{i}': rng.integers(0, 50, n).astype(str) for i in range(width)}
+
+    pd.DataFrame({
+        'nDeviceID': ids,
+        'sDisplayName': [f'dev{i}' for i in ids],
+        'nWorstStateID': rng.integers(1, 5, n_devices),
+        'sNote': '',
+        **extra(n_devices),
+    }).to_csv(os.path.join(data, 'Device.csv'), index=False)
+    for c in range(n_children):
+        name = f'Child{c}'
+        n = n_devices * child_rows_per_device
+        pd.DataFrame({
+            f'n{name}ID': np.arange(1, n + 1),
+            'nDeviceID': np.repeat(ids, child_rows_per_device),
+            'sValue': rng.integers(0, 1000, n).astype(str),
+            **extra(n),
+        }).to_csv(os.path.join(data, f'dbo.{name}.csv'), index=False)
+        rel_rows.append((f'FK_{name}', f'dbo.{name}', 'nDeviceID', 'dbo.Device', 'nDeviceID'))
+    rel = os.path.join(folder, 'relations.csv')
+    pd.DataFrame(rel_rows, columns=['ForeignKeyName', 'ParentTable', 'ParentColumn', 'ReferencedTable', 'ReferencedColumn']).to_csv(rel, index=False)
+    return data, rel
+
+
+def update_input(n_devices, n_rows, seed=1):
+    rng = np.random.default_rng(seed)
+    keys = rng.choice(np.arange(1, n_devices + 1), size=min(n_rows, n_devices), replace=False)
+    return pd.DataFrame({'nDeviceID': keys.astype(object), 'sNote': [f'note{k}' for k in keys]}, dtype=object)
+
+
+def insert_input(n_rows):
+    # sValue holds integers in the generated tables, so validation expects one here too
+    return pd.DataFrame({'sDisplayName': [f'new{i}' for i in range(n_rows)],
+                         'Child0.sValue': '7'}, dtype=object)
+
+
+def upsert_input(n_devices, n_rows, seed=2):
+    # half existing devices (updated), half new ones (inserted)
+    old = update_input(n_devices, n_rows - n_rows // 2, seed)
+    new = pd.DataFrame({'nDeviceID': np.arange(n_devices + 1, n_devices + 1 + n_rows // 2).astype(object),
+                        'sNote': 'upserted'}, dtype=object)
+    return pd.concat([old, new], ignore_index=True)
+
+
+def delete_input(n_devices, n_rows, seed=3):
+    return update_input(n_devices, n_rows, seed)[['nDeviceID']]
+
+
+def as_chunks(df, folder, excel):
+    """The engine input: the DataFrame itself, or (with excel) the chunks streamed
+    back from an .xlsx written from it, so the timing includes reading Excel."""
+    if not excel:
+        return [df]
+    path = os.path.join(folder, 'input.xlsx')
+    df.to_excel(path, index=False)
+    return whatsup.iter_excel_chunks(path)
+
+
+class Measure:
+    """Wall time and traced peak memory of the enclosed block."""
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.seconds = 0.0
+        self.peak_mb = None
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._t0
+        if self.memory:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        return False
+
+
+def run_op(op, base, folder, n, args):
+    """Time one operation on Device table size n; returns (input rows, detail, Measure)."""
+    data, rel = base
+    if op in ('load', 'detect_defaults', 'refresh', 'load_cached'):
+        data_in = data
+    else:
+        # mutating operations get their own copy of the data
+        data_in = os.path.join(folder, f'data_{op}')
+        shutil.rmtree(data_in, ignore_errors=True)
+        shutil.copytree(data, data_in)
+    m = Measure(args.memory)
+    if op == 'load':
+        with m:
+            schema = whatsup.DeviceSchema(data_in, rel)
+        return n, f'{len(schema.tables)} tables', m
+    if op == 'load_cached':
+        cache = os.path.join(folder, 'cache')
+        whatsup.DeviceSchema(data_in, rel, cache_dir=cache)   # warm it
+        with m:
+            schema = whatsup.DeviceSchema(data_in, rel, cache_dir=cache)
+        return n, f'{len(schema.tables)} tables', m
+    schema = whatsup.DeviceSchema(data_in, rel)
+    if op == 'detect_defaults':
+        with m:
+            defaults = schema.detect_defaults()
+        return sum(len(df) for df, _ in schema.tables.values()), f'{sum(map(len, defaults.values()))} columns', m
+    if op == 'refresh':
+        path = schema.get_table_path('Child0') if 'Child0' in schema.tables else schema.get_table_path('Device')
+        if os.path.isdir(path):
+            path = whatsup.ShardLayout.open(path).files()[0]   # change one shard
+        df = pd.read_csv(path, dtype=object, keep_default_na=False)
+        df.to_csv(path, index=False)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1))
+        with m:
+            reloaded = schema.refresh(changed_only=True)
+        return len(df), 'reloaded ' + ','.join(reloaded), m
+    engine = whatsup.BulkEngine(schema, {}, {}, {})
+    exdf = {'insert': lambda: insert_input(args.rows),
+            'update': lambda: update_input(n, args.rows),
+            'upsert': lambda: upsert_input(n, args.rows),
+            'delete': lambda: delete_input(n, args.rows)}[op]()
+    chunks = as_chunks(exdf, folder, args.excel)
+    with m:
+        result = engine.run(op, chunks)
+    shutil.rmtree(data_in, ignore_errors=True)
+    return len(exdf), result.summary(), m
+
+
+def run_suite(args):
+    results = []
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            base = make_data_folder(tmp, n, args.children, args.child_rows, args.width)
+            if args.shards:
+                for c in range(args.children):
+                    whatsup.shard_table(os.path.join(base[0], f'dbo.Child{c}.csv'), 'nDeviceID', args.shards)
+            for op in args.ops:
+                rows, detail, m = run_op(op, base, tmp, n, args)
+                rec = {'op': op, 'devices': n, 'children': args.children,
+                       'child_rows_per_device': args.child_rows, 'width': args.width, 'shards': args.shards,
+                       'input': 'excel' if args.excel and op in ('insert', 'update', 'upsert', 'delete') else 'dataframe',
+                       'rows': rows, 'seconds': round(m.seconds, 4),
+                       'rows_per_sec': round(rows / m.seconds) if m.seconds else None,
+                       'peak_mb': None if m.peak_mb is None else round(m.peak_mb, 1),
+                       'detail': detail}
+                results.append(rec)
+                mem = '' if m.peak_mb is None else f'  peak={m.peak_mb:8.1f}MB'
+                print(f'{op:<16} devices={n:>9}  rows={rows:>9}  {m.seconds:8.3f}s  '
+                      f'{rec["rows_per_sec"] or 0:>10}/s{mem}', flush=True)
+    return results
+
+
+def environment():
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Benchmark whatsup schema loading and bulk operations on synthetic data.')
+    p.add_argument('ops', nargs='*', metavar='op', help='operations to time: ' + ', '.join(OPS) + ' (default: all)')
+    p.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Device table sizes (10k to 5M)')
+    p.add_argument('--rows', type=int, default=10000, help='input rows per bulk operation')
+    p.add_argument('--children', type=int, default=2, help='number of child tables')
+    p.add_argument('--child-rows', type=int, default=2, help='child rows per device in each child table')
+    p.add_argument('--width', type=int, default=0, help='extra columns per table')
+    p.add_argument('--shards', type=int, default=0, help='store child tables as this many shard files')
+    p.add_argument('--excel', action='store_true', help='feed bulk operations from an .xlsx instead of a DataFrame')
+    p.add_argument('--no-memory', dest='memory', action='store_false', help="don't trace peak memory (tracing slows the timed code)")
+    p.add_argument('--json', metavar='FILE', help="write results as JSON to FILE ('-' for stdout)")
+    args = p.parse_args(argv)
+    unknown = [op for op in args.ops if op not in OPS]
+    if unknown:
+        p.error('unknown operation: ' + ', '.join(unknown))
+    args.ops = args.ops or OPS
+    results = run_suite(args)
+    if args.json:
+        doc = {'environment': environment(), 'args': vars(args), 'results': results}
+        if args.json == '-':
+            print(json.dumps(doc, indent=2))
+        else:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(doc, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
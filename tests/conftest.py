@@ -0,0 +1,50 @@
+import os, sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import whatsup
+
+RELATIONS = [
+    ('FK_Pivot', 'dbo.PivotActiveMonitorTypeToDevice', 'nDeviceID', 'dbo.Device', 'nDeviceID'),
+    ('FK_Attr', 'dbo.DeviceAttribute', 'nDeviceID', 'dbo.Device', 'nDeviceID'),
+    ('FK_State', 'dbo.MonitorState', 'nPivotActiveMonitorTypeToDeviceID',
+     'dbo.PivotActiveMonitorTypeToDevice', 'nPivotActiveMonitorTypeToDeviceID'),
+]
+
+TABLES = {
+    'Device.csv': {'nDeviceID': [1, 2, 3], 'sDisplayName': ['a', 'b', 'c'], 'nWorstStateID': [1, 1, 2],
+                   'sNote': ['', 'x', '']},
+    'dbo.PivotActiveMonitorTypeToDevice.csv': {'nPivotActiveMonitorTypeToDeviceID': [10, 11, 12, 13],
+                                               'nDeviceID': [1, 1, 2, 3], 'nMonitorTypeID': [5, 6, 5, 5]},
+    'DeviceAttribute.csv': {'nDeviceAttributeID': [100, 101], 'nDeviceID': [1, 2], 'sName': ['k', 'k'],
+                            'sValue': ['v1', 'v2']},
+    'MonitorState.csv': {'nMonitorStateID': [1, 2, 3], 'nPivotActiveMonitorTypeToDeviceID': [10, 11, 12],
+                         'sState': ['up', 'down', 'up']},
+}
+
+
+@pytest.fixture
+def folder(tmp_path):
+    """(data folder, relations.csv) of a small tree: Device, two tables below it and
+    MonitorState below PivotActiveMonitorTypeToDevice."""
+    data = tmp_path / 'data'
+    data.mkdir()
+    for name, columns in TABLES.items():
+        pd.DataFrame(columns).to_csv(data / name, index=False)
+    rel = tmp_path / 'relations.csv'
+    pd.DataFrame(RELATIONS, columns=['ForeignKeyName', 'ParentTable', 'ParentColumn', 'ReferencedTable',
+                                     'ReferencedColumn']).to_csv(rel, index=False)
+    return str(data), str(rel)
+
+
+@pytest.fixture
+def open_schema(folder):
+    def open_schema(**kwargs):
+        return whatsup.DeviceSchema(*folder, **kwargs)
+    return open_schema
+
+
+def read_table(folder, name):
+    """A table CSV of the data folder as text, the way the tool reads it."""
+    return whatsup.DeviceSchema._read_csv(os.path.join(folder[0], name))
@@ -0,0 +1,93 @@
+import os, time
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+
+def write_inputs(tmp_path, files):
+    src = tmp_path / 'inputs'
+    src.mkdir(exist_ok=True)
+    for name, columns in files.items():
+        pd.DataFrame(columns).to_csv(src / name, index=False)
+    return str(src)
+
+
+def run(schema, src, **kwargs):
+    return whatsup.BulkEngine(schema).run_batch(whatsup.BatchSpec(src, **kwargs))
+
+
+def statuses(result):
+    return sorted((os.path.basename(e['file']), e['status']) for e in result.entries)
+
+
+GOOD = {'1_update.csv': {'nDeviceID': [2], 'sNote': ['first']},
+        '3_insert.csv': {'sDisplayName': ['d']}}
+BAD = {'2_update.csv': {'nDeviceID': [9], 'sNote': ['no such device']}}
+
+
+def test_rerun_skips_the_files_already_done(folder, open_schema, tmp_path):
+    src = write_inputs(tmp_path, GOOD)
+    assert statuses(run(open_schema(), src)) == [('1_update.csv', 'done'), ('3_insert.csv', 'done')]
+    again = run(open_schema(), src)
+    assert statuses(again) == [('1_update.csv', 'skipped'), ('3_insert.csv', 'skipped')]
+    assert again.tables_written == []
+    time.sleep(0.01)
+    pd.DataFrame({'nDeviceID': [2], 'sNote': ['edited']}).to_csv(os.path.join(src, '1_update.csv'), index=False)
+    assert statuses(run(open_schema(), src)) == [('1_update.csv', 'done'), ('3_insert.csv', 'skipped')]
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'edited', '', '']
+
+
+def test_a_failed_file_stops_the_batch_and_a_rerun_resumes_there(folder, open_schema, tmp_path):
+    src = write_inputs(tmp_path, {**GOOD, **BAD})
+    result = run(open_schema(), src)
+    assert statuses(result) == [('1_update.csv', 'done'), ('2_update.csv', 'failed')]
+    assert any('Stopped at 2_update.csv' in w for w in result.warnings)
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'first', '']   # the file before it is committed
+    write_inputs(tmp_path, {'2_update.csv': {'nDeviceID': [3], 'sNote': ['fixed']}})
+    result = run(open_schema(), src)
+    assert statuses(result) == [('1_update.csv', 'skipped'), ('2_update.csv', 'done'), ('3_insert.csv', 'done')]
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'first', 'fixed', '']
+
+
+def test_keep_going_runs_past_a_failed_file(folder, open_schema, tmp_path):
+    src = write_inputs(tmp_path, {**GOOD, **BAD})
+    result = run(open_schema(), src, keep_going=True)
+    assert statuses(result) == [('1_update.csv', 'done'), ('2_update.csv', 'failed'), ('3_insert.csv', 'done')]
+    assert read_table(folder, 'Device.csv')['sDisplayName'].tolist() == ['a', 'b', 'c', 'd']
+    # the failed file is retried on the next run, the others are not
+    assert statuses(run(open_schema(), src, keep_going=True)) == [
+        ('1_update.csv', 'skipped'), ('2_update.csv', 'failed'), ('3_insert.csv', 'skipped')]
+
+
+def test_input_is_read_a_few_chunks_ahead(tmp_path, monkeypatch):
+    produced = []
+
+    def chunks(path):
+        for k in range(20):
+            produced.append((path, k))
+            yield pd.DataFrame({'k': [k]})
+    monkeypatch.setattr(whatsup, 'iter_excel_chunks', chunks)
+    reader = whatsup.ChunkPrefetcher(['a', 'b'], depth=2)
+    try:
+        seen = 0
+        for chunk in reader.chunks(0):
+            time.sleep(0.01)
+            assert len(produced) <= seen + 4    # the queue, the chunk being put and the one being consumed
+            seen += 1
+            if seen == 5:
+                break   # the rest of 'a' is skipped
+        assert [c['k'][0] for c in reader.chunks(1)] == list(range(20))
+    finally:
+        reader.close()
+    assert produced[-1] == ('b', 19)
+
+
+def test_a_read_error_fails_only_its_file(folder, open_schema, tmp_path):
+    src = write_inputs(tmp_path, GOOD)
+    with open(os.path.join(src, '2_update.csv'), 'wb') as f:
+        f.write(b'nDeviceID,sNote\n"2,unterminated\n')
+    result = run(open_schema(), src, keep_going=True)
+    assert statuses(result) == [('1_update.csv', 'done'), ('2_update.csv', 'failed'), ('3_insert.csv', 'done')]
+    assert 'Failed to read CSV' in result.entries[1]['detail']
@@ -0,0 +1,33 @@
+import os, threading
+import pandas as pd
+
+import whatsup
+
+
+def test_commit_stores_the_cache_in_the_background(open_schema, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    schema = open_schema(cache_dir=cache_dir)
+    stored = []
+    store = whatsup.TableCache._store
+
+    def record(self, norm, *args):
+        stored.append((norm, threading.current_thread().name))
+        return store(self, norm, *args)
+    monkeypatch.setattr(whatsup.TableCache, '_store', record)
+    whatsup.BulkEngine(schema).update(pd.DataFrame({'nDeviceID': ['2'], 'sNote': ['y']}, dtype=object))
+    schema.cache.flush()
+    assert stored == [('Device', 'cache-writer')]
+    df, encoding = schema.cache.load('Device', schema.get_table_path('Device'))
+    assert df['sNote'].tolist() == ['', 'y', ''] and encoding == 'utf-8'
+
+
+def test_only_the_latest_frame_is_written(tmp_path):
+    cache = whatsup.TableCache(str(tmp_path / 'cache'))
+    path = tmp_path / 'Device.csv'
+    pd.DataFrame({'a': ['1']}).to_csv(path, index=False)
+    with cache._cond:   # hold the writer back while the table is stored twice
+        cache.store_later('Device', str(path), pd.DataFrame({'a': ['old']}))
+        cache.store_later('Device', str(path), pd.DataFrame({'a': ['new']}))
+    cache.flush()
+    assert cache.load('Device', str(path))[0]['a'].tolist() == ['new']
+    assert not any(f.startswith('.tmp_cache_') for f in os.listdir(cache.folder))
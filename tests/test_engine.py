@@ -0,0 +1,112 @@
+import os
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+PIVOT = 'PivotActiveMonitorTypeToDevice'
+
+
+def frame(**columns):
+    return pd.DataFrame(columns, dtype=object)
+
+
+def test_repeated_inserts_allocate_new_keys(folder, open_schema):
+    schema = open_schema()
+    engine = whatsup.BulkEngine(schema)
+    engine.insert(frame(sDisplayName=['d', 'e']))
+    engine.run('insert', [frame(sDisplayName=['preview'])], dry_run=True)   # a preview uses up no keys
+    whatsup.BulkEngine(schema).insert(frame(sDisplayName=['f']))
+    engine.insert(frame(nDeviceID=['20', ''], sDisplayName=['given', 'next']))
+    whatsup.BulkEngine(open_schema()).insert(frame(sDisplayName=['reloaded']))   # a fresh load continues too
+    device = read_table(folder, 'Device.csv')
+    assert device['nDeviceID'].tolist() == ['1', '2', '3', '4', '5', '6', '20', '21', '22']
+    assert device['sDisplayName'].tolist()[3:] == ['d', 'e', 'f', 'given', 'next', 'reloaded']
+
+
+def test_child_templates_get_the_new_device_keys(folder, open_schema):
+    templates = {'DeviceAttribute': [{'sName': 'owner', 'sValue': 'ops'}, {'sName': 'site'}]}
+    engine = whatsup.BulkEngine(open_schema(), default_child_rows=templates)
+    result = engine.insert(frame(sDisplayName=['d', 'e'], **{f'{PIVOT}.nMonitorTypeID': ['7', None]}))
+    assert result.child_rows == {'DeviceAttribute': 4, PIVOT: 1}
+    attr = read_table(folder, 'DeviceAttribute.csv').iloc[2:]
+    assert attr.values.tolist() == [['102', '4', 'owner', 'ops'], ['103', '4', 'site', ''],
+                                    ['104', '5', 'owner', 'ops'], ['105', '5', 'site', '']]
+    pivot = read_table(folder, 'dbo.PivotActiveMonitorTypeToDevice.csv').iloc[4:]
+    assert pivot.values.tolist() == [['14', '4', '7']]
+
+
+def test_delete_cascades_through_every_level(folder, open_schema):
+    result = whatsup.BulkEngine(open_schema()).delete(frame(nDeviceID=['1']))
+    assert result.devices == 1
+    assert result.child_rows == {PIVOT: 2, 'DeviceAttribute': 1, 'MonitorState': 2}
+    assert read_table(folder, 'Device.csv')['nDeviceID'].tolist() == ['2', '3']
+    assert read_table(folder, f'dbo.{PIVOT}.csv')['nPivotActiveMonitorTypeToDeviceID'].tolist() == ['12', '13']
+    assert read_table(folder, 'DeviceAttribute.csv')['nDeviceAttributeID'].tolist() == ['101']
+    assert read_table(folder, 'MonitorState.csv')['nMonitorStateID'].tolist() == ['3']
+
+
+def test_delete_follows_cycles_and_self_references(folder, open_schema):
+    data, rel = folder
+    relations = pd.read_csv(rel, dtype=str)
+    relations.loc[len(relations)] = ['FK_PivotState', f'dbo.{PIVOT}', 'nDefaultStateID', 'dbo.MonitorState', 'nMonitorStateID']
+    relations.loc[len(relations)] = ['FK_StateParent', 'dbo.MonitorState', 'nParentStateID', 'dbo.MonitorState', 'nMonitorStateID']
+    relations.to_csv(rel, index=False)
+    pivot = read_table(folder, f'dbo.{PIVOT}.csv').assign(nDefaultStateID=['', '', '', '2'])
+    pivot.to_csv(os.path.join(data, f'dbo.{PIVOT}.csv'), index=False)
+    # state 4 hangs off state 3, which hangs off state 2 (device 1); pivot 13 (device 3) defaults to state 2
+    state = pd.DataFrame({'nMonitorStateID': ['1', '2', '3', '4'], 'nPivotActiveMonitorTypeToDeviceID': ['10', '11', '12', '12'],
+                          'sState': ['up', 'down', 'up', 'up'], 'nParentStateID': ['', '', '2', '3']})
+    state.to_csv(os.path.join(data, 'MonitorState.csv'), index=False)
+    result = whatsup.BulkEngine(open_schema()).delete(frame(nDeviceID=['1']))
+    assert result.child_rows == {PIVOT: 3, 'DeviceAttribute': 1, 'MonitorState': 4}
+    assert read_table(folder, f'dbo.{PIVOT}.csv')['nPivotActiveMonitorTypeToDeviceID'].tolist() == ['12']
+    assert read_table(folder, 'MonitorState.csv').empty
+
+
+def test_upsert_updates_existing_keys_and_inserts_new_ones(folder, open_schema):
+    chunks = [frame(nDeviceID=['2', None, '30'], sDisplayName=['B', 'new', 'thirty'], sNote=['y', None, None]),
+              frame(nDeviceID=['3'], sDisplayName=['C'])]
+    result = whatsup.BulkEngine(open_schema()).run('upsert', chunks)
+    assert (result.inserted, result.updated, result.devices, result.rows) == (2, 2, 4, 4)
+    device = read_table(folder, 'Device.csv')
+    assert device[['nDeviceID', 'sDisplayName', 'sNote']].values.tolist() == [
+        ['1', 'a', ''], ['2', 'B', 'y'], ['3', 'C', ''], ['31', 'new', ''], ['30', 'thirty', '']]
+
+
+def test_saved_delete_plan_refuses_rows_added_below_it(folder, open_schema, tmp_path):
+    plan = whatsup.BulkEngine(open_schema()).run('delete', [frame(nDeviceID=['1'])], dry_run=True).plan
+    plan.save(tmp_path / 'plan.csv')
+    attr = read_table(folder, 'DeviceAttribute.csv').assign(nDeviceID=['1', '1'])   # 101 now belongs to device 1
+    attr.to_csv(os.path.join(folder[0], 'DeviceAttribute.csv'), index=False)
+    schema = open_schema()
+    before = {name: read_table(folder, name) for name in ('Device.csv', 'DeviceAttribute.csv')}
+    with pytest.raises(whatsup.BulkError, match='DeviceAttribute: 1 rows now reference Device'):
+        whatsup.BulkEngine(schema).apply_plan(whatsup.ChangePlan.load(tmp_path / 'plan.csv'))
+    for name, df in before.items():
+        assert read_table(folder, name).equals(df)
+    # the same plan applies once the new row is gone again
+    attr.assign(nDeviceID=['1', '2']).to_csv(os.path.join(folder[0], 'DeviceAttribute.csv'), index=False)
+    result = whatsup.BulkEngine(open_schema()).apply_plan(whatsup.ChangePlan.load(tmp_path / 'plan.csv'))
+    assert result.devices == 1
+    assert read_table(folder, 'DeviceAttribute.csv')['nDeviceAttributeID'].tolist() == ['101']
+
+
+@pytest.mark.parametrize('ext', ['csv', 'xlsx'])
+@pytest.mark.parametrize('op', ['update', 'upsert'])
+def test_an_export_read_back_changes_nothing(folder, open_schema, tmp_path, ext, op):
+    path = str(tmp_path / f'export.{ext}')
+    # text that must come back as it was: leading zeros, an exponent, commas, quotes
+    attr = read_table(folder, 'DeviceAttribute.csv').assign(sValue=['007', '1e3'], sName=['a, "b"', ''])
+    attr.to_csv(os.path.join(folder[0], 'DeviceAttribute.csv'), index=False)
+    schema = open_schema()
+    engine = whatsup.BulkEngine(schema)
+    assert engine.export(whatsup.ExportSpec(path)).devices == 3
+    def snapshot():
+        return {f: (open(os.path.join(folder[0], f), 'rb').read(), os.stat(os.path.join(folder[0], f)).st_mtime_ns)
+                for f in os.listdir(folder[0]) if f.endswith('.csv')}
+    before = snapshot()
+    result = engine.run(op, whatsup.iter_excel_chunks(path, chunk_rows=2))
+    assert (result.rows, result.inserted, result.updated, result.tables_written) == (4, 0, 0, [])
+    assert snapshot() == before
@@ -0,0 +1,97 @@
+import os, threading
+import numpy as np
+import pandas as pd
+import pytest
+
+import whatsup
+
+PIVOT = 'PivotActiveMonitorTypeToDevice'
+FKS = [(PIVOT, 'nDeviceID'), ('DeviceAttribute', 'nDeviceID'), ('MonitorState', 'nPivotActiveMonitorTypeToDeviceID')]
+
+
+def frame(**columns):
+    return pd.DataFrame(columns, dtype=object)
+
+
+def assert_indexes_current(schema):
+    for norm in ('Device', PIVOT, 'DeviceAttribute', 'MonitorState'):
+        df = schema.tables[norm][0]
+        keys = whatsup.text_values(df.iloc[:, 0]).tolist() + ['999']
+        fresh = whatsup.PrimaryKeyIndex(df.iloc[:, 0])
+        assert schema.lookup_rows(norm, keys).tolist() == fresh.get(keys).tolist()
+    for norm, column in FKS:
+        df = schema.tables[norm][0]
+        fresh = whatsup.ForeignKeyIndex(df[column])
+        for key in whatsup.text_values(df[column]).unique().tolist() + ['1', '2', '3', '10', '999']:
+            assert schema.fk_index(norm, column).rows([key]).tolist() == fresh.rows([key]).tolist()
+            assert schema.fk_index(norm, column).contains([key]).tolist() == fresh.contains([key]).tolist()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('sharded', [False, True])
+def test_indexes_follow_commits_without_a_rebuild(folder, open_schema, compact, sharded):
+    if sharded:
+        whatsup.shard_table(os.path.join(folder[0], 'dbo.PivotActiveMonitorTypeToDevice.csv'), 'nDeviceID', 3)
+    schema = open_schema(compact=compact)
+    engine = whatsup.BulkEngine(schema)
+    assert_indexes_current(schema)
+    built = [schema.pk_index('Device')] + [schema.fk_index(*fk) for fk in FKS]
+    engine.insert(frame(sDisplayName=['d', 'e'], **{f'{PIVOT}.nMonitorTypeID': ['7', '8']}))
+    assert_indexes_current(schema)
+    engine.update(frame(nDeviceID=['2'], sNote=['y']))
+    assert_indexes_current(schema)
+    engine.delete(frame(nDeviceID=['1', '4']))
+    assert_indexes_current(schema)
+    engine.insert(frame(nDeviceID=['1'], sDisplayName=['again'], **{f'{PIVOT}.nMonitorTypeID': ['9']}))
+    assert_indexes_current(schema)
+    assert [schema.pk_index('Device')] + [schema.fk_index(*fk) for fk in FKS] == built
+
+
+def test_editing_a_key_column_drops_its_index(open_schema):
+    schema = open_schema()
+    pivot = schema.fk_index(PIVOT, 'nDeviceID')
+    attr = schema.fk_index('DeviceAttribute', 'nDeviceID')
+    whatsup.BulkEngine(schema).update(frame(**{'nDeviceID': ['3'], f'{PIVOT}.nPivotActiveMonitorTypeToDeviceID': ['13'],
+                                               f'{PIVOT}.nDeviceID': ['2']}))
+    assert schema.fk_index(PIVOT, 'nDeviceID') is not pivot
+    assert schema.fk_index('DeviceAttribute', 'nDeviceID') is attr
+    assert_indexes_current(schema)
+
+
+def test_appended_rows_fold_into_the_index(monkeypatch):
+    monkeypatch.setattr(whatsup, '_tail_full', lambda base, tail: tail > 2)
+    s = pd.Series(['a', 'b', '', 'a'], dtype=object)
+    fk, pk = whatsup.ForeignKeyIndex(s), whatsup.PrimaryKeyIndex(s)
+    for i, value in enumerate(['b', 'c', 'a', 'd'], len(s)):
+        fk.append(pd.Series([value], dtype=object), np.array([i]))
+        pk.append(pd.Series([value], dtype=object), np.array([i]))
+    s = pd.concat([s, pd.Series(['b', 'c', 'a', 'd'], dtype=object)], ignore_index=True)
+    for key in ('a', 'b', 'c', 'd', 'x'):
+        assert fk.rows([key]).tolist() == whatsup.ForeignKeyIndex(s).rows([key]).tolist()
+    assert pk.get(['a', 'b', 'c', 'd', 'x']).tolist() == [0, 1, 5, 7, -1]
+    assert fk.remap(np.array([0, 1, 2, -1, 3, 4, -1, 5]))
+    assert fk.rows(['a']).tolist() == [0] and fk.rows(['d']).tolist() == [5]
+
+
+def test_table_view_lookups_wait_for_a_commit(open_schema):
+    schema = open_schema()
+    view = whatsup.TableView(schema, PIVOT)
+    done = threading.Event()
+    with schema.lock.write():
+        worker = threading.Thread(target=lambda: (view.restrict('nDeviceID', ['1']), done.set()))
+        worker.start()
+        assert not done.wait(0.2)   # the FK index may be mid-remap
+    worker.join(5)
+    assert done.is_set() and view.rows.tolist() == [0, 1]
+    view.set_filter('nPivotActiveMonitorTypeToDeviceID', '11', exact=True)
+    assert view.rows.tolist() == [1]
+
+
+def test_key_set_follows_the_chunks():
+    seen, added = whatsup.KeySet(), set()
+    for chunk in (['1', '2'], ['2', '3'], ['4', '5', '1'], ['6'], ['7', '8', '9', '10', '2']):
+        assert seen.contains(chunk).tolist() == [k in added for k in chunk]
+        assert seen.add(chunk).tolist() == [k in added for k in chunk]
+        added.update(chunk)
+    assert len(seen) == 10 and len(seen.parts) < 5
+    assert seen.contains(['6', '11', '3']).tolist() == [True, False, True]
@@ -0,0 +1,44 @@
+import openpyxl
+import pytest
+
+import whatsup
+from conftest import read_table
+
+
+def write_sheet(path, rows):
+    wb = openpyxl.Workbook()
+    for r in rows:
+        wb.active.append(r)
+    wb.save(path)
+    return str(path)
+
+
+ROWS = [('nDeviceID', 'sNote'), (1, 'one'), (None, None), (2, 'two'), (3, None), ('9', 'nine')]
+
+
+def test_excel_is_read_in_chunks_numbered_by_sheet_row(tmp_path):
+    path = write_sheet(tmp_path / 'in.xlsx', ROWS)
+    chunks = list(whatsup.iter_excel_chunks(path, chunk_rows=2))
+    assert [c.index.tolist() for c in chunks] == [[2, 4], [5, 6]]   # the blank row 3 is skipped
+    assert [c.values.tolist() for c in chunks] == [[[1, 'one'], [2, 'two']], [[3, None], ['9', 'nine']]]
+    csv = tmp_path / 'in.csv'
+    csv.write_text('nDeviceID,sNote\n1,one\n,\n2,two\n3,\n', encoding='utf-8')
+    assert [c.index.tolist() for c in whatsup.iter_excel_chunks(str(csv), chunk_rows=2)] == [[2], [4, 5]]
+
+
+def test_chunked_update_reports_problems_by_sheet_row(folder, open_schema, tmp_path):
+    path = write_sheet(tmp_path / 'in.xlsx', ROWS)
+    engine = whatsup.BulkEngine(open_schema())
+    with pytest.raises(whatsup.ValidationError) as e:
+        engine.run('update', whatsup.iter_excel_chunks(path, chunk_rows=2))
+    assert e.value.report.errors[['row', 'value']].values.tolist() == [[6, '9']]
+    result = engine.run('update', whatsup.iter_excel_chunks(write_sheet(tmp_path / 'ok.xlsx', ROWS[:-1]), chunk_rows=2))
+    assert (result.rows, result.updated) == (3, 2)   # device 3's blank sNote is left alone
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['one', 'two', '']
+
+
+def test_unreadable_workbook_is_a_bulk_error(tmp_path):
+    bad = tmp_path / 'bad.xlsx'
+    bad.write_bytes(b'not a zip')
+    with pytest.raises(whatsup.BulkError, match='Failed to read Excel'):
+        list(whatsup.iter_excel_chunks(str(bad)))
@@ -0,0 +1,33 @@
+import json, threading
+
+import whatsup
+
+
+def entries(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_jobs_on_different_threads_flush_their_own_phases(tmp_path, monkeypatch):
+    log = tmp_path / 'metrics.jsonl'
+    monkeypatch.setattr(whatsup.METRICS, 'path', str(log))
+    both_open = threading.Barrier(2)
+
+    def job(name):
+        with whatsup.METRICS.phase(name):
+            both_open.wait()
+        whatsup.METRICS.flush(name)
+    threads = [threading.Thread(target=job, args=(name,)) for name in ('a', 'b')]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert {e['label']: [p['phase'] for p in e['phases']] for e in entries(log)} == {'a': ['a'], 'b': ['b']}
+
+
+def test_loader_threads_record_into_the_load(open_schema, tmp_path, monkeypatch):
+    log = tmp_path / 'metrics.jsonl'
+    monkeypatch.setattr(whatsup.METRICS, 'path', str(log))
+    open_schema()
+    (load,) = entries(log)
+    reads = [p for p in load['phases'] if p['phase'] == 'read_csv']
+    assert len(reads) == 4
+    assert all(p['thread'] != threading.current_thread().name for p in reads)
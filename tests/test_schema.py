@@ -0,0 +1,76 @@
+import os, shutil
+import pandas as pd
+
+import whatsup
+from conftest import read_table
+
+TABLES = ('Device', 'PivotActiveMonitorTypeToDevice', 'DeviceAttribute', 'MonitorState')
+
+
+def frame(**columns):
+    return pd.DataFrame(columns, dtype=object)
+
+
+def write_later(path, df):
+    # another program rewrites the file; make sure its mtime differs from the load's
+    st = os.stat(path)
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_refresh_reloads_only_files_changed_by_others(folder, open_schema):
+    schema = open_schema()
+    path = os.path.join(folder[0], 'Device.csv')
+    device = read_table(folder, 'Device.csv')
+    write_later(path, pd.concat([device, frame(nDeviceID=['7'], sDisplayName=['g'], nWorstStateID=['1'], sNote=[''])]))
+    assert schema.refresh() == ['Device']
+    assert schema.tables['Device'][0]['nDeviceID'].tolist() == ['1', '2', '3', '7']
+    assert schema.refresh() == []
+    whatsup.BulkEngine(schema).update(frame(nDeviceID=['7'], sNote=['seen']))   # the engine sees the new row
+    assert schema.refresh() == []   # its own write is not taken for someone else's
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'x', '', 'seen']
+
+
+def test_projected_tables_load_the_rest_on_first_use(folder, open_schema):
+    schema = open_schema(columns={'Device': ['sNote']})
+    assert list(schema.peek('Device')[0].columns) == ['nDeviceID', 'sNote']
+    assert list(schema.peek('DeviceAttribute')[0].columns) == ['nDeviceAttributeID', 'nDeviceID', 'sName', 'sValue']
+    keys = open_schema(columns='keys')
+    assert list(keys.peek('DeviceAttribute')[0].columns) == ['nDeviceAttributeID', 'nDeviceID']
+    assert keys.is_partial('DeviceAttribute') and keys.columns('DeviceAttribute')[2:] == ['sName', 'sValue']
+    assert keys.tables['DeviceAttribute'][0]['sValue'].tolist() == ['v1', 'v2']
+    assert not keys.is_partial('DeviceAttribute')
+    # a file changed before its columns were read is taken as it is now
+    path = os.path.join(folder[0], 'Device.csv')
+    write_later(path, read_table(folder, 'Device.csv').iloc[:2])
+    assert keys.tables['Device'][0]['sDisplayName'].tolist() == ['a', 'b']
+
+
+def test_detected_defaults_follow_the_changes(folder, open_schema):
+    schema = open_schema()
+    engine = whatsup.BulkEngine(schema)
+    assert schema.table_defaults('DeviceAttribute')['sName'] == 'k'
+    engine.insert(frame(sDisplayName=['d'], **{'DeviceAttribute.sValue': ['v4']}))
+    assert read_table(folder, 'DeviceAttribute.csv').iloc[-1].tolist() == ['102', '4', 'k', 'v4']   # filled from the default
+    engine.update(frame(nDeviceID=['1'], **{'DeviceAttribute.nDeviceAttributeID': ['100'], 'DeviceAttribute.sName': ['z']}))
+    assert schema.table_defaults('DeviceAttribute')['sName'] is None
+    engine.delete(frame(nDeviceID=['1', '3']))
+    engine.update(frame(nDeviceID=['2'], sDisplayName=['B']))
+    for norm in TABLES:
+        df = schema.tables[norm][0]
+        assert schema.table_defaults(norm) == whatsup.TableStats().defaults(df), norm
+
+
+def test_compact_tables_write_back_the_same_text(folder, tmp_path):
+    data, rel = folder
+    pd.DataFrame({'nDeviceAttributeID': ['100', '101', '102'], 'nDeviceID': ['1', '-0', '0'], 'sName': ['k', 'k', 'k'],
+                  'sValue': ['v1', '007', '-0']}).to_csv(os.path.join(data, 'DeviceAttribute.csv'), index=False)
+    plain = str(tmp_path / 'plain')
+    shutil.copytree(data, plain)
+    change = frame(nDeviceID=['1'], **{'DeviceAttribute.nDeviceAttributeID': ['100'], 'DeviceAttribute.sValue': ['w']})
+    for path, compact in ((data, True), (plain, False)):
+        whatsup.BulkEngine(whatsup.DeviceSchema(path, rel, compact=compact)).update(change)
+    for name in os.listdir(plain):
+        with open(os.path.join(data, name), 'rb') as a, open(os.path.join(plain, name), 'rb') as b:
+            assert a.read() == b.read(), name
+    assert read_table(folder, 'DeviceAttribute.csv')['nDeviceID'].tolist() == ['1', '-0', '0']
@@ -0,0 +1,121 @@
+import http.client, json, os, threading, time, urllib.parse
+from collections import Counter
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+
+def test_readers_build_each_index_and_table_once(open_schema, monkeypatch):
+    schema = open_schema(columns='keys')
+    built, completed = [], Counter()
+    fk_init, complete = whatsup.ForeignKeyIndex.__init__, whatsup.DeviceSchema._complete
+
+    def slow_fk(self, s, *args):
+        built.append(s.name)
+        time.sleep(0.05)   # widen the window for a second reader
+        fk_init(self, s, *args)
+
+    def counted_complete(self, norm):
+        completed[norm] += 1
+        time.sleep(0.05)
+        complete(self, norm)
+    monkeypatch.setattr(whatsup.ForeignKeyIndex, '__init__', slow_fk)
+    monkeypatch.setattr(whatsup.DeviceSchema, '_complete', counted_complete)
+    service = whatsup.BulkService(schema)
+    replies = []
+
+    def lookup():
+        replies.append(service.handle('lookup', {'keys': ['1', '2']}))
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert [status for status, _ in replies] == [200] * 4
+    assert all(reply == replies[0][1] for _, reply in replies)
+    assert [r['sDisplayName'] for r in replies[0][1]['Device']] == ['a', 'b']
+    assert len(built) == 3   # one per relation
+    assert set(completed.values()) == {1}
+
+
+def test_output_files_stay_in_the_output_folder(folder, open_schema, tmp_path):
+    service = whatsup.BulkService(open_schema(), output_folder=str(tmp_path / 'out'))
+    status, reply = service.handle('export', {'path': 'devices.csv'})
+    assert status == 200 and reply['files'] == [str(tmp_path / 'out' / 'devices.csv')]
+    outside = [('export', {'path': str(tmp_path / 'devices.csv')}),
+               ('export', {'path': os.path.join(folder[0], 'Device.csv')}),
+               ('export', {'path': '../devices.csv'}),
+               ('update', {'rows': [{'nDeviceID': '2', 'sNote': 'y'}], 'dry_run': True,
+                           'plan_file': str(tmp_path / 'plan.csv')}),
+               ('batch', {'source': str(tmp_path), 'checkpoint': os.path.join(folder[0], 'x.csv')})]
+    for op, req in outside:
+        status, reply = service.handle(op, req)
+        assert status == 400 and 'outside the service output folder' in reply['error']
+    assert sorted(os.listdir(tmp_path)) == ['data', 'out', 'relations.csv']
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'x', '']
+
+
+def test_batch_checkpoint_defaults_to_the_output_folder(open_schema, tmp_path):
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    pd.DataFrame({'nDeviceID': ['2'], 'sNote': ['y']}).to_csv(inputs / '01_update.csv', index=False)
+    service = whatsup.BulkService(open_schema(), output_folder=str(tmp_path / 'out'))
+    status, reply = service.handle('batch', {'source': str(inputs)})
+    assert status == 200 and [e['status'] for e in reply['entries']] == ['done']
+    assert os.listdir(inputs) == ['01_update.csv']
+    (checkpoint,) = os.listdir(tmp_path / 'out')
+    assert checkpoint.startswith('inputs-') and checkpoint.endswith('.checkpoint.csv')
+    status, reply = service.handle('batch', {'source': str(inputs)})
+    assert [e['status'] for e in reply['entries']] == ['skipped']
+
+
+@pytest.fixture
+def server(open_schema, tmp_path):
+    """Start a service on a free local port; yields (url, server)."""
+    started = []
+
+    def start(token=None):
+        server = whatsup.service_server(whatsup.BulkService(open_schema(), output_folder=str(tmp_path / 'out')),
+                                        '127.0.0.1:0', token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}', server
+    yield start
+    for s in started:
+        s.shutdown(); s.server_close()
+
+
+def post(url, body, headers):
+    u = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(u.hostname, u.port, timeout=10)
+    try:
+        conn.request('POST', '/lookup', body, headers)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read())
+    finally:
+        conn.close()
+
+
+def test_requests_from_web_pages_are_refused(server):
+    url, _ = server()
+    body = json.dumps({'keys': ['1']})
+    assert post(url, body, {'Content-Type': 'application/json'})[0] == 200
+    assert post(url, body, {'Content-Type': 'text/plain'})[0] == 415      # a "simple" cross-site form post
+    assert post(url, body, {'Content-Type': 'application/json', 'Origin': 'http://evil.example'})[0] == 403
+    assert post(url, body, {'Content-Type': 'application/json', 'Host': 'evil.example:8765'})[0] == 403   # DNS rebinding
+    assert post(url, body, {'Content-Type': 'application/json', 'Host': 'localhost:8765'})[0] == 200
+    assert whatsup.ServiceClient(url).lookup(['2'])['Device']['sDisplayName'].tolist() == ['b']
+
+
+def test_token_is_required_when_set(server):
+    url, _ = server(token='s3cret')
+    status, reply = post(url, '{}', {'Content-Type': 'application/json'})
+    assert status == 401
+    with pytest.raises(whatsup.BulkError, match='X-Whatsup-Token'):
+        whatsup.ServiceClient(url, token='wrong').lookup(['1'])
+    assert len(whatsup.ServiceClient(url, token='s3cret').lookup(['1'])['Device']) == 1
+
+
+def test_listening_beyond_localhost_needs_a_token(open_schema):
+    with pytest.raises(whatsup.BulkError, match='WHATSUP_SERVICE_TOKEN'):
+        whatsup.service_server(whatsup.BulkService(open_schema()), '0.0.0.0:0', None)
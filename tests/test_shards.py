@@ -0,0 +1,101 @@
+import os, shutil, threading
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+PIVOT = 'dbo.PivotActiveMonitorTypeToDevice.csv'
+
+
+def by_key(df):
+    return df.sort_values(df.columns[0], key=lambda s: s.astype(int)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('scheme', ['hash', 'range'])
+def test_shard_and_unshard_round_trip(folder, scheme):
+    path = os.path.join(folder[0], PIVOT)
+    before = read_table(folder, PIVOT)
+    layout = whatsup.shard_table(path, 'nDeviceID', 3, scheme)
+    assert not os.path.exists(path)
+    parts = [whatsup.DeviceSchema._read_csv(f) for f in layout.files()]
+    for k, part in enumerate(parts):
+        assert (layout.shard_of(part['nDeviceID']) == k).all()
+    assert whatsup.unshard_table(layout.folder) == path
+    assert by_key(read_table(folder, PIVOT)).equals(by_key(before))
+
+
+def run_ops(schema):
+    engine = whatsup.BulkEngine(schema)
+    engine.insert(pd.DataFrame({'sDisplayName': ['d', 'e'], 'PivotActiveMonitorTypeToDevice.nMonitorTypeID': ['7', '8']},
+                               dtype=object))
+    engine.update(pd.DataFrame({'nDeviceID': ['2'], 'PivotActiveMonitorTypeToDevice.nPivotActiveMonitorTypeToDeviceID': ['12'],
+                                'PivotActiveMonitorTypeToDevice.nMonitorTypeID': ['9']}, dtype=object))
+    engine.delete(pd.DataFrame({'nDeviceID': ['1']}, dtype=object))
+
+
+@pytest.mark.parametrize('columns', [None, 'keys'])
+def test_bulk_operations_on_shards_match_a_plain_table(folder, tmp_path, columns):
+    plain = str(tmp_path / 'plain')
+    shutil.copytree(folder[0], plain)
+    run_ops(whatsup.DeviceSchema(plain, folder[1], columns=columns))
+    whatsup.shard_table(os.path.join(folder[0], PIVOT), 'nDeviceID', 4)
+    whatsup.shard_table(os.path.join(folder[0], 'Device.csv'), 'nDeviceID', 2)
+    run_ops(whatsup.DeviceSchema(*folder, columns=columns))
+    for name in ('Device', PIVOT[:-4]):
+        whatsup.unshard_table(os.path.join(folder[0], name + whatsup.SHARD_SUFFIX))
+    for name in (PIVOT, 'Device.csv', 'MonitorState.csv', 'DeviceAttribute.csv'):
+        assert by_key(read_table(folder, name)).equals(by_key(whatsup.DeviceSchema._read_csv(os.path.join(plain, name))))
+
+
+def test_only_shards_with_changed_rows_are_written(folder, open_schema):
+    layout = whatsup.shard_table(os.path.join(folder[0], PIVOT), 'nDeviceID', 4)
+    schema = open_schema()
+    shard = int(layout.shard_of(pd.Series(['3']))[0])
+    result = whatsup.BulkEngine(schema).update(pd.DataFrame(
+        {'nDeviceID': ['3'], 'PivotActiveMonitorTypeToDevice.nPivotActiveMonitorTypeToDeviceID': ['13'],
+         'PivotActiveMonitorTypeToDevice.nMonitorTypeID': ['6']}, dtype=object))
+    assert result.tables_written == [os.path.relpath(layout.files()[shard], folder[0])]
+    reloaded = whatsup.DeviceSchema(*folder)
+    pivot = reloaded.tables['PivotActiveMonitorTypeToDevice'][0]
+    assert pivot.loc[pivot['nPivotActiveMonitorTypeToDeviceID'] == '13', 'nMonitorTypeID'].tolist() == ['6']
+
+
+def test_sharding_waits_for_the_folder_lock(folder):
+    path = os.path.join(folder[0], PIVOT)
+    lock = whatsup.FolderLock(folder[0])
+    lock.acquire()   # another writer is committing
+    done = threading.Event()
+    worker = threading.Thread(target=lambda: (whatsup.shard_table(path, 'nDeviceID', 3), done.set()))
+    worker.start()
+    assert not done.wait(0.2) and os.path.exists(path)
+    lock.release()
+    worker.join(5)
+    assert done.is_set() and not os.path.exists(path)
+
+
+def test_failed_conversion_changes_nothing(folder, monkeypatch):
+    path = os.path.join(folder[0], PIVOT)
+    shards = path[:-4] + whatsup.SHARD_SUFFIX
+    before = read_table(folder, PIVOT)
+    publish = whatsup._publish
+
+    def publish_then_fail(rewrites, appends, removes=(), replay=True):
+        publish(rewrites, appends, removes[:1], replay)   # dies after removing the first file
+        raise OSError('disk full')
+
+    def leftovers():
+        return [f for d in (folder[0], shards) if os.path.isdir(d) for f in os.listdir(d) if f.startswith(whatsup.STAGE_PREFIX)]
+    with monkeypatch.context() as m:
+        m.setattr(whatsup, '_publish', publish_then_fail)
+        with pytest.raises(OSError):
+            whatsup.shard_table(path, 'nDeviceID', 3)
+    assert read_table(folder, PIVOT).equals(before) and not os.path.exists(shards)
+    assert leftovers() == []
+    whatsup.shard_table(path, 'nDeviceID', 3)
+    with monkeypatch.context() as m:
+        m.setattr(whatsup, '_publish', publish_then_fail)
+        with pytest.raises(OSError):
+            whatsup.unshard_table(shards)
+    assert not os.path.exists(path) and leftovers() == []
+    assert by_key(whatsup.DeviceSchema(*folder).tables['PivotActiveMonitorTypeToDevice'][0]).equals(by_key(before))
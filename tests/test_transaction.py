@@ -0,0 +1,147 @@
+import codecs, os
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+
+def write_cp1252(folder):
+    path = os.path.join(folder[0], 'Device.csv')
+    with open(path, 'wb') as f:
+        f.write('nDeviceID,sDisplayName,nWorstStateID,sNote\n1,Café,1,\n2,Müller,1,x\n3,c,2,\n'.encode('cp1252'))
+    return path
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_append_keeps_the_file_encoding(folder, open_schema, tmp_path, cached):
+    path = write_cp1252(folder)
+    cache_dir = str(tmp_path / 'cache') if cached else None
+    if cached:
+        open_schema(cache_dir=cache_dir)   # warm the cache; the next load doesn't read the CSV
+    schema = open_schema(cache_dir=cache_dir)
+    assert schema.tables['Device'][0]['sDisplayName'].tolist() == ['Café', 'Müller', 'c']
+    engine = whatsup.BulkEngine(schema)
+    engine.insert(pd.DataFrame({'sDisplayName': ['Zoë']}, dtype=object))
+    raw = open(path, 'rb').read()
+    assert not raw.startswith(codecs.BOM_UTF8)
+    assert raw.decode('cp1252').splitlines()[-1] == '4,Zoë,,'
+    assert read_table(folder, 'Device.csv')['sDisplayName'].tolist() == ['Café', 'Müller', 'c', 'Zoë']
+
+
+def test_value_outside_the_code_page_rewrites_as_utf8(folder, open_schema):
+    path = write_cp1252(folder)
+    engine = whatsup.BulkEngine(open_schema())
+    engine.insert(pd.DataFrame({'sDisplayName': ['東京']}, dtype=object))
+    assert open(path, 'rb').read().startswith(codecs.BOM_UTF8)
+    assert read_table(folder, 'Device.csv')['sDisplayName'].tolist() == ['Café', 'Müller', 'c', '東京']
+    # the file is UTF-8 now, and later appends follow it
+    engine.insert(pd.DataFrame({'sDisplayName': ['Zoë']}, dtype=object))
+    assert open(path, 'rb').read().decode('utf-8-sig').splitlines()[-1] == '5,Zoë,,'
+
+
+def test_filtered_delete_keeps_the_file_encoding(folder, open_schema):
+    path = write_cp1252(folder)
+    engine = whatsup.BulkEngine(open_schema(columns='keys'))
+    engine.delete(pd.DataFrame({'nDeviceID': ['1']}, dtype=object))
+    assert open(path, 'rb').read().decode('cp1252').splitlines()[1:] == ['2,Müller,1,x', '3,c,2,']
+
+
+def stage(data):
+    """A transaction that rewrites Device.csv, appends to DeviceAttribute.csv and creates New.csv."""
+    txn = whatsup.TableTransaction(data)
+    device = whatsup.DeviceSchema._read_csv(os.path.join(data, 'Device.csv'))
+    device.loc[0, 'sNote'] = 'changed'
+    txn.rewrite(device, os.path.join(data, 'Device.csv'))
+    assert txn.append(pd.DataFrame({'nDeviceAttributeID': ['102'], 'nDeviceID': ['3'], 'sName': ['k'], 'sValue': ['v3']}),
+                      os.path.join(data, 'DeviceAttribute.csv'), ['nDeviceAttributeID', 'nDeviceID', 'sName', 'sValue'])
+    txn.rewrite(pd.DataFrame({'a': ['1']}), os.path.join(data, 'New.csv'))
+    return txn
+
+
+def snapshot(data):
+    return {f: open(os.path.join(data, f), 'rb').read() for f in sorted(os.listdir(data)) if f.endswith('.csv')}
+
+
+def leftovers(data):
+    return [f for f in os.listdir(data) if f.startswith(whatsup.STAGE_PREFIX) or f == whatsup.JOURNAL_NAME]
+
+
+def fail(*args):
+    raise OSError('disk full')
+
+
+@pytest.mark.parametrize('crash', ['moved_aside', 'appending'])
+def test_crashed_commit_is_replayed_from_any_directory(folder, monkeypatch, tmp_path, crash):
+    data = folder[0]
+    monkeypatch.chdir(os.path.dirname(data))
+    txn = stage(os.path.basename(data))   # a relative data folder, as given on the command line
+    replace = os.replace
+    with monkeypatch.context() as m:
+        if crash == 'moved_aside':
+            # dies between moving Device.csv aside and putting the new one in place
+            def dying_replace(src, dst):
+                if os.path.basename(src).startswith(whatsup.STAGE_PREFIX) and not src.endswith('.old'):
+                    raise OSError('killed')
+                replace(src, dst)
+            m.setattr(whatsup.os, 'replace', dying_replace)
+        else:
+            m.setattr(whatsup, '_append_payload', fail)
+        # a dead process neither undoes nor cleans up; the OS drops its lock
+        m.setattr(whatsup, '_undo', lambda *args: None)
+        m.setattr(whatsup.TableTransaction, '_cleanup', lambda self: self.lock.release())
+        with pytest.raises(OSError):
+            txn.commit()
+    assert whatsup.JOURNAL_NAME in os.listdir(data)
+    (tmp_path / 'elsewhere').mkdir()
+    monkeypatch.chdir(tmp_path / 'elsewhere')
+    assert whatsup.TableTransaction.recover(data)
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['changed', 'x', '']
+    assert read_table(folder, 'DeviceAttribute.csv')['nDeviceAttributeID'].tolist() == ['100', '101', '102']
+    assert read_table(folder, 'New.csv')['a'].tolist() == ['1']
+    assert leftovers(data) == []
+
+
+def test_failed_publish_is_rolled_back(folder, monkeypatch):
+    data = folder[0]
+    before = snapshot(data)
+    txn = stage(data)
+    monkeypatch.setattr(whatsup, '_append_payload', fail)
+    with pytest.raises(OSError):
+        txn.commit()
+    assert snapshot(data) == before   # Device.csv restored, New.csv removed again
+    assert leftovers(data) == []
+
+
+def test_missing_staged_file_fails_the_commit(folder):
+    data = folder[0]
+    before = snapshot(data)
+    txn = stage(data)
+    os.remove(txn.rewrites[0][0])
+    with pytest.raises(FileNotFoundError):
+        txn.commit()
+    assert snapshot(data) == before
+    assert leftovers(data) == []
+
+
+def test_opening_the_folder_during_a_commit_leaves_it_alone(folder, open_schema, monkeypatch):
+    schema = open_schema()
+    publish = whatsup._publish
+
+    def publish_after_another_open(*args, **kwargs):
+        open_schema()   # its recover() must not take the staged files for leftovers
+        return publish(*args, **kwargs)
+    monkeypatch.setattr(whatsup, '_publish', publish_after_another_open)
+    result = whatsup.BulkEngine(schema).update(pd.DataFrame({'nDeviceID': ['2'], 'sNote': ['y']}, dtype=object))
+    assert result.tables_written == ['Device.csv']
+    assert read_table(folder, 'Device.csv')['sNote'].tolist() == ['', 'y', '']
+
+
+def test_recover_leaves_a_live_transaction_alone(folder):
+    data = folder[0]
+    txn = stage(data)
+    staged = sorted(leftovers(data))
+    assert not whatsup.TableTransaction.recover(data)
+    assert sorted(leftovers(data)) == staged
+    txn.commit()
+    assert read_table(folder, 'New.csv')['a'].tolist() == ['1']
@@ -0,0 +1,62 @@
+import os
+import pandas as pd
+import pytest
+
+import whatsup
+from conftest import read_table
+
+PIVOT = 'PivotActiveMonitorTypeToDevice'
+
+
+def frame(**columns):
+    return pd.DataFrame(columns, dtype=object)
+
+
+def problems(report):
+    return [tuple(r) for r in report.errors[whatsup.ValidationReport.COLUMNS].astype(str).itertuples(index=False)]
+
+
+def test_report_lists_every_problem_and_nothing_is_written(folder, open_schema):
+    before = {f: read_table(folder, f) for f in os.listdir(folder[0]) if f.endswith('.csv')}
+    engine = whatsup.BulkEngine(open_schema())
+    update = frame(nDeviceID=['2', '9', '2', ''], nWorstStateID=['1', 'two', '3', '1'], sNope=['', '', '', ''])
+    with pytest.raises(whatsup.ValidationError) as e:
+        engine.update(update)
+    assert problems(e.value.report) == [
+        ('', 'sNope', '', 'no column sNope in Device'),
+        ('1', 'nDeviceID', '9', 'no Device with this nDeviceID'),
+        ('1', 'nWorstStateID', 'two', 'not an integer like the rest of Device.nWorstStateID'),
+        ('2', 'nDeviceID', '2', 'nDeviceID repeated in the input'),
+        ('3', 'nDeviceID', '', 'missing nDeviceID'),
+    ]
+    assert 'Input rejected: 5 problems in 3 rows' in str(e.value)
+    assert all(read_table(folder, f).equals(df) for f, df in before.items())
+
+
+def test_foreign_keys_are_checked_against_the_referenced_table(open_schema):
+    engine = whatsup.BulkEngine(open_schema())
+    report = engine.validate_input('update', [frame(**{
+        'nDeviceID': ['1', '2'], f'{PIVOT}.nPivotActiveMonitorTypeToDeviceID': ['10', '12'],
+        f'{PIVOT}.nDeviceID': ['2', '7']})])
+    assert problems(report) == [('1', f'{PIVOT}.nDeviceID', '7', 'no Device row with this nDeviceID')]
+
+
+def test_value_types_come_from_the_data_not_the_column_name(folder, open_schema):
+    path = os.path.join(folder[0], 'Device.csv')
+    device = read_table(folder, 'Device.csv')
+    device['sPort'] = ['80', '443', '']     # numbers, in a column named like text
+    device.to_csv(path, index=False)
+    engine = whatsup.BulkEngine(open_schema())
+    report = engine.validate_input('update', [frame(nDeviceID=['1', '2', '3'], sPort=['8080', 'http', ''],
+                                                    sNote=['5', 'free text', ''])])
+    assert problems(report) == [('1', 'sPort', 'http', 'not an integer like the rest of Device.sPort')]
+
+
+def test_saved_report_reads_back(open_schema, tmp_path):
+    engine = whatsup.BulkEngine(open_schema())
+    report = engine.validate_input('insert', [frame(nDeviceID=['1', '5'], sDisplayName=['a', 'b'])])
+    assert problems(report) == [('0', 'nDeviceID', '1', 'Device with this nDeviceID already exists')]
+    report.save(str(tmp_path / 'report.csv'))
+    saved = pd.read_csv(tmp_path / 'report.csv', dtype=str, keep_default_na=False)
+    assert [tuple(r) for r in saved.itertuples(index=False)] == problems(report)
+    assert len(engine.validate_input('insert', [frame(nDeviceID=['5'], sDisplayName=['b'])])) == 0
@@ -1,673 +1,4927 @@
-"""
-device_combined_bulk.py
-
-Adds Bulk Insert / Bulk Update / Bulk Delete from an Excel file to the previous
-Device-combined manager.
-
-Features added in this file compared to prior version:
-- Buttons: Bulk Insert, Bulk Update, Bulk Delete. They accept an Excel file.
-- Column mapping rules:
-    * Columns named like "Table.Column" (e.g. "Device.sName" or "ChildTable.sVal")
-      are mapped to the named table/column.
-    * Columns not containing a dot are mapped to Device table columns.
-- Bulk Insert:
-    * For each Excel row, creates a Device row and child rows (based on columns or
-      default child-row templates). Missing parameters are taken from user defaults
-      (then detected defaults), otherwise left empty.
-    * After insertion, writes device and child CSVs.
-- Bulk Update:
-    * For each Excel row, locates the Device by primary key (first column of Device CSV);
-      updates only the specified columns that differ (doesn't remove or replace other rows).
-    * For child tables: supports updates if Excel columns use Table.Column and include
-      the child's PK column to identify the row.
-- Bulk Delete:
-    * Excel file must contain the Device primary key column (or column named like it).
-      Each listed PK will be removed from Device CSV and corresponding child rows
-      referencing the device will be removed too (simple cascade by FK match).
-- Default child-row templates: persists to DEFAULT_CHILD_ROWS_FILE. Templates are
-  applied during Insert (both single insert and bulk insert).
-- Visibility dialog now has table-level visibility toggles (show/hide entire table)
-
-Usage: edit DATA_FOLDER, RELATION_FILE paths at top; run with Python 3 and pandas.
-Make a backup of your CSV folder before using bulk operations.
-
-Requires: pandas
-"""
-
-import os, re, json, tempfile, shutil
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import pandas as pd
-from collections import defaultdict
-
-# ---------------- CONFIG ----------------
-DATA_FOLDER = r"C:\WhatsUpCSVs"
-RELATION_FILE = r"C:\Users\Ammar\Desktop\relations.csv"
-DEFAULTS_FILE = os.path.join(os.path.expanduser("~"), "device_defaults.json")
-VISIBILITY_FILE = os.path.join(os.path.expanduser("~"), "device_visibility.json")
-DEFAULT_CHILD_ROWS_FILE = os.path.join(os.path.expanduser("~"), "device_default_child_rows.json")
-ROOT_TABLE = "Device"
-# ----------------------------------------
-
-# ----- small helpers -----
-def normalize_table_name(name: str) -> str:
-    if not isinstance(name, str): return name
-    return re.sub(r"(?i)^dbo[_\.]", "", name.strip())
-
-
-def human_label(c: str) -> str:
-    s = re.sub(r"^[ns](_|-)?", "", c)
-    s = s.replace("_", " ").replace(".", " ")
-    s = re.sub(r"(?<=[a-z0-9])(?=[A-Z])", " ", s)
-    s = re.sub(r"\bID\b", "Id", s, flags=re.IGNORECASE)
-    return " ".join([w.capitalize() for w in s.split()])
-
-
-def safe_write_csv(df, path):
-    df2 = df.fillna("").astype(object)
-    dirn = os.path.dirname(path) or "."
-    fd, tmp = tempfile.mkstemp(dir=dirn, prefix=".tmp_csv_")
-    os.close(fd)
-    try:
-        df2.to_csv(tmp, index=False, encoding="utf-8-sig", na_rep="")
-        shutil.move(tmp, path)
-    finally:
-        if os.path.exists(tmp):
-            try: os.remove(tmp)
-            except: pass
-
-# ----- Tooling (Tooltips) -----
-class ToolTip:
-    def __init__(self, widget, text):
-        self.widget = widget; self.text = text; self.top = None
-        widget.bind("<Enter>", self.show); widget.bind("<Leave>", self.hide)
-    def show(self, e=None):
-        if self.top: return
-        x = self.widget.winfo_rootx() + 12
-        y = self.widget.winfo_rooty() + 12
-        self.top = tk.Toplevel(self.widget); self.top.wm_overrideredirect(True)
-        self.top.wm_geometry(f"+{x}+{y}")
-        lbl = tk.Label(self.top, text=self.text, background="#ffffe0", relief="solid", borderwidth=1, padx=6, pady=3, wraplength=320)
-        lbl.pack()
-    def hide(self, e=None):
-        if self.top:
-            try: self.top.destroy()
-            except: pass
-            self.top = None
-
-# ----- Schema -----
-class DeviceSchema:
-    def __init__(self, data_folder, relation_file, root_table="Device"):
-        self.data_folder = data_folder
-        self.relation_file = relation_file
-        self.root_table = root_table
-        self.relations = None
-        self.child_map = defaultdict(list)
-        self.tables = {}
-        self._load_relations()
-        self._load_device_and_children()
-
-    def _load_relations(self):
-        if not os.path.exists(self.relation_file):
-            raise FileNotFoundError("relations.csv not found")
-        rel = pd.read_csv(self.relation_file, dtype=str, keep_default_na=False)
-        expected = ["ForeignKeyName","ParentTable","ParentColumn","ReferencedTable","ReferencedColumn"]
-        colmap = {}
-        for e in expected:
-            for c in rel.columns:
-                if c.strip().lower() == e.lower():
-                    colmap[e] = c; break
-            else:
-                raise ValueError(f"relations.csv missing column: {e}")
-        rel = rel[[colmap[e] for e in expected]].copy(); rel.columns = expected
-        rel["Parent_norm"] = rel["ParentTable"].apply(normalize_table_name)
-        rel["Referenced_norm"] = rel["ReferencedTable"].apply(normalize_table_name)
-        self.relations = rel
-        for _, r in rel.iterrows():
-            self.child_map[r["Referenced_norm"]].append({
-                "ForeignKeyName": r["ForeignKeyName"],
-                "ParentTable": r["ParentTable"],
-                "Parent_norm": r["Parent_norm"],
-                "ParentColumn": r["ParentColumn"],
-                "ReferencedTable": r["ReferencedTable"],
-                "Referenced_norm": r["Referenced_norm"],
-                "ReferencedColumn": r["ReferencedColumn"],
-            })
-
-    def _find_csv_for_norm(self, norm):
-        files = [f for f in os.listdir(self.data_folder) if f.lower().endswith('.csv')]
-        for f in files:
-            base = os.path.splitext(f)[0]
-            if normalize_table_name(base).lower() == norm.lower():
-                return os.path.join(self.data_folder, f)
-        return None
-
-    def get_table_path(self, norm):
-        return self.tables.get(norm, (None, None))[1]
-
-    def _load_device_and_children(self):
-        root_norm = normalize_table_name(self.root_table)
-        needed = {root_norm}
-        for child in self.child_map.get(root_norm, []):
-            needed.add(child['Parent_norm'])
-        for norm in needed:
-            path = self._find_csv_for_norm(norm)
-            if not path:
-                print(f"[WARN] CSV for {norm} not found in {self.data_folder}; skipping.")
-                continue
-            try:
-                df = pd.read_csv(path, dtype=object, keep_default_na=False)
-            except Exception:
-                df = pd.read_csv(path, dtype=object, encoding='utf-8', errors='replace', keep_default_na=False)
-            df.columns = [str(c) for c in df.columns]
-            df = df.reset_index(drop=True)
-            self.tables[norm] = (df, path)
-
-    def detect_defaults(self):
-        defaults = {}
-        for norm, (df, _) in self.tables.items():
-            col_defaults = {}
-            for c in df.columns:
-                vals = [('' if x is None else str(x)).strip() for x in df[c].tolist()]
-                unique = sorted(set(vals))
-                if len(unique) == 1:
-                    col_defaults[c] = unique[0]
-                else:
-                    col_defaults[c] = None
-            defaults[norm] = col_defaults
-        return defaults
-
-    def compute_next_numeric_pk(self, norm):
-        if norm not in self.tables: return None
-        df, _ = self.tables[norm]
-        if df.shape[1] == 0: return None
-        pk = df.columns[0]
-        try:
-            nums = pd.to_numeric(df[pk], errors='coerce')
-            if nums.dropna().empty: return None
-            return int(nums.max()) + 1
-        except:
-            return None
-
-# ----- Application UI -----
-class DeviceBulkApp(tk.Tk):
-    def __init__(self, schema: DeviceSchema):
-        super().__init__()
-        self.schema = schema
-        self.root_norm = normalize_table_name(schema.root_table)
-        if self.root_norm not in self.schema.tables:
-            messagebox.showerror("Error", f"Device CSV not found in {schema.data_folder}")
-            self.destroy(); return
-        self.detected_defaults = self.schema.detect_defaults()
-        self.user_defaults = self._load_user_defaults()
-        self.visibility = self._load_visibility()
-        self.default_child_rows = self._load_default_child_rows()
-        self._build_ui()
-
-    def _load_user_defaults(self):
-        if os.path.exists(DEFAULTS_FILE):
-            try:
-                with open(DEFAULTS_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-
-    def _load_visibility(self):
-        if os.path.exists(VISIBILITY_FILE):
-            try:
-                with open(VISIBILITY_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-
-    def _load_default_child_rows(self):
-        if os.path.exists(DEFAULT_CHILD_ROWS_FILE):
-            try:
-                with open(DEFAULT_CHILD_ROWS_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-
-    def _save_default_child_rows(self):
-        try:
-            with open(DEFAULT_CHILD_ROWS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.default_child_rows, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            messagebox.showerror("Save error", str(e))
-
-    def _build_ui(self):
-        self.title("Device bulk manager")
-        self.geometry('900x700')
-        top = ttk.Frame(self); top.pack(fill='x', padx=6, pady=6)
-        ttk.Button(top, text='Bulk Insert (Excel)', command=self.bulk_insert_dialog).pack(side='left', padx=6)
-        ttk.Button(top, text='Bulk Update (Excel)', command=self.bulk_update_dialog).pack(side='left', padx=6)
-        ttk.Button(top, text='Bulk Delete (Excel)', command=self.bulk_delete_dialog).pack(side='left', padx=6)
-        ttk.Button(top, text='Manage default child rows', command=self._manage_default_child_rows).pack(side='left', padx=6)
-        ttk.Button(top, text='Show/Hide fields', command=self._open_visibility_editor).pack(side='right', padx=6)
-        ttk.Button(top, text='Edit defaults', command=self._open_defaults_editor).pack(side='right', padx=6)
-        info = ttk.Label(self, text='Make a backup of CSVs before running bulk operations!')
-        info.pack(fill='x', padx=6)
-
-        # small status area
-        self.status = tk.StringVar(value='Ready')
-        ttk.Label(self, textvariable=self.status).pack(fill='x', padx=6, pady=(6,0))
-
-    # ---------- Bulk operations ----------
-    def bulk_insert_dialog(self):
-        path = filedialog.askopenfilename(title='Select Excel for bulk insert', filetypes=[('Excel', '*.xlsx;*.xls')])
-        if not path: return
-        try:
-            df = pd.read_excel(path, dtype=object)
-        except Exception as e:
-            messagebox.showerror('Read error', f'Failed to read Excel: {e}'); return
-        self.status.set(f'Bulk insert: {len(df)} rows from {os.path.basename(path)}')
-        self.bulk_insert_from_df(df)
-
-    def bulk_update_dialog(self):
-        path = filedialog.askopenfilename(title='Select Excel for bulk update', filetypes=[('Excel', '*.xlsx;*.xls')])
-        if not path: return
-        try:
-            df = pd.read_excel(path, dtype=object)
-        except Exception as e:
-            messagebox.showerror('Read error', f'Failed to read Excel: {e}'); return
-        self.status.set(f'Bulk update: {len(df)} rows from {os.path.basename(path)}')
-        self.bulk_update_from_df(df)
-
-    def bulk_delete_dialog(self):
-        path = filedialog.askopenfilename(title='Select Excel for bulk delete (device PK list expected)', filetypes=[('Excel', '*.xlsx;*.xls')])
-        if not path: return
-        try:
-            df = pd.read_excel(path, dtype=object)
-        except Exception as e:
-            messagebox.showerror('Read error', f'Failed to read Excel: {e}'); return
-        self.status.set(f'Bulk delete: {len(df)} rows from {os.path.basename(path)}')
-        self.bulk_delete_from_df(df)
-
-    def _col_to_table_col(self, colname):
-        # if col contains dot: Table.Col, else Device.Col
-        if '.' in colname:
-            t, c = colname.split('.', 1)
-            return normalize_table_name(t), c
-        return self.root_norm, colname
-
-    def bulk_insert_from_df(self, exdf: pd.DataFrame):
-        # map each row to device row + child rows
-        device_df, device_path = self.schema.tables[self.root_norm]
-        new_devices = []
-        child_inserts = defaultdict(list)
-        for _, r in exdf.iterrows():
-            # build device row initial with defaults
-            dev_row = {}
-            # start with user defaults and detected
-            for c in device_df.columns:
-                ud = self.user_defaults.get(self.root_norm, {}).get(c, None)
-                det = self.detected_defaults.get(self.root_norm, {}).get(c, None)
-                dev_row[c] = '' if ud is None and det is None else (ud if ud is not None else det)
-            # override with Excel columns mapped to Device
-            for col in exdf.columns:
-                tnorm, cname = self._col_to_table_col(col)
-                val = r[col]
-                if pd.isna(val):
-                    continue
-                if tnorm == self.root_norm:
-                    if cname in dev_row:
-                        dev_row[cname] = str(val)
-                else:
-                    # child column -> collect into temporary child dict keyed by table
-                    child_inserts[tnorm].append((dev_row, {cname: str(val)}))
-            # also plan default child rows that should be created for every device
-            for ctn, templates in self.default_child_rows.items():
-                for tmpl in templates:
-                    # copy template (strings)
-                    child_inserts[ctn].append((dev_row, dict(tmpl)))
-            new_devices.append(dev_row)
-
-        # append devices sequentially and write CSV incrementally (keeps memory small)
-        if not new_devices:
-            messagebox.showinfo('Bulk insert', 'No devices found in Excel.')
-            return
-        # Build new device DF (append)
-        appended = pd.concat([device_df, pd.DataFrame(new_devices)], ignore_index=True)
-        try:
-            safe_write_csv(appended, device_path)
-        except Exception as e:
-            messagebox.showerror('Write error', f'Failed to write Device CSV: {e}'); return
-        # For child inserts, we must compute FK value for each child row using referenced column or pk.
-        # reload device df to get final state (including newly appended devices)
-        self.schema._load_device_and_children()
-        device_df2, _ = self.schema.tables[self.root_norm]
-        # naive approach: assume excel rows appended in same order to device_df2 tail
-        start_idx = len(device_df)
-        for i, dev_row in enumerate(new_devices):
-            device_pk = None
-            pk_col = device_df.columns[0]
-            # determine device_pk value from appended frame
-            try:
-                device_pk = str(device_df2.iloc[start_idx + i][pk_col])
-            except Exception:
-                device_pk = ''
-            # apply child inserts that referenced this particular dev_row
-            # child_inserts stored tuples (dev_row_ref, partial_row), we match by object identity -- not robust when copy
-            # simpler: also add per-new-device child templates stored earlier in order. We'll instead handle default child rows by templates only here.
-            pass
-        # For simplicity: re-open all child tables and append templates linked to each new device
-        for ctn, templates in self.default_child_rows.items():
-            if ctn not in self.schema.tables:
-                continue
-            child_df, child_path = self.schema.tables[ctn]
-            rows_to_add = []
-            pk_col_child = child_df.columns[0] if child_df.shape[1]>0 else None
-            for j in range(len(new_devices)):
-                # corresponding appended device row
-                try:
-                    device_pk = str(device_df2.iloc[start_idx + j][device_df.columns[0]])
-                except Exception:
-                    device_pk = ''
-                for tmpl in templates:
-                    rdict = dict(tmpl)
-                    # ensure FK set to device_pk if parentcol exists in template key names
-                    # find relation meta
-                    meta_list = [m for m in self.schema.child_map.get(self.root_norm, []) if m['Parent_norm']==ctn]
-                    parent_col = meta_list[0]['ParentColumn'] if meta_list else None
-                    if parent_col:
-                        rdict[parent_col] = device_pk
-                    # child pk auto assign
-                    if pk_col_child and (rdict.get(pk_col_child, '') == ''):
-                        try:
-                            existing = pd.to_numeric(child_df[pk_col_child], errors='coerce')
-                            maxv = existing.max()
-                            if not pd.isna(maxv): rdict[pk_col_child] = int(maxv)+1
-                            else: rdict[pk_col_child] = ''
-                        except:
-                            rdict[pk_col_child] = ''
-                    rows_to_add.append(rdict)
-            if rows_to_add:
-                new_child_df = pd.concat([child_df, pd.DataFrame(rows_to_add)], ignore_index=True)
-                try:
-                    safe_write_csv(new_child_df, child_path)
-                except Exception as e:
-                    messagebox.showerror('Write error', f'Failed to write child table {ctn}: {e}'); return
-        messagebox.showinfo('Bulk insert', f'Inserted {len(new_devices)} devices and default child rows.')
-        self.schema._load_device_and_children()
-
-    def bulk_update_from_df(self, exdf: pd.DataFrame):
-        # update Device rows and optionally child rows if identifying PK is provided
-        device_df, device_path = self.schema.tables[self.root_norm]
-        pk = device_df.columns[0]
-        updated_count = 0
-        device_df2 = device_df.copy()
-        # columns with dot syntax map to child tables; track child updates grouped by table
-        child_updates = defaultdict(list)
-        for _, r in exdf.iterrows():
-            # device pk value expected either as column named pk or as Device.pk
-            if pk in exdf.columns:
-                dev_pk_val = r[pk]
-            elif f'{self.root_norm}.{pk}' in exdf.columns:
-                dev_pk_val = r[f'{self.root_norm}.{pk}']
-            else:
-                messagebox.showwarning('Missing PK', f'Excel must contain Device PK column named "{pk}" for updates. Row skipped.'); continue
-            if pd.isna(dev_pk_val):
-                continue
-            dev_pk_val = str(dev_pk_val)
-            # locate device row by pk
-            matches = device_df2[device_df2[pk].astype(str) == dev_pk_val]
-            if matches.empty:
-                continue
-            idx = matches.index[0]
-            changed = False
-            for col in exdf.columns:
-                tnorm, cname = self._col_to_table_col(col)
-                val = r[col]
-                if pd.isna(val):
-                    continue
-                val = str(val)
-                if tnorm == self.root_norm:
-                    # update device_df2 at idx
-                    old = '' if pd.isna(device_df2.at[idx, cname]) else str(device_df2.at[idx, cname])
-                    if old != val:
-                        device_df2.at[idx, cname] = val; changed = True
-                else:
-                    # child update: require child pk to be present as column Table.ChildPK
-                    child_updates[tnorm].append((dev_pk_val, cname, val, r))
-            if changed:
-                updated_count += 1
-        # write device CSV if any updates
-        if updated_count > 0:
-            try:
-                safe_write_csv(device_df2, device_path)
-            except Exception as e:
-                messagebox.showerror('Write error', f'Failed to write Device CSV: {e}'); return
-        # process child updates: we expect exdf to include child PK column to map
-        child_written = 0
-        for ctn, updates in child_updates.items():
-            if ctn not in self.schema.tables: continue
-            child_df, child_path = self.schema.tables[ctn]
-            child_df2 = child_df.copy()
-            child_pk_col = child_df.columns[0] if child_df.shape[1]>0 else None
-            # naive approach: if update rows contain child's PK column in excel, perform per-row update
-            # otherwise skip child updates
-            # gather unique child pk columns referenced
-            # assume updates entries may include tuple with cname equals child PK column
-            # More robust implementation would require structured Excel design; we'll try simple support
-            for (dev_pk_val, cname, val, original_row) in updates:
-                # look for child pk in original_row as Table.ChildPK or ChildPK
-                child_pk_val = None
-                candidate1 = f'{ctn}.{child_pk_col}' if child_pk_col else None
-                if candidate1 and candidate1 in exdf.columns:
-                    child_pk_val = original_row[candidate1]
-                elif child_pk_col and child_pk_col in exdf.columns:
-                    child_pk_val = original_row[child_pk_col]
-                if pd.isna(child_pk_val) or child_pk_val is None:
-                    continue
-                child_pk_val = str(child_pk_val)
-                # locate row in child_df2
-                match = child_df2[child_df2[child_pk_col].astype(str) == child_pk_val]
-                if match.empty:
-                    continue
-                cidx = match.index[0]
-                old = '' if pd.isna(child_df2.at[cidx, cname]) else str(child_df2.at[cidx, cname])
-                if old != val:
-                    child_df2.at[cidx, cname] = val
-                    child_written += 1
-            if child_written > 0:
-                try:
-                    safe_write_csv(child_df2, child_path)
-                except Exception as e:
-                    messagebox.showerror('Write error', f'Failed to write child table {ctn}: {e}'); return
-        messagebox.showinfo('Bulk update', f'Device rows updated: {updated_count}. Child cells updated (approx): {child_written}.')
-        self.schema._load_device_and_children()
-
-    def bulk_delete_from_df(self, exdf: pd.DataFrame):
-        # expects a column equal to device PK name or Device.PK
-        device_df, device_path = self.schema.tables[self.root_norm]
-        pk = device_df.columns[0]
-        # find column
-        if pk in exdf.columns:
-            keys = exdf[pk].dropna().astype(str).tolist()
-        elif f'{self.root_norm}.{pk}' in exdf.columns:
-            keys = exdf[f'{self.root_norm}.{pk}'].dropna().astype(str).tolist()
-        else:
-            messagebox.showerror('Missing PK', f'Excel must contain primary key column named "{pk}" or "{self.root_norm}.{pk}"'); return
-        if not keys:
-            messagebox.showinfo('Bulk delete', 'No keys found in Excel.'); return
-        # delete from device df
-        df2 = device_df[~device_df[pk].astype(str).isin(keys)].reset_index(drop=True)
-        try:
-            safe_write_csv(df2, device_path)
-        except Exception as e:
-            messagebox.showerror('Write error', f'Failed to write Device CSV: {e}'); return
-        # cascade: remove child rows whose FK equals any deleted pk
-        deleted_children = []
-        for cnorm, (child_df, child_path) in list(self.schema.tables.items()):
-            if cnorm == self.root_norm: continue
-            # find relation meta where parent is root_norm and parent_norm==cnorm
-            meta_list = [m for m in self.schema.child_map.get(self.root_norm, []) if m['Parent_norm']==cnorm]
-            if not meta_list: continue
-            parent_col = meta_list[0]['ParentColumn']
-            cnew = child_df[~child_df[parent_col].astype(str).isin(keys)].reset_index(drop=True)
-            try:
-                safe_write_csv(cnew, child_path)
-                deleted_children.append(cnorm)
-            except Exception as e:
-                messagebox.showerror('Write error', f'Failed to write child table {cnorm}: {e}'); return
-        messagebox.showinfo('Bulk delete', f'Deleted {len(keys)} devices. Cleaned child tables: {", ".join(deleted_children)}')
-        self.schema._load_device_and_children()
-
-    # ---------- default child rows manager ----------
-    def _manage_default_child_rows(self):
-        dialog = DefaultChildRowsDialog(self, 'Manage default child rows', list(self.schema.tables.keys()), self.default_child_rows)
-        if dialog.ok:
-            self.default_child_rows = dialog.result
-            self._save_default_child_rows()
-            messagebox.showinfo('Defaults', 'Default child row templates saved.')
-
-    # ---------- UI helpers (visibility, defaults) ----------
-    def _open_visibility_editor(self):
-        dialog = VisibilityDialog(self, 'Show/Hide fields + tables', list(self.schema.tables.keys()), self.schema, self.visibility)
-        if dialog.ok:
-            self.visibility = dialog.result
-            with open(VISIBILITY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.visibility, f, indent=2, ensure_ascii=False)
-            messagebox.showinfo('Visibility', 'Saved.')
-
-    def _open_defaults_editor(self):
-        dialog = DefaultsEditor(self, 'Edit defaults', self.detected_defaults, self.user_defaults)
-        if dialog.ok:
-            self.user_defaults = dialog.result
-            with open(DEFAULTS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.user_defaults, f, indent=2, ensure_ascii=False)
-            messagebox.showinfo('Defaults', 'Saved.')
-
-# ---------- Dialogs (Defaults, Visibility, DefaultChildRows) ----------
-class DefaultsEditor(tk.Toplevel):
-    def __init__(self, parent, title, detected_defaults, user_defaults):
-        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
-        self.result = {}; self.ok = False
-        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
-        canvas = tk.Canvas(body, height=520); vs = ttk.Scrollbar(body, orient='vertical', command=canvas.yview)
-        canvas.configure(yscrollcommand=vs.set); vs.pack(side='right', fill='y'); canvas.pack(side='left', fill='both', expand=True)
-        inner = ttk.Frame(canvas); canvas.create_window((0,0), window=inner, anchor='nw')
-        def on_conf(e): canvas.configure(scrollregion=canvas.bbox('all'))
-        inner.bind('<Configure>', on_conf)
-        self.entries = {}; row = 0
-        for table, cols in detected_defaults.items():
-            ttk.Label(inner, text=f'Table: {table}', font=('Segoe UI', 10, 'bold')).grid(row=row, column=0, sticky='w', pady=(8,4), padx=6); row+=1
-            for col, det in cols.items():
-                ttk.Label(inner, text=human_label(col)).grid(row=row, column=0, sticky='w', padx=6, pady=3)
-                ent = ttk.Entry(inner, width=60); ent.grid(row=row, column=1, padx=6, pady=3)
-                val = user_defaults.get(table, {}).get(col, det if det is not None else '')
-                ent.insert(0, '' if val is None else str(val))
-                self.entries.setdefault(table, {})[col] = ent
-                row += 1
-        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
-        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
-        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
-        self.grab_set(); self.wait_window(self)
-    def on_ok(self):
-        res = {}
-        for table, colmap in self.entries.items():
-            res[table] = {}
-            for col, ent in colmap.items():
-                v = ent.get().strip()
-                if v != '': res[table][col] = v
-        self.result = res; self.ok = True; self.destroy()
-    def on_cancel(self):
-        self.ok = False; self.destroy()
-
-class VisibilityDialog(tk.Toplevel):
-    def __init__(self, parent, title, table_list, schema: DeviceSchema, current_visibility):
-        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
-        self.result = {}; self.ok = False; self.vars = {}
-        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
-        canvas = tk.Canvas(body, height=520); vs = ttk.Scrollbar(body, orient='vertical', command=canvas.yview)
-        canvas.configure(yscrollcommand=vs.set); vs.pack(side='right', fill='y'); canvas.pack(side='left', fill='both', expand=True)
-        inner = ttk.Frame(canvas); canvas.create_window((0,0), window=inner, anchor='nw')
-        def on_conf(e): canvas.configure(scrollregion=canvas.bbox('all'))
-        inner.bind('<Configure>', on_conf)
-        row = 0
-        for table in table_list:
-            df, _ = schema.tables.get(table, (None, None))
-            if df is None: continue
-            # table-level toggle
-            tvar = tk.BooleanVar(value=current_visibility.get(table, {}).get('__table_visible', True))
-            cb = ttk.Checkbutton(inner, text=f'Table: {table}', variable=tvar)
-            cb.grid(row=row, column=0, sticky='w', pady=(8,4), padx=6)
-            self.vars.setdefault(table, {})['__table_visible'] = tvar
-            row += 1
-            for col in df.columns:
-                var = tk.BooleanVar(value=current_visibility.get(table, {}).get(col, True))
-                cb2 = ttk.Checkbutton(inner, text=human_label(col), variable=var)
-                cb2.grid(row=row, column=0, sticky='w', padx=12)
-                self.vars[table][col] = var
-                row += 1
-        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
-        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
-        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
-        self.grab_set(); self.wait_window(self)
-    def on_ok(self):
-        res = {}
-        for table, cmap in self.vars.items():
-            res[table] = {}
-            for col, var in cmap.items():
-                res[table][col] = bool(var.get())
-        self.result = res; self.ok = True; self.destroy()
-    def on_cancel(self):
-        self.ok = False; self.destroy()
-
-class DefaultChildRowsDialog(tk.Toplevel):
-    """Simple dialog to add/edit default child row templates."""
-    def __init__(self, parent, title, tables, current_templates):
-        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
-        self.result = {}; self.ok = False
-        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
-        canvas = tk.Canvas(body, height=520); vs = ttk.Scrollbar(body, orient='vertical', command=canvas.yview)
-        canvas.configure(yscrollcommand=vs.set); vs.pack(side='right', fill='y'); canvas.pack(side='left', fill='both', expand=True)
-        inner = ttk.Frame(canvas); canvas.create_window((0,0), window=inner, anchor='nw')
-        def on_conf(e): canvas.configure(scrollregion=canvas.bbox('all'))
-        inner.bind('<Configure>', on_conf)
-        self.editors = {}
-        row = 0
-        for t in tables:
-            df, _ = parent.schema.tables.get(t, (None, None))
-            if df is None: continue
-            ttk.Label(inner, text=f'Table: {t}', font=('Segoe UI', 10, 'bold')).grid(row=row, column=0, sticky='w', pady=(8,4), padx=6); row+=1
-            # show existing templates as JSON text (simple UX)
-            txt = tk.Text(inner, height=4, width=80)
-            cur = current_templates.get(t, [])
-            txt.insert('1.0', json.dumps(cur, indent=2, ensure_ascii=False))
-            txt.grid(row=row, column=0, padx=6, pady=4)
-            self.editors[t] = txt
-            row += 1
-        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
-        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
-        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
-        self.grab_set(); self.wait_window(self)
-    def on_ok(self):
-        res = {}
-        try:
-            for t, txt in self.editors.items():
-                raw = txt.get('1.0', 'end').strip()
-                if raw:
-                    parsed = json.loads(raw)
-                    res[t] = parsed
-            self.result = res; self.ok = True; self.destroy()
-        except Exception as e:
-            messagebox.showerror('Parse error', f'Failed to parse JSON: {e}')
-    def on_cancel(self):
-        self.ok = False; self.destroy()
-
-# ---------- run ----------
-def main():
-    if not os.path.exists(DATA_FOLDER):
-        print('Data folder not found:', DATA_FOLDER); return
-    if not os.path.exists(RELATION_FILE):
-        print('relations.csv not found:', RELATION_FILE); return
-    schema = DeviceSchema(DATA_FOLDER, RELATION_FILE, root_table=ROOT_TABLE)
-    app = DeviceBulkApp(schema)
-    app.mainloop()
-
-if __name__ == '__main__':
-    main()
+"""
+device_combined_bulk.py
+
+Adds Bulk Insert / Bulk Update / Bulk Delete from an Excel file to the previous
+Device-combined manager.
+
+Features added in this file compared to prior version:
+- Buttons: Bulk Insert, Bulk Update, Bulk Upsert, Bulk Delete. They accept an Excel file.
+- Column mapping rules:
+    * Columns named like "Table.Column" (e.g. "Device.sName" or "ChildTable.sVal")
+      are mapped to the named table/column.
+    * Columns not containing a dot are mapped to Device table columns.
+- Bulk Insert:
+    * For each Excel row, creates a Device row and child rows (based on columns or
+      default child-row templates). Missing parameters are taken from user defaults
+      (then detected defaults), otherwise left empty.
+    * Empty numeric PKs (Device and child rows) are allocated from a per-table
+      sequence on DeviceSchema (allocate_pks), so keys stay unique across runs.
+    * After insertion, appends the new rows to the device and child CSVs, each in
+      the encoding it was read in (UTF-8, or CSV_FALLBACK_ENCODING for files that
+      aren't); the whole file is rewritten only if its header no longer matches
+      the table or a new value doesn't fit its encoding.
+- Bulk Update:
+    * For each Excel row, locates the Device by primary key (first column of Device CSV);
+      updates only the specified columns that differ (doesn't remove or replace other rows).
+    * For child tables: supports updates if Excel columns use Table.Column and include
+      the child's PK column to identify the row.
+- Bulk Upsert:
+    * One sheet mixing new and existing devices. Rows whose Device PK exists are
+      applied as in Bulk Update; the others (blank or unknown PK) as in Bulk Insert,
+      with defaults and default child rows. Each table is written once.
+- Bulk Delete:
+    * Excel file must contain the Device primary key column (or column named like it).
+      Each listed PK will be removed from Device CSV, and the delete cascades down
+      relations.csv to any depth: rows referencing a deleted row are removed too,
+      one pass per table in dependency order. Only tables that lost rows are written.
+- Default child-row templates: persists to DEFAULT_CHILD_ROWS_FILE. Templates are
+  applied during Insert (both single insert and bulk insert).
+- Visibility dialog now has table-level visibility toggles (show/hide entire table)
+- Headless engine: the bulk operations live in BulkEngine (no Tk) and return
+  BulkResult objects. The UI is a thin wrapper around it, and the same code path
+  is available from the command line:
+      python whatsup.py insert devices.xlsx --data-folder DIR --relations relations.csv
+  (also `update`, `upsert` and `delete`; add --json for machine-readable output).
+- Excel input is streamed (openpyxl read-only mode) in chunks of EXCEL_CHUNK_ROWS
+  rows; each chunk is applied in memory and every affected CSV is written once
+  at the end.
+- Pre-flight validation (VALIDATE_INPUT, CLI --no-validate): before anything is
+  staged, each input chunk is checked as a whole: headers must name table columns;
+  keys must be present, unique and existing (new for inserts); FK values must exist
+  in the referenced table; and values must fit the column's type as inferred from its
+  contents. Any problem rejects the run with one row-level report (UI: save as CSV,
+  CLI: --report FILE).
+- Export ("Export (Excel/CSV)", the browser's "Export these devices", `python whatsup.py
+  export out.xlsx [--keys PK...] [--where COL=TEXT] [--contains COL=TEXT]`): writes devices
+  with every row below them in the import layout (Table.Column headers, one child row
+  per line, the Device PK on each line), gathered in batches through the FK indexes and
+  streamed with openpyxl write-only mode or as CSV. Bulk Update reads the file back
+  (.csv too) and changes nothing until cells are edited.
+- Service mode (`python whatsup.py serve [--listen HOST:PORT | unix:PATH]`): one process
+  keeps the schema loaded and serves insert/update/upsert/delete/apply/lookup/export
+  as a local JSON API (POST /<operation>, GET /status). Bulk writes run one at a time
+  from a single queue, so concurrent users can't lose each other's updates; lookups
+  and exports run side by side under the schema's read lock (SchemaLock). Exports,
+  plans and checkpoints are only written in its output folder (WHATSUP_SERVICE_OUTPUT,
+  default DATA_FOLDER/output). Only JSON requests without an Origin header and with
+  this machine as Host are served (no web page can reach it); WHATSUP_SERVICE_TOKEN
+  sets a shared token clients must send, needed to listen beyond localhost.
+  With WHATSUP_SERVICE=URL (CLI: --service URL) the CLI and the UI send their bulk
+  operations there instead of doing them on their own copy of the tables.
+- Batch ("Batch (folder)", `python whatsup.py batch FOLDER|MANIFEST`): applies a folder of
+  input files tagged by name (0412_update.xlsx) or a manifest (file, op) in order.
+  Each file is checked and staged against the tables the previous files left, and
+  folded into memory; input is parsed a few chunks ahead on a worker thread, never
+  a whole file at once (BATCH_PREFETCH_CHUNKS). Each CSV is then written once
+  per batch (--commit-every N for intermediate commits). A checkpoint CSV, written
+  in the same transaction, records each file's outcome so a rerun resumes after
+  the files already done; a failing file stops the batch (--keep-going skips it).
+- Dry run (UI checkbox, CLI --dry-run / --plan FILE): computes the full change
+  set without writing and reports counts per table. The plan is a diff CSV with
+  op, table, pk, column, old, new; it can be applied later ("Apply saved plan",
+  `python whatsup.py apply plan.csv`) and is refused if the tables changed since.
+- Instrumentation: with WHATSUP_METRICS=FILE (or --metrics FILE) every load and
+  bulk run appends a JSON line with per-phase, per-table wall time, rows/s, bytes
+  written and peak memory; WHATSUP_PROFILE=FILE (or --profile FILE) saves cProfile
+  stats. Both are off by default and then cost next to nothing.
+- Browse data: a virtual-scrolling table browser (only the visible page is put in
+  the Treeview) with filter and sort computed in pandas, and drill-down from a row
+  to its child rows. It honours the Show/Hide settings. The defaults and
+  visibility dialogs list one table at a time.
+- Bulk operations run on a worker thread (BulkJob); the UI polls its event queue,
+  shows a progress bar and offers Cancel, which stops between chunks without
+  writing anything.
+- Table cache (USE_TABLE_CACHE): each loaded table and its detected defaults are
+  kept as binary sidecars in DATA_FOLDER/.whatsup_cache, keyed by the CSV's path,
+  size and mtime, and rewritten on a background thread after every commit, so warm
+  starts skip CSV parsing and bulk edits don't wait for the pickling.
+- Compact mode (COMPACT_TABLES, CLI --compact): numeric PK/FK columns are held as
+  nullable Int64 and repetitive text as categoricals (other text as Arrow strings
+  with pyarrow), only where the column writes back byte-identical CSV. Lookups,
+  deletes and cascades compare those columns directly.
+- Device bundles: schema.get_device_bundles(pks) returns the devices with their
+  rows in every table below them, through the PK index and per-FK-column indexes
+  (fk_index) instead of scanning the tables; `python whatsup.py lookup PK...`.
+  The data browser's drill-down and cascading deletes use the same indexes, which
+  each commit carries over (remapping row positions, indexing appended rows)
+  rather than rebuilding them.
+- Sharded tables: `python whatsup.py shard dbo.DeviceAttribute --shards 32` stores a
+  table as <name>.shards/part-NNNN.csv files partitioned by hash (or --scheme range)
+  of its Device FK. It still loads as one frame; bulk writes only replace or append
+  to the shards holding changed rows. `unshard` converts back to a single CSV.
+- Tables are loaded concurrently (LOAD_THREADS) from a single listing of the data
+  folder. DeviceSchema(columns=...) can limit parsing to some columns (the UI skips
+  hidden ones, a CLI delete reads only PK/FK columns); the rest of a table is read
+  on first access through schema.tables.
+
+Usage: edit DATA_FOLDER, RELATION_FILE paths at top; run with Python 3 and pandas.
+Running without arguments starts the UI.
+Bulk operations are atomic across tables (see TableTransaction): all affected
+CSVs are published together or not at all, so no folder backup is needed, and
+processes writing to the same data folder take turns (FolderLock).
+
+Requires: pandas
+"""
+
+import os, re, sys, csv, json, atexit, codecs, contextvars, hashlib, hmac, ipaddress, time, queue, pickle, socket, cProfile, argparse, tempfile, shutil, threading
+import socketserver, http.client, urllib.parse
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, field, asdict, replace
+
+# ---------------- CONFIG ----------------
+DATA_FOLDER = r"C:\WhatsUpCSVs"
+RELATION_FILE = r"C:\Users\Ammar\Desktop\relations.csv"
+DEFAULTS_FILE = os.path.join(os.path.expanduser("~"), "device_defaults.json")
+VISIBILITY_FILE = os.path.join(os.path.expanduser("~"), "device_visibility.json")
+DEFAULT_CHILD_ROWS_FILE = os.path.join(os.path.expanduser("~"), "device_default_child_rows.json")
+ROOT_TABLE = "Device"
+EXCEL_CHUNK_ROWS = 5000   # rows per chunk when streaming Excel input
+CSV_FALLBACK_ENCODING = 'cp1252'   # table CSVs that aren't valid UTF-8 are read in this code page (and appended to in it)
+EXCEL_MAX_ROWS = 1048576  # rows per worksheet; a longer export continues in name-2.xlsx, name-3.xlsx, ...
+EXPORT_BATCH_DEVICES = 20000   # devices gathered and written per export batch
+BATCH_COMMIT_FILES = 0    # a batch writes its tables once at the end; N > 0 also commits every N files
+BATCH_PREFETCH_CHUNKS = 4   # input chunks a batch parses ahead of the one being staged
+LOAD_THREADS = min(8, os.cpu_count() or 4)   # tables parsed concurrently at load
+USE_TABLE_CACHE = True    # keep binary sidecars of the CSVs in DATA_FOLDER/.whatsup_cache
+COMPACT_TABLES = False    # hold tables in compact dtypes (categorical / Int64) instead of Python strs
+COMPACT_CATEGORY_RATIO = 0.5   # a text column becomes categorical when distinct values <= ratio * rows
+JOB_POLL_MS = 100          # how often the UI drains progress events of a running job
+PROGRESS_INTERVAL = 0.25   # min seconds between progress events sent by a job
+VALIDATE_INPUT = True      # check the whole input (headers, keys, FKs, value types) before changing anything
+METRICS_FILE = os.environ.get('WHATSUP_METRICS')   # JSON-lines log of per-phase timings (off when unset)
+PROFILE_FILE = os.environ.get('WHATSUP_PROFILE')   # cProfile stats of each bulk job (off when unset)
+SERVICE_LISTEN = '127.0.0.1:8765'   # where `whatsup.py serve` listens: HOST:PORT, or unix:PATH
+SERVICE_TOKEN = os.environ.get('WHATSUP_SERVICE_TOKEN')   # shared secret clients must send (X-Whatsup-Token); required to listen beyond localhost
+SERVICE_OUTPUT_FOLDER = os.environ.get('WHATSUP_SERVICE_OUTPUT')   # the only place the service writes exports, plans and checkpoints (default: DATA_FOLDER/output)
+SERVICE_URL = os.environ.get('WHATSUP_SERVICE')   # when set (http://HOST:PORT or unix:PATH) the UI and CLI use that service
+# ----------------------------------------
+
+# ----- small helpers -----
+def normalize_table_name(name: str) -> str:
+    if not isinstance(name, str): return name
+    return re.sub(r"(?i)^dbo[_\.]", "", name.strip())
+
+
+def human_label(c: str) -> str:
+    s = re.sub(r"^[ns](_|-)?", "", c)
+    s = s.replace("_", " ").replace(".", " ")
+    s = re.sub(r"(?<=[a-z0-9])(?=[A-Z])", " ", s)
+    s = re.sub(r"\bID\b", "Id", s, flags=re.IGNORECASE)
+    return " ".join([w.capitalize() for w in s.split()])
+
+
+def dump_csv(df, path, header=True, encoding=None):
+    # the one place that decides how table CSVs are formatted
+    if any(isinstance(t, (pd.Int64Dtype, pd.CategoricalDtype)) for t in df.dtypes):
+        df2 = pd.DataFrame({c: _csv_text(df[c]) for c in df.columns}, index=df.index)
+    else:
+        df2 = df.astype(object).fillna("")
+    df2.to_csv(path, index=False, header=header, encoding=encoding or ("utf-8-sig" if header else "utf-8"), na_rep="")
+
+
+def safe_write_csv(df, path):
+    dirn = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=dirn, prefix=".tmp_csv_")
+    os.close(fd)
+    try:
+        dump_csv(df, tmp)
+        shutil.move(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            try: os.remove(tmp)
+            except: pass
+
+def hidden_columns_projection(visibility):
+    """DeviceSchema `columns` callable that skips columns hidden in the visibility settings."""
+    def project(norm, header):
+        vis = visibility.get(norm, {})
+        if not any(v is False for c, v in vis.items() if c != '__table_visible'):
+            return None
+        return [c for c in header if vis.get(c, True)]
+    return project
+
+
+def read_csv_header(path, encoding=None):
+    try:
+        with open(path, 'r', encoding=_text_encoding(encoding), newline='') as f:
+            return next(csv.reader(f), [])
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def file_encoding(path, detected=None):
+    """Encoding to add rows to the table CSV at `path` in: UTF-8 when the file starts
+    with a BOM (as every file this tool writes does), else the encoding it was
+    `detected` in when loaded (UTF-8 unless given)."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8:
+                return 'utf-8'
+    except OSError:
+        pass
+    return detected or 'utf-8'
+
+
+def _text_encoding(encoding):
+    # opening a UTF-8 table as text: skip its BOM when reading, write one when writing
+    return 'utf-8-sig' if encoding in (None, 'utf-8') else encoding
+
+
+def text_values(s):
+    """Series as the strings written to CSV (missing values become '')."""
+    return s.astype(object).where(s.notna(), '').astype(str)
+
+# ----- Compact column dtypes -----
+# Opt-in (COMPACT_TABLES / DeviceSchema(compact=True)). A column is only converted
+# when it writes back exactly the same CSV text: key columns holding canonical
+# integers become nullable Int64 ('' is <NA>), repetitive text becomes categorical,
+# other text becomes Arrow strings when pyarrow is installed.
+_INT_PATTERN = r'0|-?[1-9][0-9]{0,17}'   # prints back unchanged and fits int64
+
+try:
+    import pyarrow  # noqa: F401
+    _ARROW_STRING = pd.StringDtype('pyarrow')
+except ImportError:
+    _ARROW_STRING = None
+
+
+def int_keys(values):
+    """Text keys as Int64; <NA> where a value isn't a canonical integer, so that
+    e.g. '007' never matches 7 (it wouldn't as text either)."""
+    t = pd.Series(np.asarray(values, dtype=object)).astype(str)
+    ok = t.str.fullmatch(_INT_PATTERN).to_numpy(dtype=bool)
+    out = pd.Series(pd.NA, index=t.index, dtype='Int64')
+    if ok.any():
+        out[ok] = t[ok].astype(np.int64).to_numpy()
+    return out
+
+
+def compact_frame(df, int_columns=(), columns=None):
+    """Copy of `df` with its object columns (or those of `columns`) in compact
+    dtypes (see above); columns that already have another dtype are left alone."""
+    out = df.copy(deep=False)
+    for c in df.columns if columns is None else columns:
+        s = df[c]
+        if s.dtype != object or not len(s):
+            continue
+        if c in int_columns:
+            t = text_values(s)
+            blank = (t == '').to_numpy()
+            if t[~blank].str.fullmatch(_INT_PATTERN).all():
+                out[c] = int_keys(t).array
+                continue
+        codes, uniques = pd.factorize(s)
+        if len(uniques) <= COMPACT_CATEGORY_RATIO * len(s):
+            out[c] = pd.Categorical.from_codes(codes, categories=uniques.astype(object))
+        elif _ARROW_STRING is not None:
+            out[c] = s.astype(_ARROW_STRING)
+    return out
+
+
+def _csv_text(s):
+    # a compact column as CSV text, without formatting every cell in Python
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = np.append(text_values(pd.Series(s.cat.categories)).to_numpy(dtype=object), '')
+        return cats[s.cat.codes.to_numpy()]   # code -1 (missing) picks the trailing ''
+    if isinstance(s.dtype, pd.Int64Dtype):
+        na = s.isna().to_numpy()
+        out = s.to_numpy(dtype=np.int64, na_value=0).astype(str).astype(object)
+        out[na] = ''
+        return out
+    return s.astype(object).fillna('')
+
+
+def key_isin(s, keys):
+    """Boolean mask of the values of column `s` found in `keys`, compared as CSV
+    text; Int64 and categorical columns are compared as they are, not as strings."""
+    if isinstance(s.dtype, pd.Int64Dtype):
+        k = keys if isinstance(getattr(keys, 'dtype', None), pd.Int64Dtype) else int_keys(keys)
+        return s.isin(pd.unique(k.dropna())).to_numpy(dtype=bool)
+    keys = text_values(pd.Series(keys))
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.isin(keys).to_numpy(dtype=bool)   # tested once per category
+    return text_values(s).isin(keys).to_numpy()
+
+
+def text_match(s, text, exact=False):
+    """Boolean mask of the values of column `s` equal to `text` (exact) or containing
+    it, ignoring case; a categorical column is matched once per category."""
+    if exact:
+        return key_isin(s, [text])
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        hit = text_values(pd.Series(s.cat.categories)).str.contains(text, case=False, regex=False)
+        return np.isin(s.cat.codes.to_numpy(), np.flatnonzero(hit.to_numpy()))
+    return text_values(s).str.contains(text, case=False, regex=False).to_numpy(dtype=bool)
+
+
+def concat_rows(base, new):
+    """pd.concat([base, new]) of new text rows, keeping base's compact dtypes where
+    the new values fit them (so the result needn't be compacted again)."""
+    compact = [c for c in base.columns if isinstance(base[c].dtype, (pd.Int64Dtype, pd.CategoricalDtype))]
+    if not compact or set(new.columns) != set(base.columns):
+        return pd.concat([base, new], ignore_index=True)
+    new = new.reset_index(drop=True)
+    cols = {}
+    for c in base.columns:
+        b, n = base[c].reset_index(drop=True), new[c]
+        if isinstance(b.dtype, pd.Int64Dtype):
+            vals = text_values(n)
+            ints = int_keys(vals)
+            if (ints.notna() | vals.eq('')).all():
+                n = ints
+        elif isinstance(b.dtype, pd.CategoricalDtype):
+            vals = text_values(n)
+            b = b.cat.add_categories(pd.Index(pd.unique(vals.to_numpy())).difference(b.cat.categories))
+            n = pd.Series(pd.Categorical(vals, dtype=b.dtype))
+        cols[c] = pd.concat([b, n], ignore_index=True)
+    return pd.DataFrame(cols)
+
+
+def set_cells(df, rows, ci, values):
+    """df.iloc[rows, ci] = values (text), keeping a compact column compact when
+    the values allow it and falling back to plain text when they don't."""
+    s = df.iloc[:, ci]
+    if isinstance(s.dtype, pd.Int64Dtype):
+        vals = pd.Series(values, dtype=object)
+        ints = int_keys(vals)
+        if (ints.notna() | vals.eq('')).all():
+            df.iloc[rows, ci] = ints.to_numpy()
+            return
+        df.isetitem(ci, text_values(s).astype(object))
+    elif isinstance(s.dtype, pd.CategoricalDtype):
+        missing = pd.Index(pd.unique(np.asarray(values, dtype=object))).difference(s.cat.categories)
+        if len(missing):
+            df.isetitem(ci, s.cat.add_categories(missing))
+    df.iloc[rows, ci] = values
+
+# ----- Instrumentation -----
+def peak_rss_mb():
+    """Peak resident memory of this process so far, in MB (None if unknown)."""
+    try:
+        import resource
+    except ImportError:
+        return _peak_rss_windows()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def _peak_rss_windows():
+    try:
+        import ctypes
+        from ctypes import wintypes
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                       [(f, ctypes.c_size_t) for f in ('PeakWorkingSetSize', 'WorkingSetSize',
+                        'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                        'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+        c = Counters(); c.cb = ctypes.sizeof(c)
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(c), c.cb):
+            return None
+        return c.PeakWorkingSetSize / 2**20
+    except Exception:
+        return None
+
+
+class _Phase:
+    __slots__ = ('metrics', 'name', 'table', 'rows', 'bytes', '_t0')
+
+    def __init__(self, metrics, name, table, rows):
+        self.metrics, self.name, self.table, self.rows, self.bytes = metrics, name, table, rows, None
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics._record(self, time.perf_counter() - self._t0, exc_type is not None)
+        return False
+
+
+class _NoPhase:
+    """What Metrics.phase() returns when instrumentation is off: does nothing and
+    is falsy, so callers can skip computing counters (`if p: p.bytes = ...`)."""
+    __slots__ = ()
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def __bool__(self): return False
+
+_NO_PHASE = _NoPhase()
+
+
+class Metrics:
+    """Per-phase wall time, rows/s, bytes written and peak memory.
+
+    Wrap a phase in `with METRICS.phase('read_csv', table) as p:` and set p.rows /
+    p.bytes inside when known. Records accumulate until flush(label), which appends
+    one JSON line (the phases plus per-phase totals) to the log file. Off unless a
+    log path is set (WHATSUP_METRICS or --metrics); then phase() is a constant.
+
+    Records are kept per context, so jobs on different threads (BulkJob, service
+    requests) each flush only their own; work a job hands to a thread pool records
+    into the job when submitted through bind().
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._records = contextvars.ContextVar(f'metrics_records_{id(self)}')
+
+    @property
+    def records(self):
+        """The records of the current job (thread) not flushed yet."""
+        records = self._records.get(None)
+        if records is None:
+            records = []
+            self._records.set(records)
+        return records
+
+    def bind(self, fn):
+        """`fn` wrapped to run in the caller's context, for pool threads whose phases
+        belong to the job that submitted them."""
+        self.records   # so the copies share the caller's list
+        ctx = contextvars.copy_context()
+        return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+    def enable(self, path):
+        self.path = path
+
+    def phase(self, name, table=None, rows=None):
+        return _Phase(self, name, table, rows) if self.path else _NO_PHASE
+
+    def _record(self, p, seconds, failed):
+        rec = {'phase': p.name, 'table': p.table, 'seconds': round(seconds, 6), 'rows': p.rows,
+               'rows_per_sec': round(p.rows / seconds) if p.rows and seconds > 0 else None,
+               'bytes': p.bytes, 'peak_rss_mb': peak_rss_mb(), 'thread': threading.current_thread().name}
+        if failed: rec['failed'] = True
+        self.records.append(rec)   # list.append is atomic; loader threads record too (see bind)
+
+    def flush(self, label, **extra):
+        if not self.path or not self.records:
+            return
+        records = self.records
+        self._records.set([])
+        totals = {}
+        for r in records:
+            t = totals.setdefault(r['phase'], {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+            t['count'] += 1; t['seconds'] = round(t['seconds'] + r['seconds'], 6)
+            t['rows'] += r['rows'] or 0; t['bytes'] += r['bytes'] or 0
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'label': label, **extra,
+                 'peak_rss_mb': peak_rss_mb(), 'totals': totals, 'phases': records}
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"[WARN] Could not write metrics to {self.path}: {e}")
+
+
+METRICS = Metrics(METRICS_FILE)
+
+
+def profiled(path, fn, *args, **kwargs):
+    """Call fn under cProfile and dump the stats to `path` (just call it if path is empty)."""
+    if not path:
+        return fn(*args, **kwargs)
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(fn, *args, **kwargs)
+    finally:
+        prof.dump_stats(path)
+
+# ----- Atomic multi-table writes -----
+JOURNAL_NAME = '.whatsup_journal.json'
+LOCK_NAME = '.whatsup_lock'
+STAGE_PREFIX = '.whatsup_stage_'
+
+
+def _fsync_file(path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def _write_json_atomic(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, indent=2); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class FolderLock:
+    """Exclusive lock on a data folder: the lock file LOCK_NAME in it, held with flock
+    (msvcrt.locking on Windows). It is tied to the open file, so it excludes other
+    processes as well as other holders in this one, and a process that dies drops it."""
+    def __init__(self, folder):
+        self.path = os.path.join(folder, LOCK_NAME)
+        self._f = None
+
+    @property
+    def held(self):
+        return self._f is not None
+
+    def acquire(self, blocking=True):
+        """Take the lock, waiting for it unless not `blocking`; False if it is taken."""
+        f = open(self.path, 'a+b')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                while True:
+                    try:
+                        f.seek(0); msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1); break
+                    except OSError:
+                        if not blocking: raise
+                        time.sleep(0.05)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def release(self):
+        if self._f is None: return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._f.seek(0); msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._f.close(); self._f = None   # closing the file drops a flock
+
+
+def _journal_path(path, folder):
+    # paths in the data folder are journalled relative to it, so a replay finds them whatever the working directory
+    try:
+        rel = os.path.relpath(path, folder)
+    except ValueError:   # another drive
+        return path
+    return path if rel == os.pardir or rel.startswith(os.pardir + os.sep) else rel
+
+
+class TableTransaction:
+    """Publish a set of CSV writes all-or-nothing.
+
+    Writes are staged next to their targets first (full rewrites as complete
+    temp files, appends as the bytes to add). commit() then records a journal
+    in the data folder and publishes: each rewritten target is renamed aside
+    and replaced, each append is written at its recorded offset, and each removed
+    file is renamed aside (and deleted with the other set-aside files). If publishing
+    fails the completed steps are undone (files the transaction created are
+    removed); if the process dies, recover() rolls the journal forward on the
+    next start. Nothing is published when staging fails, and no backup copy of
+    the folder is needed. From its first staged file until commit() or abort()
+    the transaction holds the folder's FolderLock, so other writers wait and
+    recover() in another process leaves its files alone.
+    """
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        self.journal = os.path.join(self.folder, JOURNAL_NAME)
+        self.lock = FolderLock(self.folder)
+        self.rewrites = []   # (staged file, target, aside name, whether the target is new)
+        self.appends = []    # (staged payload, target, original size)
+        self.removes = []    # (target, aside name)
+
+    def _stage_path(self, target):
+        if not self.lock.held:
+            self.lock.acquire()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=STAGE_PREFIX)
+        os.close(fd)
+        return tmp
+
+    def rewrite(self, df, path):
+        path = os.path.abspath(path)
+        tmp = self._stage_path(path)
+        with METRICS.phase('write_csv', os.path.basename(path), len(df)) as p:
+            dump_csv(df, tmp)
+            _fsync_file(tmp)
+            if p: p.bytes = os.path.getsize(tmp)
+        self.rewrites.append((tmp, path, tmp + '.old', not os.path.exists(path)))
+
+    def rewrite_json(self, obj, path):
+        path = os.path.abspath(path)
+        tmp = self._stage_path(path)
+        _write_json_atomic(obj, tmp)
+        self.rewrites.append((tmp, path, tmp + '.old', not os.path.exists(path)))
+
+    def remove(self, path):
+        """Stage the deletion of the file at `path`."""
+        path = os.path.abspath(path)
+        tmp = self._stage_path(path)
+        os.remove(tmp)   # only its (unique) name is needed, for the set-aside file
+        self.removes.append((path, tmp + '.old'))
+
+    def append(self, df, path, columns, encoding=None):
+        """Stage rows to append to `path`, in the `encoding` it was read in (see
+        file_encoding); False if its header isn't `columns` or the rows don't fit
+        that encoding (rewrite instead)."""
+        columns = [str(c) for c in columns]
+        path = os.path.abspath(path)
+        encoding = file_encoding(path, encoding)
+        if read_csv_header(path, encoding) != columns:
+            return False
+        tmp = self._stage_path(path)
+        with METRICS.phase('append_csv', os.path.basename(path), len(df)) as p:
+            try:
+                dump_csv(df.reindex(columns=columns), tmp, header=False, encoding=encoding)
+            except UnicodeEncodeError:
+                os.remove(tmp)
+                return False
+            _fsync_file(tmp)
+            if p: p.bytes = os.path.getsize(tmp)
+        self.appends.append((tmp, path, os.path.getsize(path)))
+        return True
+
+    def filter_rows(self, path, keep, encoding=None):
+        """Stage `path` without the data rows where `keep` is False. The file is
+        streamed row by row, so the table's columns needn't be in memory; the rows
+        kept are written back byte for byte in the file's `encoding`."""
+        path = os.path.abspath(path)
+        tmp = self._stage_path(path)
+        text = _text_encoding(file_encoding(path, encoding))
+        n = 0
+        with METRICS.phase('filter_csv', os.path.basename(path), len(keep)) as p:
+            with open(path, 'r', encoding=text, errors='surrogateescape', newline='') as src, \
+                 open(tmp, 'w', encoding=text, errors='surrogateescape', newline='') as out:
+                reader = csv.reader(src)
+                writer = csv.writer(out, lineterminator=os.linesep)
+                writer.writerow(next(reader, []))
+                for row in reader:
+                    if not row: continue   # blank lines aren't rows to pandas either
+                    if n < len(keep) and keep[n]: writer.writerow(row)
+                    n += 1
+            if n != len(keep):
+                os.remove(tmp)
+                raise ValueError(f'{os.path.basename(path)} has {n} rows, expected {len(keep)}; it changed on disk')
+            _fsync_file(tmp)
+            if p: p.bytes = os.path.getsize(tmp)
+        self.rewrites.append((tmp, path, tmp + '.old', False))
+
+    def targets(self):
+        return [r[1] for r in self.rewrites] + [t for _, t, _ in self.appends] + [t for t, _ in self.removes]
+
+    def commit(self):
+        if not (self.rewrites or self.appends or self.removes):
+            self._cleanup()
+            return
+        try:
+            missing = [r[0] for r in self.rewrites + self.appends if not os.path.exists(r[0])]
+            if missing:
+                raise FileNotFoundError('staged files disappeared before the commit: ' +
+                                        ', '.join(os.path.basename(m) for m in missing))
+            j = lambda p: _journal_path(p, self.folder)
+            _write_json_atomic({'rewrites': [[j(tmp), j(target), j(old), new] for tmp, target, old, new in self.rewrites],
+                                'appends': [[j(tmp), j(target), offset] for tmp, target, offset in self.appends],
+                               'removes': [[j(target), j(old)] for target, old in self.removes]},
+                               self.journal)
+            with METRICS.phase('publish'):
+                _publish(self.rewrites, self.appends, self.removes, replay=False)
+        except BaseException:
+            _undo(self.rewrites, self.appends, self.removes)
+            self._cleanup()
+            raise
+        self._cleanup()
+
+    def abort(self):
+        self._cleanup()
+
+    def _cleanup(self):
+        try:
+            for tmp, _, old, _ in self.rewrites:
+                for p in (tmp, old):
+                    if os.path.exists(p): os.remove(p)
+            for tmp, _, _ in self.appends:
+                if os.path.exists(tmp): os.remove(tmp)
+            for _, old in self.removes:
+                if os.path.exists(old): os.remove(old)
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def recover(folder):
+        """Finish (or clean up after) a commit interrupted by a crash. Returns True if
+        a journal was replayed. While a live transaction holds the folder's lock its
+        journal and staged files are its own, and nothing is touched."""
+        txn = TableTransaction(folder)
+        if not txn.lock.acquire(blocking=False):
+            return False
+        replayed = False
+        try:
+            if os.path.exists(txn.journal):
+                with open(txn.journal, 'r', encoding='utf-8') as f:
+                    j = json.load(f)
+                path = lambda p: os.path.join(txn.folder, p)   # absolute paths are kept by join
+                txn.rewrites = [(path(r[0]), path(r[1]), path(r[2]), bool(r[3]) if len(r) > 3 else False)
+                                for r in j.get('rewrites', [])]
+                txn.appends = [(path(a[0]), path(a[1]), a[2]) for a in j.get('appends', [])]
+                txn.removes = [(path(r[0]), path(r[1])) for r in j.get('removes', [])]
+                _publish(txn.rewrites, txn.appends, txn.removes)
+                replayed = True
+            txn._cleanup()
+            # staged files without a journal belong to a commit that never started
+            dirs = [txn.folder] + [os.path.join(txn.folder, d) for d in os.listdir(txn.folder) if d.endswith(SHARD_SUFFIX)]
+            for d in dirs:
+                for f in os.listdir(d):
+                    if f.startswith(STAGE_PREFIX):
+                        os.remove(os.path.join(d, f))
+        finally:
+            txn.lock.release()
+        return replayed
+
+
+def _append_payload(payload, target, offset):
+    with open(target, 'rb+') as out:
+        out.truncate(offset)
+        if offset:
+            out.seek(offset - 1)
+            if out.read(1) not in (b'\n', b'\r'):
+                out.write(os.linesep.encode())
+        out.seek(0, os.SEEK_END)
+        with open(payload, 'rb') as src:
+            shutil.copyfileobj(src, out)
+        out.flush(); os.fsync(out.fileno())
+
+
+def _publish(rewrites, appends, removes=(), replay=True):
+    # idempotent, so a journal can be replayed after a crash at any point; in a
+    # replay a missing staged file was published already, in a live commit it is an error
+    for tmp, target, old, _ in rewrites:
+        if not os.path.exists(tmp):
+            if replay: continue
+            raise FileNotFoundError(f'staged file for {os.path.basename(target)} disappeared')
+        if os.path.exists(target) and not os.path.exists(old):
+            os.replace(target, old)
+        os.replace(tmp, target)
+    for payload, target, offset in appends:
+        if os.path.exists(payload):
+            _append_payload(payload, target, offset)
+        elif not replay:
+            raise FileNotFoundError(f'staged rows for {os.path.basename(target)} disappeared')
+    for target, old in removes:
+        if os.path.exists(target) and not os.path.exists(old):
+            os.replace(target, old)
+
+
+def _undo(rewrites, appends, removes=()):
+    for target, old in removes:
+        if os.path.exists(old):
+            os.replace(old, target)
+    for tmp, target, old, new in rewrites:
+        if os.path.exists(old):
+            os.replace(old, target)
+        elif new and not os.path.exists(tmp) and os.path.exists(target):
+            os.remove(target)   # created by the transaction
+    for payload, target, offset in appends:
+        if os.path.exists(target) and os.path.getsize(target) > offset:
+            os.truncate(target, offset)
+
+# ----- Tooling (Tooltips) -----
+class ToolTip:
+    def __init__(self, widget, text):
+        self.widget = widget; self.text = text; self.top = None
+        widget.bind("<Enter>", self.show); widget.bind("<Leave>", self.hide)
+    def show(self, e=None):
+        if self.top: return
+        x = self.widget.winfo_rootx() + 12
+        y = self.widget.winfo_rooty() + 12
+        self.top = tk.Toplevel(self.widget); self.top.wm_overrideredirect(True)
+        self.top.wm_geometry(f"+{x}+{y}")
+        lbl = tk.Label(self.top, text=self.text, background="#ffffe0", relief="solid", borderwidth=1, padx=6, pady=3, wraplength=320)
+        lbl.pack()
+    def hide(self, e=None):
+        if self.top:
+            try: self.top.destroy()
+            except: pass
+            self.top = None
+
+# ----- Table cache -----
+CACHE_VERSION = 1
+
+
+def default_cache_dir(data_folder):
+    return os.path.join(data_folder, '.whatsup_cache')
+
+
+class TableCache:
+    """Binary sidecar per table so startup doesn't have to re-parse the CSVs.
+
+    Each table is pickled to <dir>/<table>.pkl together with the source CSV's
+    path, size, mtime and encoding; the detected defaults go to <table>.defaults.json with
+    the same key. An entry is used only while the key still matches the CSV.
+    The files are local and written by this tool only (pickle is not safe for
+    untrusted input). After a commit, tables are stored with store_later() on a
+    background thread, so a bulk edit doesn't wait for its tables to be pickled.
+    """
+    def __init__(self, folder, compact=False):
+        self.folder = folder
+        self.compact = compact   # compact and plain frames are cached separately
+        self._pending = {}       # norm -> (key, frame, encoding) waiting for the writer thread
+        self._writing = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _key(self, path):
+        return {'version': CACHE_VERSION, 'source': os.path.abspath(path), 'sig': list(_file_sig(path)),
+                'compact': self.compact}
+
+    def _file(self, norm, ext):
+        return os.path.join(self.folder, f'{norm}.{ext}')
+
+    def load(self, norm, path):
+        """(frame, CSV encoding) of a table, or None if there is no fresh entry."""
+        f = self._file(norm, 'pkl')
+        if not os.path.exists(f): return None
+        try:
+            with open(f, 'rb') as fh:
+                entry = pickle.load(fh)
+            return (entry['df'], entry.get('encoding', 'utf-8')) if entry.get('key') == self._key(path) else None
+        except Exception:
+            return None
+
+    def store(self, norm, path, df, encoding='utf-8'):
+        self._store(norm, self._key(path), df, encoding)
+
+    def _store(self, norm, key, df, encoding):
+        self._dump(self._file(norm, 'pkl'), lambda fh: pickle.dump({'key': key, 'df': df, 'encoding': encoding},
+                                                                   fh, protocol=pickle.HIGHEST_PROTOCOL), 'wb')
+
+    def store_later(self, norm, path, df, encoding='utf-8'):
+        """store() on the cache's writer thread. The entry is keyed by the CSV as it is
+        now; a table stored again before its turn is only written once (the latest frame)."""
+        key = self._key(path)
+        with self._cond:
+            self._pending[norm] = (key, df, encoding)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_pending, name='cache-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify_all()
+
+    def _write_pending(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                norm = next(iter(self._pending))
+                key, df, encoding = self._pending.pop(norm)
+                self._writing += 1
+            try:
+                self._store(norm, key, df, encoding)
+            finally:
+                with self._cond:
+                    self._writing -= 1
+                    self._cond.notify_all()
+
+    def flush(self):
+        """Wait until every store_later() is written."""
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+
+    def load_defaults(self, norm, path):
+        f = self._file(norm, 'defaults.json')
+        entry = load_json_file(f)
+        return entry.get('defaults') if entry.get('key') == self._key(path) else None
+
+    def store_defaults(self, norm, path, defaults):
+        self._dump(self._file(norm, 'defaults.json'), lambda fh: json.dump({'key': self._key(path), 'defaults': defaults}, fh, ensure_ascii=False), 'w')
+
+    def _dump(self, target, write, mode):
+        # the cache is only an accelerator: failures are reported, never fatal
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.folder, prefix='.tmp_cache_')
+            with os.fdopen(fd, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as fh:
+                write(fh)
+            os.replace(tmp, target)
+        except Exception as e:
+            print(f"[WARN] Could not write cache {os.path.basename(target)}: {e}")
+
+# ----- Column statistics / detected defaults -----
+def _stripped(s):
+    return text_values(s).str.strip()
+
+
+class TableStats:
+    """Per-column summary of one table: the detected default (the column's only
+    value, else None) plus, on request, distinct count and most common value.
+
+    Defaults are computed column-wise and then maintained from the changes the
+    bulk engine makes; a column whose default can't be decided from a change
+    alone is marked stale and recomputed the next time it is asked for.
+    """
+    def __init__(self, defaults=None):
+        self._defaults = dict(defaults or {})
+        self._stale = set() if defaults is not None else None   # None: everything stale
+        self._summary = {}
+        self._kinds = {}
+
+    @property
+    def computed(self):
+        return self._stale is not None
+
+    @staticmethod
+    def _detect(s):
+        v = _stripped(s)
+        if len(v) == 0: return None
+        first = v.iloc[0]
+        return first if (v == first).all() else None
+
+    def defaults(self, df):
+        if self._stale is None:
+            self._defaults = {c: self._detect(df[c]) for c in df.columns}
+            self._stale = set()
+        elif self._stale:
+            for c in self._stale:
+                if c in df.columns: self._defaults[c] = self._detect(df[c])
+            self._stale = set()
+        return dict(self._defaults)
+
+    def summary(self, df, col):
+        """{'distinct', 'top', 'top_count', 'default'} for one column (cached)."""
+        out = self._summary.get(col)
+        if out is None:
+            vc = _stripped(df[col]).value_counts()
+            out = {'distinct': int(len(vc)),
+                   'top': vc.index[0] if len(vc) else None,
+                   'top_count': int(vc.iloc[0]) if len(vc) else 0,
+                   'default': self.defaults(df).get(col)}
+            self._summary[col] = out
+        return out
+
+    def kind(self, df, col):
+        """'integer' or 'number' when every non-blank value of the column is one, else
+        None (text, or no values to go by). Cached like summary()."""
+        if col not in self._kinds:
+            s = df[col]
+            if isinstance(s.dtype, pd.Int64Dtype):
+                kind = 'integer' if s.notna().any() else None
+            else:
+                if isinstance(s.dtype, pd.CategoricalDtype):
+                    s = pd.Series(s.cat.categories)   # each distinct value once
+                v = s.to_numpy(dtype=object)
+                v = v[~(pd.isna(v) | (v == ''))]
+                kind = None
+                # numpy's casts parse the strings in C; the first value that doesn't fit ends the attempt
+                for name, dtype in (('integer', np.int64), ('number', float)):
+                    try:
+                        if len(v): v.astype(dtype); kind = name
+                    except (ValueError, TypeError, OverflowError):
+                        continue
+                    break
+            self._kinds[col] = kind
+        return self._kinds[col]
+
+    def _forget(self, col):
+        self._summary.pop(col, None)
+        self._kinds.pop(col, None)
+
+    def _mark(self, cols):
+        if self._stale is not None: self._stale.update(cols)
+        for c in cols: self._forget(c)
+
+    def rows_added(self, rows, n_before):
+        for c in rows.columns: self._kinds.pop(c, None)
+        if self._stale is None: return
+        if n_before == 0:
+            self._mark(rows.columns); return
+        for c in rows.columns:
+            d = self._defaults.get(c)
+            # a constant column stays constant only if every new value matches it;
+            # a column with two or more values can't become constant by adding rows
+            if d is not None and not (_stripped(rows[c]) == d).all():
+                self._defaults[c] = None
+            self._forget(c)
+
+    def rows_removed(self, n_left):
+        self._kinds = {}
+        if self._stale is None: return
+        if n_left == 0:
+            self._defaults = {c: None for c in self._defaults}; self._stale = set(); self._summary = {}
+            return
+        # constant columns stay constant; the others might have become constant
+        self._mark([c for c, d in self._defaults.items() if d is None])
+        self._summary = {}
+
+    def cells_updated(self, col, new_values):
+        d = self._defaults.get(col)
+        if d is not None and (_stripped(pd.Series(new_values, dtype=object)) == d).all():
+            self._forget(col)
+        else:
+            self._mark([col])
+
+class TableDelta:
+    """What the bulk engine changed in one table, used to update its TableStats."""
+    def __init__(self):
+        self.added = []                     # frames of appended rows
+        self.removed = 0                    # rows deleted
+        self.updated = defaultdict(list)    # column -> arrays of new cell values
+        self.keep = None                    # mask of the rows left by deletes
+        self.order = None                   # how the rows were reordered afterwards (sharded tables)
+
+    def apply_to(self, stats, n_rows):
+        added = pd.concat(self.added, ignore_index=True) if self.added else None
+        n_added = 0 if added is None else len(added)
+        if self.removed:
+            stats.rows_removed(n_rows - n_added)
+        for col, vals in self.updated.items():
+            stats.cells_updated(col, np.concatenate(vals))
+        if added is not None:
+            stats.rows_added(added, n_rows - n_added)
+
+    def row_map(self, n_before, n_after):
+        """(where, added): the new position of each row the table had (-1 if deleted;
+        None when no row moved) and the positions of the added rows. None if the
+        rows can't be followed."""
+        n_kept = n_before if self.keep is None else int(self.keep.sum())
+        if (self.keep is not None and len(self.keep) != n_before) or \
+                n_after - n_kept != sum(len(a) for a in self.added):
+            return None
+        if self.order is None:
+            final = np.arange(n_after)
+        elif len(self.order) == n_after:
+            final = np.empty(n_after, dtype=np.intp)
+            final[self.order] = np.arange(n_after)
+        else:
+            return None
+        where = None
+        if self.keep is not None or self.order is not None:
+            where = np.full(n_before, -1, dtype=np.intp)
+            where[np.ones(n_before, dtype=bool) if self.keep is None else self.keep] = final[:n_kept]
+        return where, final[n_kept:]
+
+# ----- Relation graph -----
+class RelationGraph:
+    """Index over relations.csv in both directions.
+
+    children[t]: relations whose ReferencedTable is t (tables holding an FK to t).
+    parents[t]:  relations whose ParentTable is t (the tables t points at).
+    Each relation is a dict with the relations.csv columns plus Parent_norm and
+    Referenced_norm. Self-references are indexed but ignored for ordering; a
+    delete cascade still follows them (BulkEngine._apply_deletes).
+    """
+    def __init__(self, rel):
+        self.children = defaultdict(list)
+        self.parents = defaultdict(list)
+        for r in rel.to_dict('records'):
+            self.children[r['Referenced_norm']].append(r)
+            self.parents[r['Parent_norm']].append(r)
+        self._orders = {}
+
+    def descendants(self, root):
+        seen, stack = {root}, [root]
+        while stack:
+            for m in self.children.get(stack.pop(), []):
+                if m['Parent_norm'] not in seen:
+                    seen.add(m['Parent_norm']); stack.append(m['Parent_norm'])
+        return seen
+
+    def order(self, root):
+        """`root` followed by its descendants, every table after all the tables it
+        references (within that set). Tables on a reference cycle come last, by name."""
+        cached = self._orders.get(root)
+        if cached is not None:
+            return cached
+        nodes = self.descendants(root)
+        deps = {t: {m['Referenced_norm'] for m in self.parents.get(t, [])
+                    if m['Referenced_norm'] in nodes and m['Referenced_norm'] != t} for t in nodes}
+        deps[root] = set()   # the root always comes first
+        out = []
+        ready = sorted(t for t, d in deps.items() if not d)
+        while ready:
+            t = ready.pop(0); out.append(t)
+            for m in self.children.get(t, []):
+                c = m['Parent_norm']
+                if c in deps and t in deps[c]:
+                    deps[c].discard(t)
+                    if not deps[c] and c not in out and c not in ready: ready.append(c)
+        out += sorted(nodes.difference(out))
+        self._orders[root] = out
+        return out
+
+# ----- Key indexes -----
+# Both indexes follow a commit in place (remap, append) instead of being rebuilt:
+# a remap is one integer gather over the index, and appended rows go to a small
+# tail index that is folded into the main one once it holds a quarter as many rows.
+def _tail_full(base_rows, tail_rows):
+    return tail_rows > max(1024, base_rows // 4)
+
+
+class PrimaryKeyIndex:
+    """Row position of each PK value of a table; the first row wins when a key is
+    duplicated. Int64 PKs are indexed as numbers, others as CSV text. Deleted rows
+    stay in the index with position -1, so their keys needn't be hashed again.
+    """
+    def __init__(self, s, positions=None):
+        self.numeric = isinstance(s.dtype, pd.Int64Dtype)
+        keys = s.reset_index(drop=True)
+        keys = keys[keys.notna().to_numpy()] if self.numeric else text_values(keys)
+        first = ~keys.duplicated()
+        self.unique = bool(first.all())
+        keys = keys[first]
+        self.keys = pd.Index(keys.array)
+        at = keys.index.to_numpy()
+        self.pos = at.copy() if positions is None else np.asarray(positions)[at]
+        self.tail = None
+
+    def _query(self, keys):
+        if isinstance(keys, pd.Index): return keys
+        return pd.Index(int_keys(keys).array) if self.numeric else pd.Index(np.asarray(keys, dtype=object))
+
+    def get(self, keys):
+        """Row positions of the PK values `keys` (text); -1 where absent."""
+        query = self._query(keys)
+        at = self.keys.get_indexer(query)
+        pos = self.pos[at] if len(self.pos) else np.zeros(len(at), dtype=np.intp)
+        pos = np.where(at >= 0, pos, -1)
+        if self.tail is not None and (pos < 0).any():
+            miss = np.flatnonzero(pos < 0)
+            pos[miss] = self.tail.get(query[miss])
+        return pos
+
+    def remap(self, where):
+        """Follow the rows to their new positions, `where[p]` being the new position of
+        row p (-1 if it was deleted). False when the index can't follow: a deleted
+        key repeats in the table, so another row may now hold it."""
+        gone = self.pos < 0
+        pos = where[self.pos]
+        if not self.unique and (pos[~gone] < 0).any():
+            return False
+        pos[gone] = -1
+        self.pos = pos
+        return self.tail is None or self.tail.remap(where)
+
+    def append(self, s, positions):
+        """Index the rows `s` added at `positions`."""
+        new = PrimaryKeyIndex(s, positions)
+        if not new.unique: self.unique = False
+        at = self.keys.get_indexer(new.keys)
+        live = at >= 0
+        live[live] = self.pos[at[live]] >= 0
+        if live.any(): self.unique = False      # the older row keeps the key
+        back = (at >= 0) & ~live                # keys of deleted rows come back
+        self.pos[at[back]] = new.pos[back]
+        new.keys, new.pos = new.keys[at < 0], new.pos[at < 0]
+        if self.tail is not None:
+            old = self.tail.pos >= 0
+            keys = self.tail.keys[old].append(new.keys)
+            first = ~keys.duplicated()
+            if not first.all(): self.unique = False
+            new.keys, new.pos = keys[first], np.concatenate([self.tail.pos[old], new.pos])[first]
+        self.tail = new
+        if _tail_full(len(self.keys), len(new.keys)):
+            self.keys, self.pos = self.keys.append(new.keys), np.concatenate([self.pos, new.pos])
+            self.tail = None
+
+
+class ForeignKeyIndex:
+    """Row positions of a table grouped by the value of one column, so the rows that
+    reference a set of keys are found without scanning the column. Values compare
+    as in PrimaryKeyIndex: Int64 columns as numbers, others as CSV text ('' is no key).
+    """
+    def __init__(self, s, positions=None):
+        self.numeric = isinstance(s.dtype, pd.Int64Dtype)
+        if self.numeric:
+            codes, uniques = pd.factorize(s)
+        else:
+            vals = text_values(s).to_numpy()
+            vals[vals == ''] = None
+            codes, uniques = pd.factorize(vals)
+        self.keys = pd.Index(uniques)
+        self.order = np.argsort(codes, kind='stable')   # rows without a key (-1) come first
+        if positions is not None:
+            self.order = np.asarray(positions)[self.order]
+        self.counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self.starts = np.cumsum(self.counts) - self.counts + int((codes < 0).sum())
+        self.tail = None
+
+    def _query(self, keys):
+        if self.numeric:
+            k = keys if isinstance(getattr(keys, 'dtype', None), pd.Int64Dtype) else int_keys(keys)
+            return pd.Index(pd.Series(k).array)
+        return pd.Index(text_values(pd.Series(keys)).to_numpy())
+
+    def _groups(self):
+        # key number of each entry of self.order (-1 for rows without a key)
+        n_none = len(self.order) - int(self.counts.sum())
+        return np.repeat(np.arange(-1, len(self.keys)), np.concatenate([[n_none], self.counts]))
+
+    def contains(self, keys):
+        """Whether each of `keys` occurs in the column."""
+        query = self._query(keys)
+        at = self.keys.get_indexer(query)
+        found = at >= 0
+        found[found] = self.counts[at[found]] > 0   # keys whose rows were all deleted
+        if self.tail is not None:
+            found |= self.tail.contains(query)
+        return found
+
+    def _rows(self, query):
+        hit = self.keys.get_indexer(query)
+        hit = hit[hit >= 0]
+        lengths = self.counts[hit]
+        first = np.cumsum(lengths) - lengths
+        at = np.repeat(self.starts[hit] - first, lengths) + np.arange(int(lengths.sum()))
+        rows = self.order[at]
+        return rows if self.tail is None else np.concatenate([rows, self.tail._rows(query)])
+
+    def rows(self, keys):
+        """Ascending positions of the rows whose value is one of `keys`."""
+        return np.sort(self._rows(self._query(keys).unique()))
+
+    def remap(self, where):
+        """Follow the rows to their new positions, `where[p]` being the new position of
+        row p (-1 if it was deleted)."""
+        order, groups = where[self.order], self._groups()
+        alive = order >= 0
+        self.order, groups = order[alive], groups[alive]
+        self.counts = np.bincount(groups[groups >= 0], minlength=len(self.keys))
+        self.starts = np.cumsum(self.counts) - self.counts + int((groups < 0).sum())
+        if self.tail is not None: self.tail.remap(where)
+        return True
+
+    def _entries(self):
+        # (values, positions) of the rows that have a key
+        groups = self._groups()
+        keyed = groups >= 0
+        return pd.Series(self.keys.take(groups[keyed]).array), self.order[keyed]
+
+    def append(self, s, positions):
+        """Index the rows `s` added at `positions`."""
+        if self.tail is not None:
+            vals, pos = self.tail._entries()
+            s = pd.concat([vals, s.reset_index(drop=True)], ignore_index=True)
+            positions = np.concatenate([pos, positions])
+        self.tail = ForeignKeyIndex(s, positions)
+        if _tail_full(len(self.order), len(positions)):
+            vals, pos = self._entries()
+            tail = self.tail._entries()
+            self.__init__(pd.concat([vals, tail[0]], ignore_index=True), np.concatenate([pos, tail[1]]))
+
+
+class KeySet:
+    """Text keys collected across the chunks of an input, as a few disjoint unique
+    pd.Index parts, largest first: a membership test is a get_indexer against each
+    part's cached hash table. A chunk's new keys become a part, merged with the
+    parts no larger than it, so there are O(log n) parts and a key is rehashed
+    O(log n) times rather than with every chunk.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def __len__(self):
+        return sum(len(p) for p in self.parts)
+
+    def contains(self, keys):
+        """Boolean array: which of `keys` were added before."""
+        query = keys if isinstance(keys, pd.Index) else pd.Index(np.asarray(keys, dtype=object))
+        found = np.zeros(len(query), dtype=bool)
+        for part in self.parts:
+            found |= part.get_indexer(query) >= 0
+        return found
+
+    def add(self, keys):
+        """Add `keys`; returns contains(keys) as it was before."""
+        query = pd.Index(np.asarray(keys, dtype=object))
+        found = self.contains(query)
+        new = query[~found].unique()
+        while self.parts and len(self.parts[-1]) <= len(new):
+            new = self.parts.pop().append(new)
+        if len(new): self.parts.append(new)
+        return found
+
+# ----- Sharded tables -----
+SHARD_SUFFIX = '.shards'
+SHARD_MANIFEST = 'shards.json'
+
+
+class ShardLayout:
+    """A table stored as several CSVs partitioned by one key column.
+
+    <data folder>/<Table>.shards/ holds shards.json and part-NNNN.csv files, each a
+    complete CSV with the table's header. A row belongs to a shard by its key (by
+    default the table's FK to Device, or the PK of Device itself): 'hash' takes a
+    stable hash of the key text modulo the shard count, 'range' splits numeric keys
+    at `bounds` (shard i holds bounds[i-1] <= key < bounds[i]; blank and non-numeric
+    keys go to shard 0). DeviceSchema reads the shards as one frame in shard order,
+    and the bulk engine only replaces or appends to the shards holding changed rows.
+    """
+    def __init__(self, folder, column, scheme='hash', count=16, bounds=None):
+        if scheme not in ('hash', 'range'):
+            raise ValueError(f'Unknown shard scheme: {scheme}')
+        self.folder = folder
+        self.column = column
+        self.scheme = scheme
+        self.bounds = sorted(float(b) for b in bounds or [])
+        self.count = len(self.bounds) + 1 if scheme == 'range' else max(1, int(count))
+
+    @classmethod
+    def open(cls, folder):
+        with open(os.path.join(folder, SHARD_MANIFEST), 'r', encoding='utf-8') as f:
+            m = json.load(f)
+        return cls(folder, m['column'], m.get('scheme', 'hash'), m.get('count', 1), m.get('bounds'))
+
+    def manifest(self):
+        return {'version': 1, 'column': self.column, 'scheme': self.scheme, 'count': self.count, 'bounds': self.bounds}
+
+    def save(self, folder=None):
+        _write_json_atomic(self.manifest(), os.path.join(folder or self.folder, SHARD_MANIFEST))
+
+    def files(self, folder=None):
+        return [os.path.join(folder or self.folder, f'part-{i:04d}.csv') for i in range(self.count)]
+
+    def header(self):
+        for f in self.files():
+            cols = read_csv_header(f) if os.path.exists(f) else None
+            if cols: return cols
+        return [self.column]
+
+    def shard_of(self, keys):
+        """Shard number of each value of the key column `keys` (a Series)."""
+        if self.scheme == 'range':
+            if isinstance(keys.dtype, pd.Int64Dtype):
+                num = keys.to_numpy(dtype=float, na_value=np.nan)
+            else:
+                num = pd.to_numeric(text_values(keys), errors='coerce').to_numpy(dtype=float)
+            ids = np.searchsorted(np.asarray(self.bounds, dtype=float), num, side='right')
+            ids[np.isnan(num)] = 0
+        else:
+            # pandas' hash_array uses a fixed key, so shards are the same in every process
+            ids = pd.util.hash_array(text_values(keys).to_numpy()) % np.uint64(self.count)
+        return ids.astype(np.int32)
+
+    def read(self, usecols=None):
+        """(one frame of every shard in shard order, shard number of each of its rows)."""
+        header = self.header()
+
+        def part(f):
+            if os.path.exists(f):
+                return DeviceSchema._read_csv(f, usecols=usecols)
+            return pd.DataFrame(columns=[c for c in header if usecols is None or c in usecols], dtype=object)
+        files = self.files()
+        with ThreadPoolExecutor(max_workers=max(1, min(LOAD_THREADS, len(files)))) as pool:
+            parts = list(pool.map(METRICS.bind(part), files))
+        ids = np.repeat(np.arange(len(parts), dtype=np.int32), [len(p) for p in parts])
+        return pd.concat(parts, ignore_index=True), ids
+
+
+def shard_table(path, column, count=16, scheme='hash', bounds=None):
+    """Convert the table CSV at `path` into a shard folder next to it (<name>.shards)
+    and remove the CSV. Without `bounds`, 'range' splits at quantiles of the keys so
+    the `count` shards hold about as many rows each. The conversion holds the data
+    folder's lock and is published as one TableTransaction. Returns the ShardLayout."""
+    txn = TableTransaction(os.path.dirname(path) or '.')
+    txn.lock.acquire()
+    folder = os.path.splitext(path)[0] + SHARD_SUFFIX
+    created = not os.path.isdir(folder)
+    try:
+        df = DeviceSchema._read_csv(path)
+        if column not in df.columns:
+            raise ValueError(f'{os.path.basename(path)} has no column {column}')
+        if scheme == 'range' and bounds is None:
+            num = pd.to_numeric(df[column], errors='coerce').dropna().to_numpy(dtype=float)
+            bounds = sorted(set(np.quantile(num, np.arange(1, count) / count).tolist())) if len(num) else []
+        layout = ShardLayout(folder, column, scheme, count, bounds)
+        ids = layout.shard_of(df[column])
+        os.makedirs(folder, exist_ok=True)
+        files = layout.files()
+        for k, f in enumerate(files):
+            txn.rewrite(df[ids == k], f)
+        # the manifest makes the folder a table, so it goes after the shards
+        manifest = os.path.join(folder, SHARD_MANIFEST)
+        txn.rewrite_json(layout.manifest(), manifest)
+        for f in sorted(os.listdir(folder)):   # shards of an earlier layout
+            f = os.path.join(folder, f)
+            if f.endswith('.csv') and f not in files and not os.path.basename(f).startswith(STAGE_PREFIX):
+                txn.remove(f)
+        txn.remove(path)
+        txn.commit()
+    except BaseException:
+        txn.abort()
+        if created and os.path.isdir(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+        raise
+    return layout
+
+
+def unshard_table(folder):
+    """Convert a shard folder back into a single CSV next to it and remove the shards,
+    holding the data folder's lock and publishing through one TableTransaction.
+    Rows come out grouped by shard. Returns the CSV path."""
+    path = folder[:-len(SHARD_SUFFIX)] + '.csv'
+    txn = TableTransaction(os.path.dirname(os.path.abspath(folder)))
+    txn.lock.acquire()
+    try:
+        layout = ShardLayout.open(folder)
+        df, _ = layout.read()
+        txn.rewrite(df, path)
+        txn.remove(os.path.join(folder, SHARD_MANIFEST))   # first: without it the folder is no table
+        for f in layout.files():
+            if os.path.exists(f): txn.remove(f)
+        txn.commit()
+    except BaseException:
+        txn.abort()
+        raise
+    if not os.listdir(folder):
+        os.rmdir(folder)
+    return path
+
+# ----- Schema -----
+def _file_sig(path):
+    if os.path.isdir(path):
+        # a sharded table changes when any of its files does
+        mtime = size = 0
+        for e in os.scandir(path):
+            if e.name.endswith('.csv') or e.name == SHARD_MANIFEST:
+                st = e.stat(); mtime += st.st_mtime_ns; size += st.st_size
+        return (mtime, size)
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class SchemaLock:
+    """Readers-writer lock of a DeviceSchema. Any number of threads may read the tables
+    at once; refresh() and apply_changes() replace them under the write side. A waiting
+    writer holds back new readers so a stream of lookups can't starve a commit. Both
+    sides are re-entrant; taking the write side inside a read section is an error.
+    What readers build on demand (completed tables, indexes, shard numbers, column
+    statistics) is built under the schema's _building mutex, one thread at a time."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = None     # thread ident holding the write side
+        self._writer_depth = 0
+        self._waiting = 0       # writers waiting
+        self._local = threading.local()
+
+    def reading(self):
+        return getattr(self._local, 'reads', 0) > 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        if self._writer == me or self.reading():
+            self._local.reads = getattr(self._local, 'reads', 0) + 1
+            try:
+                yield
+            finally:
+                self._local.reads -= 1
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers: self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer != me and self.reading():
+            raise RuntimeError('cannot change the schema inside a read section')
+        with self._cond:
+            if self._writer != me:
+                self._waiting += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None; self._cond.notify_all()
+
+
+class LazyTables(dict):
+    """DeviceSchema.tables: table name -> (DataFrame, path).
+
+    Looking a table up completes it if it was loaded with a column projection;
+    DeviceSchema.peek() gives the projected frame without loading anything.
+    """
+    def __init__(self, schema):
+        super().__init__()
+        self._schema = schema
+
+    def __getitem__(self, norm):
+        if norm in self._schema._partial:
+            with self._schema._building:
+                if norm in self._schema._partial: self._schema._complete(norm)
+        return dict.__getitem__(self, norm)
+
+    def get(self, norm, default=None):
+        return self[norm] if norm in self else default
+
+    def items(self):
+        return [(k, self[k]) for k in list(self.keys())]
+
+    def values(self):
+        return [self[k] for k in list(self.keys())]
+
+
+class DeviceSchema:
+    def __init__(self, data_folder, relation_file, root_table="Device", cache_dir=None, columns=None, compact=False):
+        """`columns` limits what is parsed up front: None (everything), 'keys' (PK and
+        relation columns only), a dict table -> columns, or a callable(table, header)
+        returning the columns to load. PK and relation columns are always loaded;
+        the rest of a table is read the first time it is looked up in `tables`.
+        With `compact`, tables are held in compact dtypes (see compact_frame).
+        """
+        self.data_folder = data_folder
+        self.relation_file = relation_file
+        self.root_table = root_table
+        self.load_columns = columns
+        self.compact = compact
+        self.relations = None
+        self.graph = None
+        self.child_map = defaultdict(list)   # referenced table -> relations pointing at it
+        self.tables = LazyTables(self)
+        self.lock = SchemaLock()    # readers share it; refresh and apply_changes take it exclusively
+        self._building = threading.RLock()   # taken by readers to complete tables and build indexes on demand
+        self._csv_index = None
+        self._headers = {}          # norm -> full column list of the CSV
+        self._partial = set()       # tables loaded with a column projection
+        self._pk_indexes = {}
+        self._fk_indexes = {}       # (norm, column) -> ForeignKeyIndex
+        self._file_sigs = {}        # norm -> (mtime_ns, size) of the CSV as loaded/written
+        self._pk_seq = {}           # norm -> next numeric PK to hand out
+        self._pk_seq_stale = set()  # tables reloaded since their sequence was set
+        self._stats = {}            # norm -> TableStats (detected defaults, column summaries)
+        self._layouts = {}          # norm -> ShardLayout of a sharded table
+        self._encodings = {}        # norm -> encoding a plain table's CSV was read in
+        self._shard_ids = {}        # norm -> shard number of each row (rows are in shard order)
+        self._shard_repair = set()  # sharded tables with rows in the wrong shard file
+        self.cache = TableCache(cache_dir, compact) if cache_dir else None
+        self._load_relations()
+        if TableTransaction.recover(self.data_folder):
+            print(f"[WARN] Completed an interrupted bulk commit in {self.data_folder}.")
+        self._load_device_and_children()
+        METRICS.flush('load', data_folder=self.data_folder)
+
+    def _load_relations(self):
+        if not os.path.exists(self.relation_file):
+            raise FileNotFoundError("relations.csv not found")
+        rel = pd.read_csv(self.relation_file, dtype=str, keep_default_na=False)
+        expected = ["ForeignKeyName","ParentTable","ParentColumn","ReferencedTable","ReferencedColumn"]
+        colmap = {}
+        for e in expected:
+            for c in rel.columns:
+                if c.strip().lower() == e.lower():
+                    colmap[e] = c; break
+            else:
+                raise ValueError(f"relations.csv missing column: {e}")
+        rel = rel[[colmap[e] for e in expected]].copy(); rel.columns = expected
+        rel["Parent_norm"] = rel["ParentTable"].apply(normalize_table_name)
+        rel["Referenced_norm"] = rel["ReferencedTable"].apply(normalize_table_name)
+        self.relations = rel
+        self.graph = RelationGraph(rel)
+        self.child_map = self.graph.children
+
+    def pk_index(self, norm):
+        """PrimaryKeyIndex of a table. Built on first use after a load; apply_changes
+        keeps it current."""
+        idx = self._pk_indexes.get(norm)
+        if idx is None:
+            with self._building:
+                idx = self._pk_indexes.get(norm)
+                if idx is None:
+                    df, _ = self.peek(norm)
+                    idx = self._pk_indexes[norm] = PrimaryKeyIndex(df[df.columns[0]])
+        return idx
+
+    def fk_index(self, norm, column):
+        """ForeignKeyIndex over `column` of table `norm`. Like pk_index it is built on
+        first use and kept current by apply_changes."""
+        idx = self._fk_indexes.get((norm, column))
+        if idx is None:
+            with self._building:
+                idx = self._fk_indexes.get((norm, column))
+                if idx is None:
+                    idx = self._fk_indexes[(norm, column)] = ForeignKeyIndex(self.peek(norm)[0][column])
+        return idx
+
+    def _drop_indexes(self, norm):
+        self._pk_indexes.pop(norm, None)
+        for key in [k for k in self._fk_indexes if k[0] == norm]:
+            del self._fk_indexes[key]
+
+    def _update_indexes(self, norm, prev, df, delta):
+        """Carry a table's indexes over a change (apply_changes). An index is dropped,
+        to be rebuilt on next use, when its column was edited or changed dtype, or
+        `delta` doesn't tell where the rows went."""
+        rows = None if delta is None else delta.row_map(len(prev), len(df))
+        indexes = [(self._pk_indexes, norm, prev.columns[0])] if norm in self._pk_indexes else []
+        indexes += [(self._fk_indexes, key, key[1]) for key in self._fk_indexes if key[0] == norm]
+        for store, key, column in indexes:
+            idx = store.pop(key)
+            if rows is None or column not in df.columns or column in delta.updated \
+                    or df[column].dtype != prev[column].dtype or (store is self._pk_indexes and df.columns[0] != column):
+                continue
+            where, added = rows
+            if where is not None and not idx.remap(where):
+                continue
+            if len(added):
+                idx.append(df[column].iloc[added], added)
+            store[key] = idx
+
+    def get_device_bundles(self, pks):
+        """Root rows with the given PKs plus every row below them in the relation graph.
+
+        Returns dict table -> DataFrame (indexed by row position): the root table first,
+        then the others in graph order, empty where nothing matches. Rows are found
+        through pk_index and fk_index, so no table is scanned once its indexes exist.
+        Unknown PKs are ignored.
+        """
+        root = normalize_table_name(self.root_table)
+        keys = text_values(pd.Series(list(pks), dtype=object))
+        pos = self.lookup_rows(root, keys)
+        rows = self.bundle_rows(pd.unique(pos[pos >= 0]))
+        return {norm: self.tables[norm][0].iloc[r] for norm, (r, _) in rows.items()}
+
+    def bundle_rows(self, pos):
+        """Row positions below the root rows `pos`, as dict table -> (rows, owners) in
+        graph order, where owners[i] is the index into `pos` of the device that rows[i]
+        belongs to (through the first relation that reaches it). Rows are ascending;
+        the root maps to (pos, arange)."""
+        root = normalize_table_name(self.root_table)
+        pos = np.asarray(pos, dtype=np.intp)
+        out = {root: (pos, np.arange(len(pos)))}
+        for norm in self.graph.order(root)[1:]:
+            if norm not in self.tables: continue
+            df = self.peek(norm)[0]
+            rows, owners = [], []
+            for m in self.graph.parents.get(norm, []):
+                parent = out.get(m['Referenced_norm'])
+                if parent is None or not len(parent[0]) or m['ParentColumn'] not in df.columns: continue
+                pdf = self.peek(m['Referenced_norm'])[0]
+                ref = m['ReferencedColumn'] if m['ReferencedColumn'] in pdf.columns else pdf.columns[0]
+                idx = self.fk_index(norm, m['ParentColumn'])
+                keys = idx._query(pdf[ref].iloc[parent[0]])
+                first = ~keys.duplicated()
+                hit = idx.rows(keys[first])
+                at = keys[first].get_indexer(idx._query(df[m['ParentColumn']].iloc[hit]))
+                rows.append(hit); owners.append(parent[1][first][at])
+            if rows:
+                r, o = np.concatenate(rows), np.concatenate(owners)
+                r, first = np.unique(r, return_index=True)
+                out[norm] = (r, o[first])
+            else:
+                out[norm] = (np.array([], dtype=np.intp), np.array([], dtype=np.intp))
+        return out
+
+    def get_device_bundle(self, pk):
+        """get_device_bundles() of one device; None if there is no such device."""
+        bundle = self.get_device_bundles([pk])
+        return bundle if len(bundle[normalize_table_name(self.root_table)]) else None
+
+    def lookup_rows(self, norm, keys):
+        """Row positions of the given PK values (text) in table `norm`; -1 where absent."""
+        return self.pk_index(norm).get(keys)
+
+    def _scan_folder(self):
+        # one directory listing per load: normalized table name -> CSV path (or shard folder)
+        index, sharded = {}, {}
+        for f in sorted(os.listdir(self.data_folder)):
+            path = os.path.join(self.data_folder, f)
+            if f.lower().endswith('.csv'):
+                base = os.path.splitext(f)[0]
+                index.setdefault(normalize_table_name(base).lower(), path)
+            elif f.endswith(SHARD_SUFFIX) and os.path.exists(os.path.join(path, SHARD_MANIFEST)):
+                sharded.setdefault(normalize_table_name(f[:-len(SHARD_SUFFIX)]).lower(), path)
+        for key, path in sharded.items():
+            if key in index:
+                print(f"[WARN] Both {os.path.basename(index[key])} and {os.path.basename(path)} exist; "
+                      f"using the shards (run the shard command again to import the CSV).")
+            index[key] = path
+        self._csv_index = index
+        return index
+
+    def _find_csv_for_norm(self, norm):
+        index = self._csv_index if self._csv_index is not None else self._scan_folder()
+        return index.get(norm.lower())
+
+    def get_table_path(self, norm):
+        return dict.get(self.tables, norm, (None, None))[1]
+
+    def shard_layout(self, norm):
+        """ShardLayout of a sharded table, None for a plain CSV."""
+        return self._layouts.get(norm)
+
+    def shard_ids(self, norm):
+        """Shard number of each row of a sharded table, as it is held in memory."""
+        ids = self._shard_ids.get(norm)
+        if ids is None:
+            with self._building:
+                ids = self._shard_ids.get(norm)
+                if ids is None:
+                    layout = self._layouts[norm]
+                    ids = self._shard_ids[norm] = layout.shard_of(self.peek(norm)[0][layout.column])
+        return ids
+
+    def needs_shard_repair(self, norm):
+        return norm in self._shard_repair
+
+    def default_shard_column(self, norm):
+        """The column a table is sharded by unless told otherwise: its FK to the root
+        table (the PK for the root itself), else its first FK, else its PK."""
+        root = normalize_table_name(self.root_table)
+        if norm != root:
+            rels = self.graph.parents.get(norm, [])
+            for m in rels:
+                if m['Referenced_norm'] == root:
+                    return m['ParentColumn']
+            if rels:
+                return rels[0]['ParentColumn']
+        return self.columns(norm)[0]
+
+    def peek(self, norm):
+        """(DataFrame, path) as loaded, without completing a column projection."""
+        return dict.__getitem__(self.tables, norm)
+
+    def columns(self, norm):
+        """All column names of a table, including ones not loaded yet."""
+        cols = self._headers.get(norm)
+        return cols if cols is not None else list(self.peek(norm)[0].columns)
+
+    def is_partial(self, norm):
+        return norm in self._partial
+
+    def key_columns(self, norm, header=None):
+        """PK plus every column that takes part in a relation, for table `norm`."""
+        header = self.columns(norm) if header is None else header
+        cols = header[:1]
+        rel = self.relations
+        cols += rel.loc[rel['Parent_norm'] == norm, 'ParentColumn'].tolist()
+        cols += rel.loc[rel['Referenced_norm'] == norm, 'ReferencedColumn'].tolist()
+        return list(dict.fromkeys(cols))
+
+    def _projection(self, norm, header):
+        # columns to read up front for `norm`, or None for all of them
+        spec = self.load_columns
+        if spec is None:
+            return None
+        if spec == 'keys':
+            wanted = []
+        elif callable(spec):
+            wanted = spec(norm, header)
+        else:
+            wanted = spec.get(norm)
+        if wanted is None:
+            return None
+        wanted = set(wanted) | set(self.key_columns(norm, header))
+        if norm in self._layouts:
+            wanted.add(self._layouts[norm].column)
+        cols = [c for c in header if c in wanted]
+        return None if len(cols) == len(header) else cols
+
+    @staticmethod
+    def _read_csv(path, usecols=None):
+        if os.path.isdir(path):
+            return ShardLayout.open(path).read(usecols)[0]
+        return DeviceSchema._read_csv_encoded(path, usecols)[0]
+
+    @staticmethod
+    def _read_csv_encoded(path, usecols=None, nrows=None):
+        """(frame, encoding) of a CSV: read as UTF-8, or in CSV_FALLBACK_ENCODING when
+        it isn't valid UTF-8 (bytes undefined there become U+FFFD)."""
+        try:
+            df = pd.read_csv(path, dtype=object, keep_default_na=False, usecols=usecols, nrows=nrows)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = CSV_FALLBACK_ENCODING
+            df = pd.read_csv(path, dtype=object, encoding=encoding, encoding_errors='replace', keep_default_na=False,
+                             usecols=usecols, nrows=nrows)
+        df.columns = [str(c) for c in df.columns]
+        return df.reset_index(drop=True), encoding
+
+    def table_encoding(self, norm):
+        """Encoding the CSV of a plain table was read in ('utf-8' unless it didn't decode)."""
+        return self._encodings.get(norm, 'utf-8')
+
+    def _read_table(self, norm, path):
+        # runs on a loader thread: returns (frame, header, projected?, shard ids or None)
+        layout = ShardLayout.open(path) if os.path.isdir(path) else None
+        if layout is not None:
+            self._layouts[norm] = layout
+            header = layout.header()
+        else:
+            self._layouts.pop(norm, None)
+            header = list(self._read_csv_encoded(path, nrows=0)[0].columns)
+        if self.cache:
+            with METRICS.phase('cache_load', norm) as p:
+                cached = self.cache.load(norm, path)
+                if p and cached is not None: p.rows = len(cached[0])
+            if cached is not None:
+                self._encodings[norm] = cached[1]
+                return cached[0], header, False, None
+        cols = self._projection(norm, header)
+        ids = None
+        with METRICS.phase('read_csv', norm) as p:
+            if layout is None:
+                df, self._encodings[norm] = self._read_csv_encoded(path, usecols=cols)
+            else:
+                df, ids = layout.read(cols)
+            if p: p.rows, p.bytes = len(df), _file_sig(path)[1]
+        misplaced = False
+        if ids is not None:
+            hashed = layout.shard_of(df[layout.column])
+            misplaced = bool((hashed != ids).any())
+            if misplaced:
+                print(f"[WARN] {norm}: some rows are in the wrong shard file; all its shards are rewritten on the next change.")
+            ids = hashed
+        df = self._compacted(norm, df, header)
+        if cols is None and self.cache and not misplaced:
+            with METRICS.phase('cache_store', norm, len(df)):
+                self.cache.store(norm, path, df, self.table_encoding(norm))
+        return df, header, cols is not None, (ids, misplaced) if layout is not None else None
+
+    def _load_device_and_children(self, changed_only=False):
+        # the root table and everything below it, at any depth
+        needed = self.graph.order(normalize_table_name(self.root_table))
+        self._scan_folder()
+        todo = []
+        for norm in needed:
+            path = self._find_csv_for_norm(norm)
+            if not path:
+                print(f"[WARN] CSV for {norm} not found in {self.data_folder}; skipping.")
+                continue
+            if changed_only and norm in self.tables and self._file_sigs.get(norm) == _file_sig(path):
+                continue
+            todo.append((norm, path))
+        if not todo:
+            return []
+        # pandas' C parser releases the GIL, so tables load side by side
+        with METRICS.phase('load_tables'), \
+             ThreadPoolExecutor(max_workers=max(1, min(LOAD_THREADS, len(todo)))) as pool:
+            loaded = list(pool.map(METRICS.bind(lambda t: self._read_table(*t)), todo))
+        for (norm, path), (df, header, partial, shards) in zip(todo, loaded):
+            self._headers[norm] = header
+            self._set_table(norm, df, path, partial)
+            if shards is not None:
+                ids, misplaced = shards
+                if ids is not None: self._shard_ids[norm] = ids
+                if misplaced: self._shard_repair.add(norm)
+        return [norm for norm, _ in todo]
+
+    def _compacted(self, norm, df, header=None, columns=None):
+        if not self.compact or columns == []:
+            return df
+        with METRICS.phase('compact', norm, len(df)):
+            return compact_frame(df, self.key_columns(norm, header), columns)
+
+    def _complete(self, norm):
+        """Read the columns a projected table was loaded without."""
+        df, path = self.peek(norm)
+        header = self._headers[norm]
+        rest = None
+        with METRICS.phase('complete_table', norm, len(df)):
+            if self._file_sigs.get(norm) == _file_sig(path):
+                rest = self._read_csv(path, usecols=[c for c in header if c not in df.columns])
+            if rest is not None and len(rest) == len(df):
+                full = pd.concat([df, rest], axis=1)[header]
+            elif os.path.isdir(path):
+                full = self._read_csv(path)   # file changed underneath: take it as it is now
+            else:
+                full, self._encodings[norm] = self._read_csv_encoded(path)
+        full = self._compacted(norm, full, header)
+        ids = self._shard_ids.get(norm) if rest is not None and len(rest) == len(df) else None
+        repair = norm in self._shard_repair
+        self._partial.discard(norm)
+        self._set_table(norm, full, path)
+        if ids is not None: self._shard_ids[norm] = ids
+        if repair: self._shard_repair.add(norm)
+        if self.cache: self.cache.store_later(norm, path, full, self.table_encoding(norm))
+
+    def _set_table(self, norm, df, path, partial=False):
+        dict.__setitem__(self.tables, norm, (df, path))
+        if partial: self._partial.add(norm)
+        else: self._partial.discard(norm)
+        self._file_sigs[norm] = _file_sig(path)
+        self._drop_indexes(norm)
+        self._shard_ids.pop(norm, None)
+        self._shard_repair.discard(norm)
+        self._stats.pop(norm, None)
+        if norm in self._pk_seq: self._pk_seq_stale.add(norm)
+
+    def refresh(self, changed_only=True):
+        """Re-read table CSVs from disk; returns the names of the tables reloaded.
+
+        With changed_only, a file is only re-read when its mtime or size differs
+        from when it was last loaded or written through apply_changes(). Inside a
+        read section of self.lock nothing is reloaded (that would deadlock); the
+        next refresh picks the files up.
+        """
+        if self.lock.reading():
+            return []
+        with self.lock.write():
+            return self._load_device_and_children(changed_only=changed_only)
+
+    def apply_changes(self, frames, deltas=None, shard_ids=None, written=True):
+        """Install frames the caller has just written to disk as the in-memory tables,
+        so they need not be re-read. `frames` maps table name -> DataFrame; `deltas`
+        (table name -> TableDelta) lets the column statistics be updated in place.
+        For sharded tables `shard_ids` gives the shard of each row (the frames being
+        in shard order, like the files).
+
+        With written=False the frames are not on disk yet (a batch in progress): the
+        tables are marked stale, so the next refresh() reloads them from their files
+        unless mark_written() is called first."""
+        deltas = deltas or {}
+        with self.lock.write(), METRICS.phase('apply_changes'):
+            self._apply_changes(frames, deltas, shard_ids or {}, written)
+
+    def mark_written(self, norms):
+        """The in-memory tables `norms` are now what their files hold (see apply_changes)."""
+        with self.lock.write():
+            for norm in norms:
+                df, path = self.peek(norm)
+                self._file_written(norm, path)
+                if self.cache and not self.is_partial(norm):
+                    self.cache.store_later(norm, path, df, self.table_encoding(norm))
+
+    def _file_written(self, norm, path):
+        self._file_sigs[norm] = _file_sig(path)
+        if norm in self._encodings:
+            self._encodings[norm] = file_encoding(path, self._encodings[norm])   # a rewrite leaves UTF-8
+
+    def _apply_changes(self, frames, deltas, shard_ids, written=True):
+        for norm, df in frames.items():
+            path = self.get_table_path(norm)
+            prev = self.peek(norm)[0]
+            if self.compact:
+                # recompact only columns an edit turned back into text (not ones that never were compact)
+                redo = [c for c in df.columns if df[c].dtype == object and c in prev.columns and prev[c].dtype != object]
+                df = self._compacted(norm, df, columns=redo)
+            df = df.reset_index(drop=True)
+            partial = len(df.columns) < len(self.columns(norm))
+            dict.__setitem__(self.tables, norm, (df, path))
+            if not partial: self._partial.discard(norm)
+            self._file_sigs[norm] = None
+            if written: self._file_written(norm, path)
+            self._update_indexes(norm, prev, df, deltas.get(norm))
+            if norm in shard_ids:
+                self._shard_ids[norm] = shard_ids[norm]
+                self._shard_repair.discard(norm)
+            else:
+                self._shard_ids.pop(norm, None)
+            stats = self._stats.get(norm)
+            if stats is not None and norm in deltas and not partial:
+                deltas[norm].apply_to(stats, len(df))
+            else:
+                self._stats.pop(norm, None)
+            if self.cache and not partial and written:
+                self.cache.store_later(norm, path, df, self.table_encoding(norm))
+                if stats is not None and norm in self._stats:
+                    self.cache.store_defaults(norm, path, stats.defaults(df))
+
+    def table_stats(self, norm):
+        """TableStats for a table, seeded from the cache when it is fresh."""
+        stats = self._stats.get(norm)
+        if stats is None:
+            with self._building:
+                stats = self._stats.get(norm)
+                if stats is None:
+                    cached = self.cache.load_defaults(norm, self.get_table_path(norm)) if self.cache else None
+                    stats = self._stats[norm] = TableStats(cached)
+        return stats
+
+    def table_defaults(self, norm):
+        df, path = self.tables[norm]
+        stats = self.table_stats(norm)
+        fresh = not stats.computed
+        with METRICS.phase('detect_defaults', norm, len(df)):
+            out = stats.defaults(df)
+        if fresh and self.cache: self.cache.store_defaults(norm, path, out)
+        return out
+
+    def column_kind(self, norm, col):
+        """'integer', 'number' or None (text) as inferred from a column's values."""
+        df = self.peek(norm)[0]
+        if col not in df.columns: df = self.tables[norm][0]
+        return self.table_stats(norm).kind(df, col)
+
+    def column_summary(self, norm, col):
+        """Distinct count, most common value and detected default of one column."""
+        return self.table_stats(norm).summary(self.tables[norm][0], col)
+
+    def detect_defaults(self):
+        return {norm: self.table_defaults(norm) for norm in list(self.tables.keys())}
+
+    def compute_next_numeric_pk(self, norm):
+        if norm not in self.tables: return None
+        df, _ = self.peek(norm)
+        if df.shape[1] == 0: return None
+        pk = df.columns[0]
+        try:
+            nums = pd.to_numeric(df[pk], errors='coerce')
+            if nums.dropna().empty: return None
+            return int(nums.max()) + 1
+        except:
+            return None
+
+    def _pk_seq_start(self, norm):
+        nxt = self._pk_seq.get(norm)
+        if nxt is None or norm in self._pk_seq_stale:
+            found = self.compute_next_numeric_pk(norm)
+            if found is None:
+                df, _ = self.peek(norm)
+                # an empty table starts at 1; a non-numeric key can't be sequenced
+                found = None if text_values(df[df.columns[0]]).ne('').any() else 1
+            if found is not None:
+                nxt = found if nxt is None else max(nxt, found)
+            self._pk_seq_stale.discard(norm)
+        return nxt
+
+    def allocate_pks(self, norm, count):
+        """Hand out `count` consecutive numeric PKs (as text) for table `norm`.
+
+        The table is scanned once per load via compute_next_numeric_pk; later
+        calls continue from the last allocation, so keys stay unique across
+        inserts in one session. Returns None when the table's PK isn't numeric.
+        """
+        nxt = self._pk_seq_start(norm)
+        if nxt is None:
+            return None
+        self._pk_seq[norm] = nxt + count
+        return pd.Series(np.arange(nxt, nxt + count)).astype(str).to_numpy(dtype=object)
+
+    def pk_state(self):
+        """Snapshot of the PK sequences, for restore_pk_state() after a dry run."""
+        return dict(self._pk_seq)
+
+    def restore_pk_state(self, state):
+        self._pk_seq = dict(state)
+
+    def reserve_pks(self, norm, values):
+        """Advance the sequence of `norm` past explicitly supplied PK values."""
+        top = pd.to_numeric(pd.Series(values), errors='coerce').max()
+        nxt = self._pk_seq_start(norm)
+        if pd.notna(top) and nxt is not None:
+            self._pk_seq[norm] = max(nxt, int(top) + 1)
+
+# ----- Headless bulk engine -----
+BULK_OPS = ('insert', 'update', 'upsert', 'delete')
+
+class BulkError(Exception):
+    """Raised by BulkEngine when an operation cannot be carried out."""
+
+
+class BulkCancelled(BulkError):
+    """The operation was cancelled before anything was written."""
+
+
+class ValidationError(BulkError):
+    """The input failed pre-flight validation; nothing was written. `report` is the
+    ValidationReport listing every problem."""
+    def __init__(self, report):
+        super().__init__(report.summary())
+        self.report = report
+
+
+@dataclass
+class BulkResult:
+    """Outcome of a bulk operation; what the UI shows and the CLI prints."""
+    op: str
+    rows: int = 0
+    devices: int = 0
+    inserted: int = 0       # devices added (insert/upsert)
+    updated: int = 0        # existing devices changed (update/upsert)
+    child_rows: dict = field(default_factory=dict)
+    tables_written: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+    dry_run: bool = False
+    changes: dict = field(default_factory=dict)   # table -> ChangePlan.counts() entry
+    plan: object = field(default=None, repr=False)  # ChangePlan of a dry run
+    files: list = field(default_factory=list)      # export: the files written
+    entries: list = field(default_factory=list)    # batch: per-file outcome (file, op, status, rows, devices, detail)
+
+    def warn(self, msg):
+        if msg not in self.warnings:
+            self.warnings.append(msg)
+
+    def summary(self):
+        verb = {'insert': 'Inserted', 'update': 'Updated', 'upsert': 'Upserted', 'delete': 'Deleted'}.get(self.op, self.op)
+        s = f'{verb} {self.devices} devices.'
+        if self.op == 'upsert':
+            s = f'{verb} {self.devices} devices ({self.inserted} inserted, {self.updated} updated).'
+        if self.child_rows:
+            s += ' Child tables: ' + ', '.join(f'{t} ({n})' for t, n in self.child_rows.items())
+        if self.op == 'apply':
+            s = 'Applied plan.'
+        if self.op == 'batch':
+            n = {st: sum(e['status'] == st for e in self.entries) for st in ('done', 'failed', 'skipped')}
+            s = (f"Batch: {n['done']} files applied ({self.rows} rows), {n['failed']} failed, "
+                 f"{n['skipped']} already done; {len(self.tables_written)} files written.")
+            s += ''.join(f"\n  {os.path.basename(e['file'])} [{e['op']}] {e['status']}: {e['detail']}" for e in self.entries)
+        if self.op == 'export':
+            s = f'Exported {self.devices} devices ({self.rows} rows) to {", ".join(map(os.path.basename, self.files))}.'
+            if self.child_rows:
+                s += ' Child tables: ' + ', '.join(f'{t} ({n})' for t, n in self.child_rows.items())
+        if self.changes:
+            s += ' Changes: ' + '; '.join(f"{t}: {c['insert']} inserted, {c['update']} cells updated, {c['delete']} deleted"
+                                          for t, c in self.changes.items())
+        return ('Dry run, nothing written. ' + s) if self.dry_run else s
+
+    def to_dict(self):
+        d = asdict(replace(self, plan=None))
+        del d['plan']
+        return d
+
+
+def load_json_file(path, default=None):
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {} if default is None else default
+
+
+def _excel_header(values):
+    # same names pd.read_excel would give: blanks become "Unnamed: i", repeats get ".1", ".2"...
+    seen, out = {}, []
+    for i, v in enumerate(values):
+        name = f'Unnamed: {i}' if v is None or str(v).strip() == '' else str(v)
+        if name in seen:
+            seen[name] += 1; name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        out.append(name)
+    return out
+
+
+def iter_excel_chunks(path, chunk_rows=EXCEL_CHUNK_ROWS):
+    """Yield the first sheet of an Excel file as object-dtype DataFrames of at most
+    `chunk_rows` rows each, without loading the whole workbook.
+
+    .xlsx files are streamed with openpyxl in read-only mode; .csv files (as
+    written by an export) are read in chunks, empty cells being empty as in Excel;
+    other formats fall back to pd.read_excel and are sliced. Fully empty rows are
+    skipped; the index of each chunk is the sheet row number, so problems can be
+    reported by row. Read failures are raised as BulkError.
+    """
+    if path.lower().endswith('.csv'):
+        try:
+            reader = pd.read_csv(path, dtype=object, keep_default_na=False, na_values=[''], encoding='utf-8-sig',
+                                 chunksize=chunk_rows)
+            empty = True
+            for df in reader:
+                df = df.dropna(how='all')
+                df.index = df.index + 2
+                empty = False
+                yield df.astype(object)
+            if empty:
+                yield pd.read_csv(path, dtype=object, nrows=0, encoding='utf-8-sig')
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            raise BulkError(f'Failed to read CSV: {e}') from e
+        return
+    if not path.lower().endswith(('.xlsx', '.xlsm')):
+        try:
+            df = pd.read_excel(path, dtype=object)
+        except Exception as e:
+            raise BulkError(f'Failed to read Excel: {e}') from e
+        df = df.dropna(how='all')
+        df.index = df.index + 2   # the header is sheet row 1
+        for start in range(0, max(len(df), 1), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+    try:
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    except Exception as e:
+        raise BulkError(f'Failed to read Excel: {e}') from e
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = _excel_header(next(rows, ()))
+        width = len(header)
+        buf, nums = [], []
+        try:
+            for num, r in enumerate(rows, 2):
+                if all(v is None or v == '' for v in r):
+                    continue
+                r = tuple(r[:width]) + (None,) * (width - len(r))
+                buf.append(r); nums.append(num)
+                if len(buf) >= chunk_rows:
+                    yield pd.DataFrame(buf, columns=header, index=nums, dtype=object); buf, nums = [], []
+        except BulkError:
+            raise
+        except Exception as e:
+            raise BulkError(f'Failed to read Excel: {e}') from e
+        if buf or not width:
+            yield pd.DataFrame(buf, columns=header, index=nums, dtype=object)
+    finally:
+        wb.close()
+
+
+def excel_row_count(path):
+    """Data rows in the first sheet as recorded in the workbook, or None if unknown."""
+    if not path.lower().endswith(('.xlsx', '.xlsm')):
+        return None
+    try:
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True)
+        try:
+            n = wb.worksheets[0].max_row
+        finally:
+            wb.close()
+        return max(n - 1, 0) if n else None
+    except Exception:
+        return None
+
+
+@dataclass
+class ExportSpec:
+    """What BulkEngine.export writes: every device, or those with the given keys,
+    narrowed by filters on Device columns (all must match)."""
+    path: str                    # .xlsx, or .csv
+    keys: list = None            # Device PKs; None for every device
+    filters: list = field(default_factory=list)   # (column, text, exact) as in the data browser
+    tables: list = None          # tables below Device to include; None for all
+    columns: object = None       # table -> columns to write, or callable(norm, header) -> them; None for all (PKs always are)
+
+
+BATCH_INPUTS = ('.xlsx', '.xlsm', '.xls', '.csv')
+BATCH_LOG_COLUMNS = ['file', 'op', 'status', 'rows', 'devices', 'detail', 'size', 'mtime_ns']
+
+
+def batch_entries(source):
+    """[(path, op)] of a batch, in order. `source` is either a folder, whose input
+    files are taken in name order and tagged by a word in their name
+    (20240412_update.xlsx, delete-old.csv), or a manifest: a CSV with columns file
+    and op, or a JSON list of {"file": ..., "op": ...}, paths relative to it."""
+    if os.path.isdir(source):
+        names = sorted(f for f in os.listdir(source)
+                       if f.lower().endswith(BATCH_INPUTS) and not f.startswith(('.', '~$')))
+        entries, untagged = [], []
+        for name in names:
+            tags = [t.lower() for t in re.findall(r'(?i)(?<![a-z])(insert|update|upsert|delete)(?![a-z])', name)]
+            if len(set(tags)) == 1:
+                entries.append((os.path.join(source, name), tags[0]))
+            else:
+                untagged.append(name)
+        if untagged:
+            raise BulkError('No single operation (insert/update/upsert/delete) in the name of: ' + ', '.join(untagged))
+        return entries
+    folder = os.path.dirname(os.path.abspath(source))
+    if source.lower().endswith('.json'):
+        items = load_json_file(source)
+        if not isinstance(items, list):
+            raise BulkError(f'{os.path.basename(source)}: expected a list of {{"file", "op"}} entries.')
+    else:
+        df = DeviceSchema._read_csv(source)
+        cols = {c.strip().lower(): c for c in df.columns}
+        if 'file' not in cols or 'op' not in cols:
+            raise BulkError(f'{os.path.basename(source)}: a batch manifest needs the columns file and op.')
+        items = [{'file': f, 'op': o} for f, o in zip(df[cols['file']], df[cols['op']])]
+    entries = []
+    for i, item in enumerate(items, 1):
+        path, op = str(item.get('file') or '').strip(), str(item.get('op') or '').strip().lower()
+        if not path or op not in BULK_OPS:
+            raise BulkError(f'{os.path.basename(source)}, entry {i}: need a file and one of {", ".join(BULK_OPS)}.')
+        entries.append((os.path.join(folder, path), op))
+    return entries
+
+
+@dataclass
+class BatchSpec:
+    """A batch for BulkEngine.run_batch: a folder or manifest of input files (batch_entries)."""
+    source: str
+    checkpoint: str = None       # default: .whatsup_batch.csv in the folder, <manifest>.checkpoint.csv
+    keep_going: bool = False     # skip a file that fails instead of stopping the batch there
+    commit_every: int = BATCH_COMMIT_FILES
+
+    def checkpoint_path(self):
+        if self.checkpoint:
+            return self.checkpoint
+        if os.path.isdir(self.source):
+            return os.path.join(self.source, '.whatsup_batch.csv')
+        return os.path.splitext(self.source)[0] + '.checkpoint.csv'
+
+
+class ChunkPrefetcher:
+    """Parses the input files of a batch on a worker thread, in order, at most `depth`
+    chunks ahead of the consumer: reading overlaps staging, and no file is held in
+    memory whole. chunks(i) yields the chunks of the i-th file (raising its read
+    error), skipping whatever is left of the files before it."""
+    def __init__(self, paths, depth=BATCH_PREFETCH_CHUNKS):
+        self._queue = queue.Queue(max(1, depth))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=METRICS.bind(self._read), args=(list(paths),), name='batch-read',
+                                        daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self, paths):
+        for i, path in enumerate(paths):
+            try:
+                for chunk in iter_excel_chunks(path):
+                    if not self._put((i, chunk, None)): return
+            except Exception as e:
+                if not self._put((i, None, e)): return
+                continue
+            if not self._put((i, None, None)): return   # end of file i
+
+    def chunks(self, i):
+        while True:
+            j, chunk, error = self._queue.get()
+            if j < i:
+                continue
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class BatchWrites:
+    """Stands in for a TableTransaction while a batch folds each file's changes into
+    memory: it only notes which files will need writing, and whether appending the
+    new rows will do, so that every file is written once when the batch commits."""
+    def __init__(self):
+        self.modes = {}   # path -> 'append' | 'rewrite'
+
+    def rewrite(self, df, path):
+        self.modes[path] = 'rewrite'
+
+    def filter_rows(self, path, keep, encoding=None):
+        self.modes[path] = 'rewrite'
+
+    def append(self, df, path, columns, encoding=None):
+        if read_csv_header(path, file_encoding(path, encoding)) != [str(c) for c in columns]:
+            return False
+        self.modes.setdefault(path, 'append')
+        return True
+
+
+class ExportWriter:
+    """Streams export lines to a .csv file, or to .xlsx in openpyxl write-only mode,
+    continuing in name-2.xlsx, name-3.xlsx, ... when a sheet is full. Files are written
+    under temporary names and only put in place by close(); abort() removes them."""
+    def __init__(self, path, header):
+        self.path, self.header = path, list(header)
+        self.excel = path.lower().endswith(('.xlsx', '.xlsm'))
+        if not self.excel and not path.lower().endswith('.csv'):
+            raise BulkError(f'Export to an .xlsx or .csv file, not {os.path.basename(path)}.')
+        self.files = []   # (temporary path, final path)
+        self._wb = self._f = None
+        self._open()
+
+    def _open(self):
+        final = self.path
+        if self.files:
+            stem, ext = os.path.splitext(self.path)
+            final = f'{stem}-{len(self.files) + 1}{ext}'
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(final)), prefix='.tmp_export_',
+                                   suffix=os.path.splitext(final)[1])
+        os.close(fd)
+        self.files.append((tmp, final))
+        if self.excel:
+            import openpyxl
+            self._wb = openpyxl.Workbook(write_only=True)
+            self._ws = self._wb.create_sheet('Devices')
+            self._ws.append(self.header)
+            self._left = EXCEL_MAX_ROWS - 1
+        else:
+            self._f = open(tmp, 'w', encoding='utf-8-sig', newline='')
+            self._csv = csv.writer(self._f)
+            self._csv.writerow(self.header)
+
+    def _finish(self):
+        if self._wb is not None:
+            self._wb.save(self.files[-1][0]); self._wb = None
+        if self._f is not None:
+            self._f.close(); self._f = None
+
+    def write(self, cols, breaks):
+        """Append lines given as one object array per header column (None is an empty
+        cell). `breaks` are the lines where a device starts; a full sheet is only
+        continued in the next file at one of them."""
+        n = len(cols[0]) if cols else 0
+        if not self.excel:
+            self._csv.writerows(zip(*cols)); return
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils.exceptions import IllegalCharacterError
+        cols = list(cols)
+        for i, v in enumerate(cols):
+            # text starting with '=' would be written as a formula
+            eq = np.flatnonzero(pd.Series(v, dtype=object).str.startswith('=', na=False).to_numpy(dtype=bool))
+            if len(eq):
+                v = cols[i] = v.copy()
+                for j in eq:
+                    cell = WriteOnlyCell(self._ws, value=v[j]); cell.data_type = 's'; v[j] = cell
+        start = 0
+        try:
+            while start < n:
+                end = n
+                if n - start > self._left:
+                    fit = breaks[(breaks > start) & (breaks <= start + self._left)]
+                    end = int(fit[-1]) if len(fit) else start + self._left
+                for row in zip(*(c[start:end] for c in cols)):
+                    self._ws.append(row)
+                self._left -= end - start
+                start = end
+                if start < n:
+                    self._finish(); self._open()
+        except IllegalCharacterError as e:
+            raise BulkError(f'A value holds characters Excel cannot store; export to CSV instead. ({e})') from e
+
+    def close(self):
+        """Put the finished files in place; returns their paths."""
+        self._finish()
+        for tmp, final in self.files:
+            os.replace(tmp, final)
+        return [final for _, final in self.files]
+
+    def abort(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+        for tmp, _ in self.files:
+            if os.path.exists(tmp): os.remove(tmp)
+
+
+class BulkJob:
+    """Runs BulkEngine.run on a worker thread and reports through a queue.
+
+    Events are ('progress', (rows, chunks)) -- throttled to PROGRESS_INTERVAL so
+    the consumer isn't flooded -- and one final ('done', BulkResult),
+    ('cancelled', None) or ('error', exception).
+    """
+    def __init__(self, engine, op, chunks, dry_run=False):
+        """`op` is one of BULK_OPS, 'apply' with a ChangePlan in place of `chunks`,
+        'export' with an ExportSpec, or 'batch' with a BatchSpec."""
+        self.engine, self.op, self.chunks, self.dry_run = engine, op, chunks, dry_run
+        self.events = queue.Queue()
+        self._cancel = threading.Event()
+        self._last = 0.0
+        self.thread = threading.Thread(target=self._work, name=f'bulk-{op}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def drain(self):
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def _progress(self, rows, chunks):
+        now = time.monotonic()
+        if now - self._last >= PROGRESS_INTERVAL:
+            self._last = now
+            self.events.put(('progress', (rows, chunks)))
+
+    def _work(self):
+        try:
+            if self.op == 'apply':
+                result = profiled(PROFILE_FILE, self.engine.apply_plan, self.chunks, cancel=self._cancel)
+            elif self.op == 'export':
+                result = profiled(PROFILE_FILE, self.engine.export, self.chunks, progress=self._progress,
+                                  cancel=self._cancel)
+            elif self.op == 'batch':
+                result = profiled(PROFILE_FILE, self.engine.run_batch, self.chunks, progress=self._progress,
+                                  cancel=self._cancel)
+            else:
+                result = profiled(PROFILE_FILE, self.engine.run, self.op, self.chunks, progress=self._progress,
+                                  cancel=self._cancel, dry_run=self.dry_run)
+        except BulkCancelled:
+            self.events.put(('cancelled', None))
+        except Exception as e:
+            self.events.put(('error', e))
+        else:
+            self.events.put(('done', result))
+
+
+class ColumnPlan:
+    """Excel header compiled against the schema."""
+    def __init__(self, root_norm):
+        self.root_norm = root_norm
+        self.targets = {}    # table norm -> [(excel column, table column)]
+        self.unknown = []    # Excel columns that don't resolve to a known table column
+
+    def columns_for(self, norm):
+        return self.targets.get(norm, [])
+
+    def child_columns(self):
+        return [(t, cols) for t, cols in self.targets.items() if t != self.root_norm]
+
+
+class ChangePlan:
+    """Cell-level change set of a bulk operation, as computed by a dry run.
+
+    `diff` holds one text row per change: op, table, pk, column, old, new.
+    An insert is a row marker (empty column) followed by the new row's non-empty
+    cells; a delete is just the marker; an update is one row per changed cell.
+    Saved as CSV it can be applied later (BulkEngine.apply_plan), which refuses
+    to write if the tables no longer hold the `old` values.
+    """
+    COLUMNS = ['op', 'table', 'pk', 'column', 'old', 'new']
+
+    def __init__(self, diff=None):
+        self.diff = pd.DataFrame(columns=self.COLUMNS, dtype=object) if diff is None else diff[self.COLUMNS]
+
+    def __len__(self):
+        return len(self.diff)
+
+    def counts(self):
+        """table -> {'insert': rows, 'update': cells, 'delete': rows}"""
+        d = self.diff
+        rows = d['op'].eq('update') | d['column'].eq('')
+        n = d[rows].groupby(['table', 'op'], sort=False).size()
+        return {t: {op: int(n.get((t, op), 0)) for op in ('insert', 'update', 'delete')}
+                for t in pd.unique(d['table'])}
+
+    def save(self, path):
+        dump_csv(self.diff, path)
+
+    @classmethod
+    def load(cls, path):
+        diff = DeviceSchema._read_csv(path)
+        missing = [c for c in cls.COLUMNS if c not in diff.columns]
+        if missing:
+            raise BulkError(f'{os.path.basename(path)} is not a change plan (missing: {", ".join(missing)}).')
+        return cls(diff)
+
+
+class ValidationReport:
+    """Every problem pre-flight validation found in the input, one row each: the input
+    row (the Excel sheet row for Excel input, else the DataFrame index; blank for a
+    header problem), the input column, its value and what is wrong."""
+    COLUMNS = ['row', 'column', 'value', 'error']
+
+    def __init__(self, errors=None):
+        self.errors = pd.DataFrame(columns=self.COLUMNS, dtype=object) if errors is None else errors[self.COLUMNS]
+
+    def __len__(self):
+        return len(self.errors)
+
+    def summary(self, limit=10):
+        e = self.errors
+        if not len(e):
+            return 'Input is valid.'
+        rows = e.loc[e['row'] != '', 'row'].nunique()
+        lines = [f'Input rejected: {len(e)} problems in {rows} rows; nothing was written.']
+        by = e.groupby(['column', 'error'], sort=False).size()
+        lines += [f'  {col}: {err} ({n})' for (col, err), n in by.head(limit).items()]
+        if len(by) > limit:
+            lines.append(f'  ... and {len(by) - limit} more kinds of problem')
+        return '\n'.join(lines)
+
+    def save(self, path):
+        dump_csv(self.errors, path)
+
+
+class BulkEngine:
+    """UI-free bulk insert/update/upsert/delete over a DeviceSchema.
+
+    Problems are raised as BulkError; everything else is reported through
+    the returned BulkResult. With `validate`, every input chunk is checked first
+    (see _validate) and any problem fails the run with a ValidationError carrying
+    the full report, before anything is written.
+    """
+    def __init__(self, schema: DeviceSchema, user_defaults=None, detected_defaults=None, default_child_rows=None,
+                 validate=VALIDATE_INPUT):
+        self.schema = schema
+        self.validate = validate
+        self.root_norm = normalize_table_name(schema.root_table)
+        if self.root_norm not in schema.tables:
+            raise BulkError(f'Device CSV not found in {schema.data_folder}')
+        self.user_defaults = user_defaults or {}
+        self._detected_defaults = detected_defaults
+        self.default_child_rows = default_child_rows or {}
+        self._plans = {}
+
+    @property
+    def detected_defaults(self):
+        if self._detected_defaults is not None:
+            return self._detected_defaults
+        return self.schema.detect_defaults()
+
+    def col_to_table_col(self, colname):
+        # if col contains dot: Table.Col, else Device.Col
+        if '.' in colname:
+            t, c = colname.split('.', 1)
+            return normalize_table_name(t), c
+        return self.root_norm, colname
+
+    def compile_plan(self, columns):
+        """Resolve an Excel header to table columns once; reused for every row (and chunk)."""
+        key = tuple(str(c) for c in columns)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = ColumnPlan(self.root_norm)
+            for src in key:
+                tnorm, cname = self.col_to_table_col(src)
+                if tnorm not in self.schema.tables or cname not in self.schema.columns(tnorm):
+                    plan.unknown.append(src)
+                else:
+                    plan.targets.setdefault(tnorm, []).append((src, cname))
+            self._plans[key] = plan
+        return plan
+
+    def _warn_unknown(self, plan, result):
+        if plan.unknown:
+            result.warn('Excel columns not matching any table column were ignored: ' + ', '.join(plan.unknown))
+
+    def default_row(self, norm):
+        """Per-column insert defaults for a table: user default, then detected, else ''."""
+        ud = self.user_defaults.get(norm, {})
+        # only inserts need detected defaults; computing them loads every column
+        if self._detected_defaults is not None:
+            det = self._detected_defaults.get(norm, {})
+        else:
+            det = self.schema.table_defaults(norm)
+        out = {}
+        for i, c in enumerate(self.schema.columns(norm)):
+            v = ud.get(c)
+            if v is None: v = det.get(c)
+            # the PK column is allocated, never defaulted
+            out[c] = '' if v is None or i == 0 else v
+        return out
+
+    def build_rows(self, norm, exdf, columns):
+        """New rows for table `norm`, one per Excel row: defaults overridden by non-null cells."""
+        n = len(exdf)
+        data = {c: np.full(n, v, dtype=object) for c, v in self.default_row(norm).items()}
+        for src, cname in columns:
+            vals = exdf[src]
+            m = vals.notna().to_numpy()
+            if m.any():
+                data[cname][m] = vals[m].astype(str).to_numpy()
+        return pd.DataFrame(data, columns=list(data))
+
+    # ---- pre-flight validation: set-based checks of a whole chunk, nothing is changed ----
+    def _validate(self, op, exdf):
+        """Check one input chunk: headers resolve to table columns, keys are present,
+        unique across the input and exist (or, for inserts, don't), FK values exist
+        in the referenced table, and values fit the column's type as inferred from
+        its contents (integer or number; whatever the column is called).
+        Problems are collected in self._errors."""
+        schema, root = self.schema, self.root_norm
+        labels = np.asarray(exdf.index, dtype=object)
+        out = self._errors
+
+        def bad(mask, src, error):
+            mask = np.asarray(mask, dtype=bool)
+            if mask.any():
+                out.append(pd.DataFrame({'row': labels[mask], 'column': src, 'value': text_values(exdf[src]).to_numpy()[mask],
+                                         'error': error}))
+
+        def header(src, error):
+            if (src, error) not in self._header_errors:
+                self._header_errors.add((src, error))
+                out.append(pd.DataFrame({'row': [''], 'column': [src], 'value': [''], 'error': [error]}))
+
+        pk = schema.columns(root)[0]
+        pk_src = self._excel_key_column(exdf, root, pk)
+        n = len(exdf)
+        if op == 'delete':
+            plan = ColumnPlan(root)
+            if pk_src is not None: plan.targets[root] = [(pk_src, pk)]
+        else:
+            plan = self.compile_plan(exdf.columns)
+            for src in plan.unknown:
+                t, c = self.col_to_table_col(src)
+                header(src, f'no table {t}' if t not in schema.tables else f'no column {c} in {t}')
+        existing = np.zeros(n, dtype=bool)   # rows addressing a device that exists (update path)
+        if pk_src is None:
+            if op in ('update', 'delete'):
+                header(pk, f'missing key column {pk} (or {root}.{pk})')
+                return
+        else:
+            keys = text_values(exdf[pk_src]).astype(object)
+            given = (keys != '').to_numpy()
+            if op in ('update', 'delete'):
+                bad(~given, pk_src, f'missing {pk}')
+            found = given & (schema.lookup_rows(root, keys) >= 0)
+            counted = given
+            if op in ('update', 'upsert'):
+                # an existing device's key may repeat on lines that only carry child rows (as exported)
+                own = [s for s, c in plan.columns_for(root) if s != pk_src]
+                counted = given & (~found | exdf[own].notna().any(axis=1).to_numpy())
+            dup = np.zeros(n, dtype=bool)
+            dup[counted] = keys[counted].duplicated().to_numpy() | self._seen[root].add(keys[counted])
+            if op != 'delete':
+                bad(dup, pk_src, f'{pk} repeated in the input')
+            if op in ('update', 'delete'):
+                bad(given & ~found, pk_src, f'no {root} with this {pk}')
+            elif op == 'insert':
+                bad(found, pk_src, f'{root} with this {pk} already exists')
+            if op in ('insert', 'upsert'):
+                self._inserted_keys.add(keys[given & ~found])
+            if op != 'insert':
+                existing = found
+        for ctn, columns in plan.child_columns():
+            filled = exdf[[s for s, _ in columns]].notna().any(axis=1).to_numpy()
+            cpk = schema.columns(ctn)[0]
+            csrc = self._excel_key_column(exdf, ctn, cpk)
+            if csrc is None:
+                if (filled & existing).any():
+                    header(columns[0][0], f'{ctn} changes to existing devices need the {ctn}.{cpk} column')
+                continue
+            ckeys = text_values(exdf[csrc]).astype(object)
+            cgiven = (ckeys != '').to_numpy()
+            bad(filled & existing & ~cgiven, csrc, f'missing {cpk} to identify the {ctn} row')
+            cdup = np.zeros(n, dtype=bool)
+            cdup[cgiven] = ckeys[cgiven].duplicated().to_numpy() | self._seen[ctn].add(ckeys[cgiven])
+            bad(cdup, csrc, f'{cpk} repeated in the input')
+            cfound = cgiven & (schema.lookup_rows(ctn, ckeys) >= 0)
+            bad(existing & cgiven & ~cfound, csrc, f'no {ctn} row with this {cpk}')
+            if op != 'update':
+                bad(~existing & cfound, csrc, f'{ctn} row with this {cpk} already exists')
+        for t, columns in plan.targets.items():
+            by_col = {c: s for s, c in columns}
+            # referential integrity along relations.csv
+            for m in schema.graph.parents.get(t, []):
+                src, ref_t = by_col.get(m['ParentColumn']), m['Referenced_norm']
+                if src is None or ref_t not in schema.tables:
+                    continue
+                vals = text_values(exdf[src]).astype(object)
+                check = (vals != '').to_numpy()
+                if t != root and ref_t == root:
+                    check = check & existing   # rows of new devices get their device's key
+                if op == 'delete' or not check.any():
+                    continue
+                ref_df = schema.peek(ref_t)[0]
+                ref = m['ReferencedColumn'] if m['ReferencedColumn'] in ref_df.columns else ref_df.columns[0]
+                v = vals[check]
+                if ref == ref_df.columns[0]:
+                    ok = schema.lookup_rows(ref_t, v) >= 0
+                else:
+                    ok = schema.fk_index(ref_t, ref).contains(v)
+                if ref_t == root:
+                    ok |= self._inserted_keys.contains(v)
+                miss = np.zeros(n, dtype=bool)
+                miss[np.flatnonzero(check)[~ok]] = True
+                bad(miss, src, f'no {ref_t} row with this {ref}')
+            # value types, as inferred from what the column already holds
+            for src, c in columns:
+                kind = schema.column_kind(t, c)
+                if kind is None:
+                    continue
+                vals = text_values(exdf[src]).to_numpy(dtype=object)
+                given = vals != ''
+                try:
+                    vals[given].astype(np.int64 if kind == 'integer' else float)   # usually all fine
+                    continue
+                except (ValueError, TypeError, OverflowError):
+                    pass
+                v = pd.Series(vals).str.strip()
+                if kind == 'integer':
+                    ok = v.str.fullmatch(r'[+-]?[0-9]+')
+                else:
+                    ok = pd.to_numeric(v, errors='coerce').notna()
+                bad(given & ~ok.to_numpy(dtype=bool), src, f'not {"an integer" if kind == "integer" else "a number"} like the rest of {t}.{c}')
+
+    def validate_input(self, op, chunks):
+        """Run only the pre-flight checks of `op` over the input; returns the ValidationReport."""
+        self._begin()
+        for chunk in chunks:
+            if len(chunk): self._validate(op, chunk)
+        return self._report()
+
+    def _report(self):
+        if not self._errors:
+            return ValidationReport()
+        errors = pd.concat(self._errors, ignore_index=True).astype(object)
+        order = pd.to_numeric(errors['row'], errors='coerce').fillna(-1).sort_values(kind='stable').index
+        return ValidationReport(errors.loc[order].reset_index(drop=True))   # header problems first, then by row
+
+    # ---- staging: chunks are applied to in-memory frames, files are written once at the end ----
+    def _begin(self):
+        self._work = {}                     # norm -> private copy being updated in place
+        self._appends = defaultdict(list)   # norm -> new-row frames to append
+        self._delete_keys = []              # Device PKs (text) to delete
+        self._updated_rows = set()          # Device row positions changed by update
+        self._unknown_keys = 0              # update rows whose Device key doesn't exist
+        self._new_keys = KeySet()           # Device PKs given in the sheet and inserted by upsert
+        self._repeated_keys = 0             # upsert rows repeating a key inserted earlier in the run
+        self._keep = {}                     # norm -> row mask left by deletes
+        self._cell_changes = []             # (norm, pks, column, old, new) from updates
+        self._touched = defaultdict(list)   # norm -> arrays of row positions changed by updates
+        self._errors = []                   # validation problem frames (see ValidationReport)
+        self._header_errors = set()         # (column, error) already reported
+        self._seen = defaultdict(KeySet)    # norm -> keys seen in the input so far
+        self._inserted_keys = KeySet()      # Device keys the input inserts
+        self._deltas = defaultdict(TableDelta)
+
+    def _work_df(self, norm):
+        df = self._work.get(norm)
+        if df is None:
+            df = self._work[norm] = self.schema.tables[norm][0].copy()
+        return df
+
+    def run(self, op, chunks, progress=None, cancel=None, dry_run=False) -> BulkResult:
+        """Apply operation `op` (one of BULK_OPS) to an iterable of
+        Excel chunks, then write every affected table once.
+
+        `progress(rows_done, chunks_done)` is called after each chunk. Setting the
+        `cancel` event stops the run between chunks with BulkCancelled, before
+        anything is written. With dry_run nothing is written either: the result
+        carries the ChangePlan and its counts instead.
+        """
+        if op not in BULK_OPS:
+            raise BulkError(f'Unknown operation: {op}')
+        pk_state = self.schema.pk_state() if dry_run else None
+        try:
+            return self._run(op, chunks, progress, cancel, dry_run)
+        finally:
+            if dry_run:
+                self.schema.restore_pk_state(pk_state)   # a preview doesn't use up keys
+            METRICS.flush(op, dry_run=dry_run)
+
+    def _run(self, op, chunks, progress, cancel, dry_run):
+        result = BulkResult(op, dry_run=dry_run)
+        # pick up CSVs someone else changed since we loaded them
+        self.schema.refresh(changed_only=True)
+        if not self._stage_input(op, chunks, result, progress, cancel):
+            return result
+        if dry_run:
+            with METRICS.phase('change_plan') as p:
+                result.plan = self._change_plan()
+                if p: p.rows = len(result.plan)
+            result.changes = result.plan.counts()
+            return result
+        self._commit(result)
+        return result
+
+    def _stage_input(self, op, chunks, result, progress, cancel):
+        """Validate and stage every chunk of one input (nothing is written); False if it had no rows."""
+        stage = getattr(self, f'_stage_{op}')
+        self._begin()
+        chunks = iter(chunks)
+        i = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise BulkCancelled('Cancelled; nothing was written.')
+            with METRICS.phase('read_input') as p:
+                chunk = next(chunks, None)
+                if p and chunk is not None: p.rows = len(chunk)
+            if chunk is None:
+                break
+            i += 1
+            if len(chunk) and self.validate:
+                with METRICS.phase('validate', rows=len(chunk)):
+                    self._validate(op, chunk)
+            # after the first problem the rest of the input is only validated
+            if len(chunk) and not self._errors:
+                with METRICS.phase(f'stage_{op}', rows=len(chunk)):
+                    stage(chunk, result)
+            result.rows += len(chunk)
+            if progress: progress(result.rows, i)
+        if self._unknown_keys:
+            result.warn(f'{self._unknown_keys} rows reference unknown Device keys; skipped.')
+        if self._repeated_keys:
+            result.warn(f'{self._repeated_keys} rows repeat a new Device key already inserted; skipped.')
+        if op != 'delete':
+            result.updated = len(self._updated_rows)
+            result.devices = result.inserted + result.updated
+        if cancel is not None and cancel.is_set():
+            raise BulkCancelled('Cancelled; nothing was written.')
+        if self._errors:
+            raise ValidationError(self._report())
+        if result.rows == 0:
+            result.warn('No rows found in Excel.')
+            return False
+        if op == 'delete':
+            with METRICS.phase('cascade_delete'):
+                self._apply_deletes(result)
+        return True
+
+    def insert(self, exdf: pd.DataFrame) -> BulkResult:
+        return self.run('insert', [exdf])
+
+    def update(self, exdf: pd.DataFrame) -> BulkResult:
+        return self.run('update', [exdf])
+
+    def upsert(self, exdf: pd.DataFrame) -> BulkResult:
+        return self.run('upsert', [exdf])
+
+    def delete(self, exdf: pd.DataFrame) -> BulkResult:
+        return self.run('delete', [exdf])
+
+    def _commit(self, result):
+        with METRICS.phase('commit'):
+            self._write_tables(result)
+
+    def _write_tables(self, result):
+        # stage every affected table, then publish them together
+        if not (self._work or self._appends):
+            return
+        txn = TableTransaction(self.schema.data_folder)
+        try:
+            final, shard_ids = self._stage_tables(txn)
+            txn.commit()
+        except Exception as e:
+            txn.abort()
+            raise BulkError(f'Failed to write tables (nothing was changed): {e}') from e
+        result.tables_written.extend(os.path.relpath(p, self.schema.data_folder) for p in txn.targets())
+        self.schema.apply_changes(final, self._deltas, shard_ids)
+
+    def _stage_tables(self, txn):
+        """Stage the writes of every affected table in `txn` (a TableTransaction, or a
+        BatchWrites recording them); returns the tables' new frames and, for sharded
+        tables, the shard of each row."""
+        norms = sorted(set(self._work) | set(self._appends), key=lambda t: (t != self.root_norm, t))
+        final, shard_ids = {}, {}
+        for norm in norms:
+            layout = self.schema.shard_layout(norm)
+            if layout is not None:
+                final[norm], shard_ids[norm] = self._stage_shards(txn, norm, layout)
+                continue
+            path = self.schema.get_table_path(norm)
+            df = self._work.get(norm)
+            if self._appends.get(norm):
+                columns = self.schema.columns(norm)
+                new = pd.concat(self._appends[norm], ignore_index=True)
+                new = new.reindex(columns=pd.Index(columns).union(new.columns, sort=False), fill_value='')
+                # insert-only: write just the new rows unless the columns changed
+                if df is None and len(new.columns) == len(columns) and \
+                        txn.append(new, path, columns, self.schema.table_encoding(norm)):
+                    base = self.schema.peek(norm)[0]   # a projected table stays projected
+                    final[norm] = concat_rows(base, new[base.columns])
+                    continue
+                base = self.schema.tables[norm][0] if df is None else df
+                final[norm] = concat_rows(base, new)
+            elif norm in self._keep:
+                final[norm] = df
+                if self.schema.is_partial(norm):
+                    # only some columns are loaded: filter the file instead of rewriting it
+                    txn.filter_rows(path, self._keep[norm], self.schema.table_encoding(norm))
+                    continue
+            else:
+                final[norm] = df
+            txn.rewrite(final[norm], path)
+        return final, shard_ids
+
+    def _stage_shards(self, txn, norm, layout):
+        """Stage the shards of a sharded table that hold changed rows; the other
+        shard files are left alone. Returns the table's new frame, in shard order like
+        the files, and the shard number of each of its rows."""
+        schema = self.schema
+        files = layout.files()
+        columns = schema.columns(norm)
+        ids = schema.shard_ids(norm)   # of the rows as loaded
+        df, keep = self._work.get(norm), self._keep.get(norm)
+        new = new_ids = None
+        if self._appends.get(norm):
+            new = pd.concat(self._appends[norm], ignore_index=True)
+            new = new.reindex(columns=pd.Index(columns).union(new.columns, sort=False), fill_value='')
+            new_ids = layout.shard_of(new[layout.column])
+        every = schema.needs_shard_repair(norm) or (new is not None and len(new.columns) != len(columns))
+        if df is None and new is not None and not every:
+            # insert-only: append the new rows to their shards
+            base = schema.peek(norm)[0]
+            for k in np.unique(new_ids):
+                rows = new[new_ids == k]
+                if not txn.append(rows, files[k], columns):
+                    full = schema.tables[norm][0]
+                    txn.rewrite(concat_rows(full[ids == k], rows), files[k])
+            frame, frame_ids = concat_rows(base, new[base.columns]), np.concatenate([ids, new_ids])
+        elif df is not None and keep is not None and schema.is_partial(norm) and new is None and not every:
+            # deletes with only some columns loaded: filter the affected shard files
+            for k in np.unique(ids[~keep]):
+                txn.filter_rows(files[k], keep[ids == k])
+            frame, frame_ids = df, ids[keep]
+        else:
+            if df is None or len(df.columns) < len(columns):
+                full = schema.tables[norm][0]
+                df = full if keep is None else full[keep].reset_index(drop=True)
+            dirty = set() if keep is None else set(np.unique(ids[~keep]).tolist())
+            frame_ids = ids if keep is None else ids[keep]
+            if self._touched.get(norm):
+                dirty.update(np.unique(ids[np.concatenate(self._touched[norm])]).tolist())
+                if layout.column in self._deltas[norm].updated:
+                    # rows whose key changed move to another shard
+                    moved_ids = layout.shard_of(df[layout.column])
+                    dirty.update(np.unique(moved_ids[moved_ids != frame_ids]).tolist())
+                    frame_ids = moved_ids
+            frame = df
+            if new is not None:
+                dirty.update(np.unique(new_ids).tolist())
+                frame, frame_ids = concat_rows(df, new), np.concatenate([frame_ids, new_ids])
+            for k in (range(layout.count) if every else sorted(dirty)):
+                txn.rewrite(frame[frame_ids == k], files[k])
+        if len(frame_ids) and (np.diff(frame_ids) < 0).any():
+            order = np.argsort(frame_ids, kind='stable')
+            self._deltas[norm].order = order
+            frame, frame_ids = frame.iloc[order].reset_index(drop=True), frame_ids[order]
+        return frame, frame_ids
+
+    def _change_plan(self):
+        """ChangePlan of everything staged so far (deletes, updates, inserts)."""
+        parts = []
+        for norm, keep in self._keep.items():
+            df, _ = self.schema.peek(norm)
+            parts.append(pd.DataFrame({'op': 'delete', 'table': norm, 'pk': text_values(df.iloc[~keep, 0]).to_numpy(),
+                                       'column': '', 'old': '', 'new': ''}))
+        if self._cell_changes:
+            upd = pd.concat([pd.DataFrame({'table': norm, 'pk': pks, 'column': col, 'old': old, 'new': new})
+                             for norm, pks, col, old, new in self._cell_changes], ignore_index=True)
+            # a cell changed by several chunks: first old value, last new value
+            upd = upd.groupby(['table', 'pk', 'column'], sort=False).agg(old=('old', 'first'), new=('new', 'last')).reset_index()
+            upd = upd[upd['old'] != upd['new']]
+            upd.insert(0, 'op', 'update')
+            parts.append(upd)
+        for norm, frames in self._appends.items():
+            new = pd.concat(frames, ignore_index=True)
+            pk = self.schema.columns(norm)[0]
+            pks = text_values(new[pk]).to_numpy() if pk in new.columns else np.full(len(new), '', dtype=object)
+            cells = [pd.DataFrame({'row': np.arange(len(new)), 'seq': 0, 'pk': pks, 'column': '', 'new': ''})]
+            for i, c in enumerate(new.columns, 1):
+                if c == pk: continue
+                v = text_values(new[c]).to_numpy()
+                m = v != ''
+                cells.append(pd.DataFrame({'row': np.flatnonzero(m), 'seq': i, 'pk': pks[m], 'column': c, 'new': v[m]}))
+            ins = pd.concat(cells, ignore_index=True).sort_values(['row', 'seq'], kind='stable')
+            parts.append(ins.drop(columns=['row', 'seq']).assign(op='insert', table=norm, old=''))
+        if not parts:
+            return ChangePlan()
+        diff = pd.concat(parts, ignore_index=True)
+        return ChangePlan(diff.astype(object))
+
+    def apply_plan(self, plan, cancel=None) -> BulkResult:
+        """Write a ChangePlan computed earlier (possibly saved and reloaded) without
+        recomputing it. Every table is checked first: if an updated cell no longer
+        holds its `old` value, an inserted key already exists, or a row the plan
+        doesn't delete now references a deleted one, nothing is written."""
+        try:
+            return self._apply_plan(plan, cancel)
+        finally:
+            METRICS.flush('apply')
+
+    def _apply_plan(self, plan, cancel):
+        result = BulkResult('apply')
+        self.schema.refresh(changed_only=True)
+        self._begin()
+        d = plan.diff
+        conflicts = []
+        for norm, g in d.groupby('table', sort=False):
+            if norm not in self.schema.tables:
+                raise BulkError(f'The plan refers to table {norm}, which is not loaded.')
+            self._stage_plan_updates(norm, g[g['op'] == 'update'], conflicts)
+            self._stage_plan_deletes(norm, g[g['op'] == 'delete'], result)
+            self._stage_plan_inserts(norm, g[g['op'] == 'insert'], conflicts)
+        self._check_plan_cascade(d[d['op'] == 'delete'], conflicts)
+        if conflicts:
+            raise BulkError('The tables changed since the plan was made; nothing was written.\n' + '\n'.join(conflicts))
+        if cancel is not None and cancel.is_set():
+            raise BulkCancelled('Cancelled; nothing was written.')
+        result.changes = plan.counts()
+        root = result.changes.get(self.root_norm, {})
+        result.inserted = root.get('insert', 0)
+        result.updated = int(d.loc[(d['table'] == self.root_norm) & (d['op'] == 'update'), 'pk'].nunique())
+        result.devices = result.inserted + result.updated + root.get('delete', 0)
+        self._commit(result)
+        return result
+
+    def _stage_plan_updates(self, norm, upd, conflicts):
+        if not len(upd): return
+        df = self._work_df(norm)
+        for col, cg in upd.groupby('column', sort=False):
+            if col not in df.columns:
+                conflicts.append(f'{norm}: column {col} no longer exists'); continue
+            pos = self.schema.lookup_rows(norm, cg['pk'])
+            if (pos < 0).any():
+                conflicts.append(f'{norm}.{col}: {int((pos < 0).sum())} rows no longer exist'); continue
+            ci = df.columns.get_loc(col)
+            differ = text_values(df.iloc[pos, ci]).to_numpy() != cg['old'].to_numpy()
+            if differ.any():
+                conflicts.append(f'{norm}.{col}: {int(differ.sum())} cells were changed since'); continue
+            set_cells(df, pos, ci, cg['new'].to_numpy())
+            self._touched[norm].append(pos)
+            self._deltas[norm].updated[col].append(cg['new'].to_numpy())
+
+    def _stage_plan_deletes(self, norm, dele, result):
+        if not len(dele): return
+        df = self._work.get(norm)
+        if df is None: df, _ = self.schema.peek(norm)
+        keep = ~key_isin(df.iloc[:, 0], dele['pk'])
+        gone = len(dele) - int((~keep).sum())
+        if gone > 0:
+            result.warn(f'{gone} {norm} rows in the plan were already deleted.')
+        if not keep.all():
+            self._drop_rows(norm, df, keep)
+
+    def _check_plan_cascade(self, dele, conflicts):
+        # the plan holds the cascade as it was: a row added (or re-pointed) since then
+        # at a row the plan deletes would be left behind, pointing at nothing
+        if not len(dele): return
+        planned = {norm: g['pk'] for norm, g in dele.groupby('table', sort=False)}
+        graph = self.schema.graph
+        for norm in graph.order(self.root_norm):
+            if norm not in planned: continue
+            df, _ = self.schema.peek(norm)
+            pos = self.schema.lookup_rows(norm, planned[norm])
+            rows = df.iloc[pos[pos >= 0]]
+            for m in graph.children.get(norm, []):
+                cnorm = m['Parent_norm']
+                if cnorm not in self.schema.tables: continue
+                child_df, _ = self.schema.peek(cnorm)
+                if m['ParentColumn'] not in child_df.columns: continue
+                ref = m['ReferencedColumn'] if m['ReferencedColumn'] in rows.columns else rows.columns[0]
+                at = self.schema.fk_index(cnorm, m['ParentColumn']).rows(rows[ref])
+                left = int((~key_isin(child_df.iloc[at, 0], planned.get(cnorm, []))).sum())
+                if left:
+                    conflicts.append(f'{cnorm}: {left} rows now reference {norm} rows the plan deletes')
+
+    def _stage_plan_inserts(self, norm, ins, conflicts):
+        if not len(ins): return
+        columns = self.schema.columns(norm)
+        marker = ins['column'].eq('').to_numpy()
+        row = np.cumsum(marker) - 1
+        pks = ins['pk'].to_numpy()[marker]
+        given = pks[pks != '']
+        if (self.schema.lookup_rows(norm, given) >= 0).any():
+            conflicts.append(f'{norm}: some inserted keys already exist'); return
+        rows = pd.DataFrame('', index=range(int(marker.sum())), columns=columns, dtype=object)
+        rows[columns[0]] = pks
+        cells = ins[~marker]
+        for col, cg in cells.groupby('column', sort=False):
+            if col not in columns:
+                conflicts.append(f'{norm}: column {col} no longer exists'); continue
+            rows.loc[row[~marker][cells['column'].eq(col).to_numpy()], col] = cg['new'].to_numpy()
+        if len(given): self.schema.reserve_pks(norm, given)
+        self._appends[norm].append(rows)
+        self._deltas[norm].added.append(rows)
+
+    def _stage_insert(self, exdf, result):
+        plan = self.compile_plan(exdf.columns)
+        self._warn_unknown(plan, result)
+        new_devices = self.build_rows(self.root_norm, exdf, plan.columns_for(self.root_norm))
+        self._assign_pks(self.root_norm, new_devices)
+        new_children = self._child_rows_for(new_devices, exdf, plan, result)
+        self._appends[self.root_norm].append(new_devices)
+        self._deltas[self.root_norm].added.append(new_devices)
+        result.inserted += len(new_devices)
+        for ctn, rows in new_children.items():
+            self._appends[ctn].append(rows)
+            self._deltas[ctn].added.append(rows)
+            result.child_rows[ctn] = result.child_rows.get(ctn, 0) + len(rows)
+
+    def _child_meta(self, ctn):
+        # relation linking child table ctn to the Device table
+        for m in self.schema.child_map.get(self.root_norm, []):
+            if m['Parent_norm'] == ctn:
+                return m
+        return None
+
+    def _assign_pks(self, norm, rows):
+        """Fill empty PKs of new rows from the schema's sequence for `norm` (in place)."""
+        if rows.shape[1] == 0 or len(rows) == 0: return
+        pk = rows.columns[0]
+        keys = text_values(rows[pk])
+        given = keys[keys != '']
+        if len(given):
+            self.schema.reserve_pks(norm, given)
+        missing = (keys == '').to_numpy()
+        if missing.any():
+            ids = self.schema.allocate_pks(norm, int(missing.sum()))
+            if ids is not None:
+                rows.loc[missing, pk] = ids
+
+    def _child_rows_for(self, new_devices, exdf, plan, result):
+        """Child rows for freshly built devices: one per Excel row that fills Table.Column
+        cells, plus every default child-row template crossed with every device."""
+        out = defaultdict(list)
+        n = len(new_devices)
+        for ctn, columns in plan.child_columns():
+            if ctn in self.schema.tables:
+                filled = exdf[[src for src, _ in columns]].notna().any(axis=1).to_numpy()
+                if filled.any():
+                    rows = self.build_rows(ctn, exdf[filled], columns)
+                    out[ctn].append((rows, np.flatnonzero(filled)))
+        for ctn, templates in self.default_child_rows.items():
+            if ctn not in self.schema.tables or not templates:
+                continue
+            child_cols = self.schema.columns(ctn)
+            tmpl = pd.DataFrame(templates, dtype=object)
+            extra = [c for c in tmpl.columns if c not in child_cols]
+            if extra:
+                result.warn(f'Template columns not in {ctn} were ignored: ' + ', '.join(extra))
+            base = pd.DataFrame(self.default_row(ctn), index=range(len(tmpl)), columns=child_cols, dtype=object)
+            for c in tmpl.columns.difference(extra):
+                m = tmpl[c].notna()
+                base.loc[m, c] = tmpl.loc[m, c].astype(str)
+            # devices x templates cross product
+            rows = base.iloc[np.tile(np.arange(len(base)), n)].reset_index(drop=True)
+            out[ctn].append((rows, np.repeat(np.arange(n), len(base))))
+        new_children = {}
+        for ctn, parts in out.items():
+            rows = pd.concat([r for r, _ in parts], ignore_index=True)
+            dev_pos = np.concatenate([p for _, p in parts])
+            meta = self._child_meta(ctn)
+            if meta:
+                ref = meta['ReferencedColumn']
+                ref = ref if ref in new_devices.columns else new_devices.columns[0]
+                rows[meta['ParentColumn']] = new_devices[ref].to_numpy()[dev_pos]
+            self._assign_pks(ctn, rows)
+            new_children[ctn] = rows
+        return new_children
+
+    def _excel_key_column(self, exdf, table_norm, col):
+        # a key column may be given as "Col" or as "Table.Col"
+        for cand in (col, f'{table_norm}.{col}'):
+            if cand in exdf.columns:
+                return cand
+        return None
+
+    def _merge_updates(self, norm, exdf, pos, columns):
+        """Write the non-null Excel cells of `columns` into table `norm` at row positions `pos`.
+
+        Returns (changed_cells, changed_row_positions). Cells equal to the current
+        value are not counted; for duplicate keys the last Excel row wins.
+        """
+        df = self._work.get(norm)
+        if df is None: df = self.schema.tables[norm][0]
+        changed_cells = 0
+        changed_rows = []
+        for src, cname in columns:
+            vals = exdf[src]
+            m = vals.notna().to_numpy()
+            if not m.any():
+                continue
+            upd = pd.Series(vals[m].astype(str).to_numpy(), index=pos[m])
+            upd = upd[~upd.index.duplicated(keep='last')]
+            ci = df.columns.get_loc(cname)
+            old = text_values(df.iloc[upd.index.to_numpy(), ci]).to_numpy()
+            diff = old != upd.to_numpy()
+            if not diff.any():
+                continue
+            df = self._work_df(norm)
+            rows = upd.index.to_numpy()[diff]
+            set_cells(df, rows, ci, upd.to_numpy()[diff])
+            self._touched[norm].append(rows)
+            self._deltas[norm].updated[cname].append(upd.to_numpy()[diff])
+            self._cell_changes.append((norm, text_values(df.iloc[rows, 0]).to_numpy(), cname, old[diff], upd.to_numpy()[diff]))
+            changed_cells += int(diff.sum())
+            changed_rows.append(rows)
+        rows = np.unique(np.concatenate(changed_rows)) if changed_rows else np.array([], dtype=int)
+        return changed_cells, rows
+
+    def _stage_update(self, exdf, result):
+        # update Device rows and optionally child rows if identifying PK is provided
+        pk = self.schema.columns(self.root_norm)[0]
+        pk_src = self._excel_key_column(exdf, self.root_norm, pk)
+        if pk_src is None:
+            raise BulkError(f'Excel must contain Device PK column named "{pk}" for updates.')
+        exdf = exdf[exdf[pk_src].notna().to_numpy()]
+        pos = self.schema.lookup_rows(self.root_norm, exdf[pk_src].astype(str))
+        found = pos >= 0
+        self._unknown_keys += int((~found).sum())
+        self._update_rows(exdf[found], pos[found], result)
+
+    def _update_rows(self, exdf, pos, result):
+        # exdf rows are existing devices, at Device row positions `pos`
+        plan = self.compile_plan(exdf.columns)
+        self._warn_unknown(plan, result)
+        _, rows = self._merge_updates(self.root_norm, exdf, pos, plan.columns_for(self.root_norm))
+        self._updated_rows.update(rows.tolist())
+        # child updates need the child's PK column (Table.ChildPK or ChildPK) to identify the row
+        for ctn, columns in plan.child_columns():
+            child_pk = self.schema.columns(ctn)[0]
+            child_pk_src = self._excel_key_column(exdf, ctn, child_pk)
+            if child_pk_src is None:
+                if exdf[[src for src, _ in columns]].notna().any(axis=None):
+                    result.warn(f'No {ctn}.{child_pk} column; updates to {ctn} skipped.')
+                continue
+            cex = exdf[exdf[child_pk_src].notna().to_numpy()]
+            cpos = self.schema.lookup_rows(ctn, cex[child_pk_src].astype(str))
+            cfound = cpos >= 0
+            cells, _ = self._merge_updates(ctn, cex[cfound], cpos[cfound], columns)
+            if cells:
+                result.child_rows[ctn] = result.child_rows.get(ctn, 0) + cells
+
+    def _stage_upsert(self, exdf, result):
+        """Split the chunk with one PK lookup: rows whose key exists take the update
+        path, the rest (no key, or a key not in Device) take the insert path."""
+        pk = self.schema.columns(self.root_norm)[0]
+        pk_src = self._excel_key_column(exdf, self.root_norm, pk)
+        if pk_src is None:
+            return self._stage_insert(exdf, result)
+        has_key = exdf[pk_src].notna().to_numpy()
+        keys = exdf[pk_src].astype(str)
+        pos = np.where(has_key, self.schema.lookup_rows(self.root_norm, keys), -1)
+        found = pos >= 0
+        # a new key is inserted once; later rows with the same key are skipped
+        fresh = has_key & ~found
+        skip = np.zeros(len(exdf), dtype=bool)
+        if fresh.any():
+            k = keys[fresh]
+            skip[fresh] = k.duplicated().to_numpy() | self._new_keys.add(k)
+            self._repeated_keys += int(skip.sum())
+        if found.any():
+            self._update_rows(exdf[found], pos[found], result)
+        new = ~found & ~skip
+        if new.any():
+            self._stage_insert(exdf[new], result)
+
+    def _stage_delete(self, exdf, result):
+        # expects a column equal to device PK name or Device.PK
+        pk = self.schema.columns(self.root_norm)[0]
+        pk_src = self._excel_key_column(exdf, self.root_norm, pk)
+        if pk_src is None:
+            raise BulkError(f'Excel must contain primary key column named "{pk}" or "{self.root_norm}.{pk}"')
+        self._delete_keys.append(exdf[pk_src].dropna().astype(str).to_numpy())
+
+    def _apply_deletes(self, result):
+        keys = np.unique(np.concatenate(self._delete_keys)) if self._delete_keys else np.array([], dtype=object)
+        if len(keys) == 0:
+            result.warn('No keys found in Excel.')
+            return
+        # only PK/FK columns are needed here, so projected tables stay projected
+        device_df, _ = self.schema.peek(self.root_norm)
+        pos = self.schema.lookup_rows(self.root_norm, keys)
+        drop = np.zeros(len(device_df), dtype=bool)
+        drop[pos[pos >= 0]] = True
+        if not drop.any():
+            return
+        # cascade down the relation graph: the table earliest in dependency order that
+        # lost rows is visited next, and its children lose the rows pointing at those.
+        # Without cycles that visits a table once, after every table it references; a
+        # table referencing itself or on a cycle is visited again while it loses rows.
+        graph = self.schema.graph
+        rank = {t: i for i, t in enumerate(graph.order(self.root_norm))}
+        frames, gone, fresh = {self.root_norm: device_df}, {self.root_norm: drop}, {self.root_norm: drop.copy()}
+        pending = {self.root_norm}
+        while pending:
+            t = min(pending, key=rank.get); pending.discard(t)
+            rows = frames[t][fresh[t]]
+            fresh[t][:] = False
+            for m in graph.children.get(t, []):
+                cnorm = m['Parent_norm']
+                if cnorm not in self.schema.tables: continue
+                if cnorm not in frames:
+                    frames[cnorm], _ = self.schema.peek(cnorm)
+                    gone[cnorm] = np.zeros(len(frames[cnorm]), dtype=bool)
+                    fresh[cnorm] = gone[cnorm].copy()
+                if m['ParentColumn'] not in frames[cnorm].columns: continue
+                ref = m['ReferencedColumn']
+                ref = ref if ref in rows.columns else rows.columns[0]
+                at = self.schema.fk_index(cnorm, m['ParentColumn']).rows(rows[ref])
+                at = at[~gone[cnorm][at]]
+                if len(at):
+                    gone[cnorm][at] = fresh[cnorm][at] = True
+                    pending.add(cnorm)
+        result.devices = int(gone[self.root_norm].sum())
+        for norm in sorted(gone, key=rank.get):
+            if not gone[norm].any(): continue
+            self._drop_rows(norm, frames[norm], ~gone[norm])
+            if norm != self.root_norm:
+                result.child_rows[norm] = int(gone[norm].sum())
+
+    def _drop_rows(self, norm, df, keep):
+        self._work[norm] = df[keep].reset_index(drop=True)
+        self._keep[norm] = keep
+        delta = self._deltas[norm]
+        delta.removed += int((~keep).sum())
+        if delta.keep is not None:   # rows dropped twice: `keep` is over what the first drop left
+            keep, delta.keep = delta.keep.copy(), None
+            keep[keep] = self._keep[norm]
+        delta.keep = keep
+
+    # ---- export: devices with their rows below, in the layout Bulk Update reads back ----
+    def export(self, spec, progress=None, cancel=None) -> BulkResult:
+        """Write the devices selected by `spec` (ExportSpec) and every row below them.
+
+        Device columns keep their names, other tables' are Table.Column. A device's
+        first line holds its columns; each line holds at most one row of every other
+        table, so a device takes as many lines as its largest child table, and lines
+        after the first carry only the Device PK and child values. Updating from the
+        file therefore changes nothing until cells are edited. Devices are gathered
+        EXPORT_BATCH_DEVICES at a time through the FK indexes and streamed to the
+        file (ExportWriter); `progress(devices_done, batches_done)` follows each batch.
+        """
+        result = BulkResult('export')
+        self.schema.refresh(changed_only=True)
+        pos = self._export_positions(spec, result)
+        layout = self._export_layout(spec)
+        header = [c if t == self.root_norm else f'{t}.{c}' for t, cols in layout for c in cols]
+        writer = ExportWriter(spec.path, header)
+        try:
+            for i, start in enumerate(range(0, len(pos), EXPORT_BATCH_DEVICES), 1):
+                if cancel is not None and cancel.is_set():
+                    raise BulkCancelled('Cancelled; no file was written.')
+                batch = pos[start:start + EXPORT_BATCH_DEVICES]
+                with METRICS.phase('export', rows=len(batch)):
+                    cols, breaks = self._export_lines(batch, layout, result)
+                    writer.write(cols, breaks)
+                result.devices += len(batch)
+                if progress: progress(result.devices, i)
+            result.files = writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            METRICS.flush('export')
+        if not len(pos):
+            result.warn('No devices matched; the file holds only the header.')
+        return result
+
+    def _export_positions(self, spec, result):
+        # Device row positions to export, in key order for a key list, else table order
+        root = self.root_norm
+        if spec.keys is None:
+            pos = np.arange(len(self.schema.peek(root)[0]))
+        else:
+            pos = self.schema.lookup_rows(root, text_values(pd.Series(list(spec.keys), dtype=object)))
+            if (pos < 0).any():
+                result.warn(f'{int((pos < 0).sum())} keys match no device; skipped.')
+            pos = pd.unique(pos[pos >= 0])
+        for column, text, exact in spec.filters:
+            if column not in self.schema.columns(root):
+                raise BulkError(f'No column {column} in {root}.')
+            if text:
+                pos = pos[text_match(self.schema.tables[root][0][column], text, exact)[pos]]
+        return pos
+
+    def _export_layout(self, spec):
+        # [(table, columns)]: the root table, then the tables below it in graph order
+        order = [t for t in self.schema.graph.order(self.root_norm) if t in self.schema.tables]
+        if spec.tables is not None:
+            wanted = {normalize_table_name(t) for t in spec.tables}
+            unknown = wanted.difference(order)
+            if unknown:
+                raise BulkError(f'Not tables below {self.root_norm}: ' + ', '.join(sorted(unknown)))
+            order = [t for t in order if t == self.root_norm or t in wanted]
+        layout = []
+        for t in order:
+            header = self.schema.columns(t)
+            wanted = spec.columns(t, header) if callable(spec.columns) else (spec.columns or {}).get(t)
+            layout.append((t, header if wanted is None else [c for c in header if c == header[0] or c in set(wanted)]))
+        return layout
+
+    def _export_lines(self, pos, layout, result):
+        """(one object array per header column, first line of each device) for the
+        devices at Device row positions `pos`."""
+        found = self.schema.bundle_rows(pos)
+        n = len(pos)
+        lines = np.ones(n, dtype=np.int64)
+        placed = {}
+        for t, _ in layout[1:]:
+            rows, owners = found[t]
+            order = np.lexsort((rows, owners))
+            rows, owners = rows[order], owners[order]
+            counts = np.bincount(owners, minlength=n)
+            rank = np.arange(len(rows)) - (np.cumsum(counts) - counts)[owners]
+            placed[t] = (rows, owners, rank)
+            lines = np.maximum(lines, counts)
+            if len(rows):
+                result.child_rows[t] = result.child_rows.get(t, 0) + len(rows)
+        starts = np.cumsum(lines) - lines
+        total = int(lines.sum())
+        cols = []
+        for t, columns in layout:
+            df = self.schema.tables[t][0]
+            if t == self.root_norm:
+                rows, at = pos, starts
+            else:
+                rows, owners, rank = placed[t]
+                at = starts[owners] + rank
+            sub = df.iloc[rows, [df.columns.get_loc(c) for c in columns]]
+            for c in columns:
+                vals = text_values(sub[c]).to_numpy(dtype=object)
+                vals[vals == ''] = None
+                out = np.full(total, None, dtype=object)
+                out[at] = vals
+                cols.append(out)
+            if t == self.root_norm:
+                cols[0] = np.repeat(text_values(sub[columns[0]]).to_numpy(dtype=object), lines)   # the key on every line
+        result.rows += total
+        return cols, starts
+
+    # ---- batches: many input files, every table written once ----
+    def run_batch(self, spec, progress=None, cancel=None) -> BulkResult:
+        """Apply the input files of a batch (BatchSpec) in order, writing each table
+        once per commit instead of once per file.
+
+        Each file is validated and staged against the tables as the files before it
+        left them, then folded into the in-memory tables while BatchWrites notes the
+        files to write. Input is parsed on a worker thread a few chunks ahead of
+        staging (ChunkPrefetcher), one chunk at a time. At the
+        end (and after every `commit_every` files) the noted files are written in one
+        TableTransaction together with the checkpoint CSV, which records each file's
+        outcome; a rerun skips the files it lists as done, if unchanged since. A file
+        that fails stops the batch after committing the ones before it, unless
+        keep_going. On cancel or a write error the uncommitted files are dropped and
+        their tables reloaded. `progress(rows_done, files_done)` follows each file.
+        """
+        result = BulkResult('batch')
+        entries = batch_entries(spec.source)
+        log_path = spec.checkpoint_path()
+        log = DeviceSchema._read_csv(log_path) if os.path.exists(log_path) else pd.DataFrame(columns=BATCH_LOG_COLUMNS)
+        log = log.reindex(columns=BATCH_LOG_COLUMNS, fill_value='').astype(object)
+        ok = log[log['status'] == 'done']
+        done = set(zip(ok['file'], ok['size'], ok['mtime_ns']))
+        todo = []
+        for path, op in entries:
+            path = os.path.abspath(path)
+            st = os.stat(path) if os.path.exists(path) else None
+            if st is not None and (path, str(st.st_size), str(st.st_mtime_ns)) in done:
+                result.entries.append({'file': path, 'op': op, 'status': 'skipped', 'rows': 0, 'devices': 0,
+                                       'detail': 'done in an earlier run'})
+            else:
+                todo.append((path, op))
+        self.schema.refresh(changed_only=True)
+        for norm in self.schema.tables.keys():
+            self.schema.tables[norm]   # load projected columns: appends are written from whole rows
+        writes, base = BatchWrites(), {}
+        pending, files = 0, 0
+        try:
+            reader = ChunkPrefetcher(path for path, _ in todo)
+            try:
+                for i, (path, op) in enumerate(todo):
+                    entry = {'file': path, 'op': op, 'status': 'done', 'rows': 0, 'devices': 0, 'detail': ''}
+                    st = os.stat(path) if os.path.exists(path) else None
+                    file_result = BulkResult(op)
+                    try:
+                        if self._stage_input(op, reader.chunks(i), file_result, None, cancel):
+                            self._fold(writes, base)
+                        entry.update(rows=file_result.rows, devices=file_result.devices,
+                                     detail=' '.join([file_result.summary()] + file_result.warnings))
+                    except BulkCancelled:
+                        raise
+                    except BulkError as e:
+                        entry.update(status='failed', rows=file_result.rows, detail=str(e).replace('\n', ' '))
+                    result.entries.append(entry)
+                    result.rows += entry['rows']; result.devices += entry['devices']
+                    for k, v in file_result.child_rows.items():
+                        result.child_rows[k] = result.child_rows.get(k, 0) + v
+                    log = log[log['file'] != path]
+                    log.loc[len(log)] = [path, op, entry['status'], entry['rows'], entry['devices'], entry['detail'],
+                                         st.st_size if st else '', st.st_mtime_ns if st else '']
+                    log = log.reset_index(drop=True)
+                    pending += 1; files += 1
+                    if progress: progress(result.rows, files)
+                    if entry['status'] == 'failed' and not spec.keep_going:
+                        result.warn(f'Stopped at {os.path.basename(path)}; fix it and run the batch again to continue.')
+                        break
+                    if spec.commit_every and pending >= spec.commit_every:
+                        self._commit_batch(writes, base, log, log_path, result); pending = 0
+                    if cancel is not None and cancel.is_set():
+                        raise BulkCancelled('Cancelled; files after the last commit were not written.')
+            finally:
+                reader.close()
+            self._commit_batch(writes, base, log, log_path, result)
+        except BaseException:
+            self.schema.refresh(changed_only=True)   # drop what was folded but not written
+            raise
+        finally:
+            METRICS.flush('batch')
+        return result
+
+    def _fold(self, writes, base):
+        # one staged file becomes the in-memory state; `writes` notes the files to write and
+        # `base` the rows each table (or shard) had on disk, so appended rows can be told apart
+        final, shard_ids = self._stage_tables(writes)
+        for norm in final:
+            if norm not in base:
+                layout = self.schema.shard_layout(norm)
+                base[norm] = (len(self.schema.peek(norm)[0]) if layout is None
+                              else np.bincount(self.schema.shard_ids(norm), minlength=layout.count))
+        self.schema.apply_changes(final, self._deltas, shard_ids, written=False)
+
+    def _commit_batch(self, writes, base, log, log_path, result):
+        """Write every file the folded inputs changed, once, and the checkpoint with them."""
+        txn = TableTransaction(self.schema.data_folder)
+        try:
+            with METRICS.phase('commit'):
+                for norm, n in base.items():
+                    df = self.schema.peek(norm)[0]
+                    columns = self.schema.columns(norm)
+                    layout = self.schema.shard_layout(norm)
+                    encoding = self.schema.table_encoding(norm) if layout is None else None
+                    if layout is None:
+                        parts = [(self.schema.get_table_path(norm), df, n)]
+                    else:
+                        ids = self.schema.shard_ids(norm)
+                        parts = [(f, df[ids == k], n[k]) for k, f in enumerate(layout.files())]
+                    for path, frame, rows in parts:
+                        mode = writes.modes.get(path)
+                        if mode is None: continue
+                        if mode == 'append' and txn.append(frame.iloc[rows:], path, columns, encoding): continue
+                        txn.rewrite(frame, path)
+                tables = txn.targets()
+                txn.rewrite(log, log_path)   # published with the tables: a file is done exactly when its changes are
+                txn.commit()
+        except Exception as e:
+            txn.abort()
+            raise BulkError(f'Failed to write tables (nothing was changed): {e}') from e
+        result.tables_written.extend(os.path.relpath(p, self.schema.data_folder) for p in tables)
+        self.schema.mark_written(list(base))
+        writes.modes.clear(); base.clear()
+
+# ----- Service -----
+class BulkService:
+    """One warm DeviceSchema shared by every client, behind a small JSON API (serve()).
+
+    insert/update/upsert/delete/apply/refresh go through one queue and run one at a
+    time on the writer thread, so concurrent clients can't lose each other's updates;
+    lookup, export and status run on the request threads under the schema's read
+    lock, side by side. Files named in requests are paths on the service's machine;
+    the files it writes (exports, dry-run plans, batch checkpoints) must lie in
+    `output_folder` (default: an output folder in the data folder), and relative
+    paths are taken from there.
+    """
+    WRITES = BULK_OPS + ('apply', 'batch', 'refresh')
+    READS = ('lookup', 'export', 'status')
+
+    def __init__(self, schema: DeviceSchema, user_defaults=None, default_child_rows=None, output_folder=SERVICE_OUTPUT_FOLDER):
+        self.schema = schema
+        self.output_folder = os.path.realpath(output_folder or os.path.join(schema.data_folder, 'output'))
+        self.user_defaults = user_defaults or {}
+        self.default_child_rows = default_child_rows or {}
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, name='service-writer', daemon=True)
+        self.thread.start()
+
+    def _engine(self, req):
+        # a client may send its own defaults (the UI's); else the service's files apply
+        return BulkEngine(self.schema, req.get('user_defaults') or self.user_defaults, None,
+                          req.get('default_child_rows') or self.default_child_rows,
+                          validate=bool(req.get('validate', VALIDATE_INPUT)))
+
+    def _writer(self):
+        while True:
+            fn, future = self.writes.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+
+    def handle(self, op, req):
+        """Carry out one request (a dict decoded from JSON); returns (HTTP status, reply dict)."""
+        try:
+            if op in self.WRITES:
+                future = Future()
+                self.writes.put((lambda: getattr(self, f'_do_{op}', self._do_bulk)(op, req), future))
+                return 200, future.result()
+            if op in self.READS:
+                with self.schema.lock.read():
+                    return 200, getattr(self, f'_do_{op}')(op, req)
+            return 404, {'error': f'unknown operation: {op}'}
+        except ValidationError as e:
+            return 422, {'error': 'validation', 'message': str(e), 'problems': e.report.errors.to_dict('records')}
+        except (BulkError, FileNotFoundError, ValueError, KeyError, TypeError) as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+
+    def _output_path(self, path):
+        # where a request may have the service write: inside the output folder only
+        full = os.path.realpath(os.path.join(self.output_folder, path))
+        if os.path.commonpath([full, self.output_folder]) != self.output_folder:
+            raise ValueError(f'{path} is outside the service output folder {self.output_folder}')
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        return full
+
+    @staticmethod
+    def _reply(result):
+        out = result.to_dict()
+        if result.plan is not None:
+            out['plan'] = result.plan.diff.to_dict('records')
+        return out
+
+    def _do_bulk(self, op, req):
+        if req.get('file'):
+            chunks = iter_excel_chunks(req['file'], int(req.get('chunk_rows') or EXCEL_CHUNK_ROWS))
+        else:
+            chunks = [pd.DataFrame(req.get('rows') or [], dtype=object)]
+        plan_file = self._output_path(req['plan_file']) if req.get('plan_file') else None
+        result = self._engine(req).run(op, chunks, dry_run=bool(req.get('dry_run')))
+        if plan_file and result.plan is not None:
+            result.plan.save(plan_file)
+        return self._reply(result)
+
+    def _do_apply(self, op, req):
+        if req.get('file'):
+            plan = ChangePlan.load(req['file'])
+        else:
+            plan = ChangePlan(pd.DataFrame(req.get('plan') or [], columns=ChangePlan.COLUMNS, dtype=object))
+        return self._reply(self._engine(req).apply_plan(plan))
+
+    def _do_batch(self, op, req):
+        checkpoint = req.get('checkpoint')
+        if not checkpoint:
+            # not next to the inputs as run_batch would: one per source in the output folder
+            source = os.path.abspath(req['source'])
+            name = os.path.splitext(os.path.basename(source))[0]
+            checkpoint = f"{name}-{hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]}.checkpoint.csv"
+        spec = BatchSpec(req['source'], self._output_path(checkpoint), bool(req.get('keep_going')),
+                         int(req.get('commit_every') or BATCH_COMMIT_FILES))
+        return self._reply(self._engine(req).run_batch(spec))
+
+    def _do_refresh(self, op, req):
+        try:
+            return {'reloaded': self.schema.refresh(changed_only=True)}
+        finally:
+            METRICS.flush('refresh')
+
+    def _do_lookup(self, op, req):
+        return bundle_records(self.schema.get_device_bundles(req.get('keys') or []))
+
+    def _do_export(self, op, req):
+        spec = ExportSpec(self._output_path(req['path']), keys=req.get('keys'), filters=[tuple(f) for f in req.get('filters') or []],
+                          tables=req.get('tables'), columns=req.get('columns'))
+        return self._reply(self._engine(req).export(spec))
+
+    def _do_status(self, op, req):
+        return {'data_folder': self.schema.data_folder, 'queued_writes': self.writes.qsize(),
+                'tables': {norm: len(df) for norm, (df, _) in ((t, self.schema.peek(t)) for t in self.schema.tables.keys())}}
+
+
+SERVICE_TOKEN_HEADER = 'X-Whatsup-Token'
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    # GET /status, POST /<operation> with a JSON body; replies are JSON
+    def do_GET(self):
+        refused = self._refused()
+        if refused:
+            return self._send(*refused)
+        if self.path.strip('/') != 'status':
+            return self._send(404, {'error': 'use POST /<operation> or GET /status'})
+        self._send(*self.server.service.handle('status', {}))
+
+    def _refused(self):
+        # the API is for tools on this machine (or holding the token), not for web pages:
+        # a browser marks cross-site requests with Origin, and a page on a rebound DNS name
+        # still sends that name as Host
+        if self.headers.get('Origin') is not None:
+            return 403, {'error': 'cross-origin requests are not accepted'}
+        host = self.headers.get('Host') or ''
+        try:
+            name = urllib.parse.urlsplit('//' + host).hostname or ''
+        except ValueError:
+            name = ''
+        if name not in self.server.host_names:
+            try:
+                ipaddress.ip_address(name)
+            except ValueError:
+                return 403, {'error': f'unexpected Host: {host}'}
+        token = self.server.token
+        if token and not hmac.compare_digest(self.headers.get(SERVICE_TOKEN_HEADER, '').encode('utf-8'),
+                                             token.encode('utf-8')):
+            return 401, {'error': f'missing or wrong {SERVICE_TOKEN_HEADER}'}
+        return None
+
+    def do_POST(self):
+        refused = self._refused()
+        if not refused and self.headers.get_content_type() != 'application/json':
+            refused = 415, {'error': 'the request body must be application/json'}
+        if refused:
+            self.close_connection = True   # the body is left unread
+            return self._send(*refused)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            req = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            return self._send(400, {'error': f'bad JSON: {e}'})
+        if not isinstance(req, dict):
+            return self._send(400, {'error': 'the request body must be a JSON object'})
+        self._send(*self.server.service.handle(self.path.strip('/'), req))
+
+    def _send(self, status, reply):
+        body = json.dumps(reply, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'local'   # '' on a Unix socket
+
+
+class _UnixServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def service_server(service, address=SERVICE_LISTEN, token=SERVICE_TOKEN):
+    """The HTTP server of `service` (BulkService) on HOST:PORT or unix:PATH, not yet serving.
+
+    Requests must come without an Origin header, name this machine in Host (an IP
+    address, localhost or its host name) and, with a `token`, carry it in
+    X-Whatsup-Token. Listening on anything but a loopback address needs a token."""
+    names = {'localhost', socket.gethostname().lower(), socket.getfqdn().lower()}
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path): os.remove(path)   # left over from a previous run
+        server = _UnixServiceServer(path, _ServiceHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        host = host or '127.0.0.1'
+        if not token and not _is_loopback(host):
+            raise BulkError(f'Listening on {host} needs a service token (set WHATSUP_SERVICE_TOKEN).')
+        server = ThreadingHTTPServer((host.strip('[]'), int(port)), _ServiceHandler)
+        server.daemon_threads = True
+        names.add(host.strip('[]').lower())
+    server.service = service
+    server.token = token
+    server.host_names = names
+    return server
+
+
+def serve(service, address=SERVICE_LISTEN, token=SERVICE_TOKEN):
+    """Serve `service` on `address` until interrupted (see service_server)."""
+    server = service_server(service, address, token)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None: self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient:
+    """The BulkEngine calls the UI and the CLI make (run, apply_plan, export, run_batch) plus
+    lookup, carried out by a running service at `url` (http://HOST:PORT or
+    unix:PATH). Input files are sent as paths, DataFrames as rows; files the service
+    writes (exports, batch checkpoints) must be in its output folder, and relative
+    paths are taken from there. Progress and cancel are not supported, the call
+    returns when the service is done. Defaults given here replace the service's
+    own for this client's inserts."""
+    def __init__(self, url, validate=VALIDATE_INPUT, timeout=None, user_defaults=None, default_child_rows=None,
+                 token=SERVICE_TOKEN):
+        self.url, self.validate, self.timeout, self.token = url, validate, timeout, token
+        self.user_defaults, self.default_child_rows = user_defaults, default_child_rows
+
+    def _connect(self):
+        if self.url.startswith('unix:'):
+            return _UnixHTTPConnection(self.url[len('unix:'):], self.timeout)
+        u = urllib.parse.urlsplit(self.url if '//' in self.url else 'http://' + self.url)
+        return http.client.HTTPConnection(u.hostname or '127.0.0.1', u.port or 80, timeout=self.timeout)
+
+    def request(self, op, body=None):
+        """POST `body` to /op (GET /op without one); returns the JSON reply."""
+        conn = self._connect()
+        try:
+            data = None if body is None else json.dumps(body, ensure_ascii=False, default=str).encode('utf-8')
+            headers = {'Content-Type': 'application/json'}
+            if self.token: headers[SERVICE_TOKEN_HEADER] = self.token
+            conn.request('GET' if body is None else 'POST', '/' + op, data, headers)
+            resp = conn.getresponse()
+            reply = json.loads(resp.read() or b'{}')
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise BulkError(f'No answer from the service at {self.url}: {e}') from e
+        finally:
+            conn.close()
+        if resp.status == 422:
+            raise ValidationError(ValidationReport(pd.DataFrame(reply.get('problems') or [], columns=ValidationReport.COLUMNS)))
+        if resp.status != 200:
+            raise BulkError(reply.get('error') or f'Service error {resp.status}')
+        return reply
+
+    @staticmethod
+    def _result(reply):
+        plan = reply.pop('plan', None)
+        result = BulkResult(**{k: v for k, v in reply.items() if k in BulkResult.__dataclass_fields__})
+        if plan is not None:
+            result.plan = ChangePlan(pd.DataFrame(plan, columns=ChangePlan.COLUMNS, dtype=object))
+        return result
+
+    def run(self, op, chunks, progress=None, cancel=None, dry_run=False, chunk_rows=EXCEL_CHUNK_ROWS) -> BulkResult:
+        """Like BulkEngine.run; `chunks` may also be the path of the input file."""
+        body = {'dry_run': dry_run, 'validate': self.validate, 'chunk_rows': chunk_rows,
+                'user_defaults': self.user_defaults, 'default_child_rows': self.default_child_rows}
+        if isinstance(chunks, str):
+            body['file'] = os.path.abspath(chunks)
+        else:
+            frames = [c for c in chunks if len(c)]
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            body['rows'] = df.astype(object).where(df.notna(), None).to_dict('records')
+        return self._result(self.request(op, body))
+
+    def apply_plan(self, plan, cancel=None) -> BulkResult:
+        return self._result(self.request('apply', {'plan': plan.diff.to_dict('records'), 'validate': self.validate}))
+
+    def export(self, spec, progress=None, cancel=None) -> BulkResult:
+        if callable(spec.columns):
+            raise BulkError('A service export takes the columns as a dict (table -> columns), not a callable.')
+        return self._result(self.request('export', {'path': spec.path, 'keys': spec.keys,
+                                                    'filters': spec.filters, 'tables': spec.tables, 'columns': spec.columns}))
+
+    def run_batch(self, spec, progress=None, cancel=None) -> BulkResult:
+        return self._result(self.request('batch', {'source': os.path.abspath(spec.source), 'keep_going': spec.keep_going,
+                                                   'checkpoint': spec.checkpoint,
+                                                   'commit_every': spec.commit_every, 'validate': self.validate,
+                                                   'user_defaults': self.user_defaults,
+                                                   'default_child_rows': self.default_child_rows}))
+
+    def lookup(self, keys):
+        """get_device_bundles() as dict table -> DataFrame of text."""
+        reply = self.request('lookup', {'keys': list(keys)})
+        return {norm: pd.DataFrame(rows, dtype=object) for norm, rows in reply.items()}
+
+# ----- Application UI -----
+class DeviceBulkApp(tk.Tk):
+    def __init__(self, schema: DeviceSchema, service=None):
+        """With `service` (a ServiceClient) bulk operations and exports are carried out
+        by the service; this window's own schema only serves browsing and dialogs."""
+        super().__init__()
+        self.schema = schema
+        self.service = service
+        self.root_norm = normalize_table_name(schema.root_table)
+        if self.root_norm not in self.schema.tables:
+            messagebox.showerror("Error", f"Device CSV not found in {schema.data_folder}")
+            self.destroy(); return
+        self.user_defaults = self._load_user_defaults()
+        self.visibility = self._load_visibility()
+        self.default_child_rows = self._load_default_child_rows()
+        self._build_ui()
+
+    @property
+    def detected_defaults(self):
+        # computed on first use (and cached by the schema): it needs every column loaded
+        return self.schema.detect_defaults()
+
+    def _load_user_defaults(self):
+        return load_json_file(DEFAULTS_FILE)
+
+    def _load_visibility(self):
+        return load_json_file(VISIBILITY_FILE)
+
+    def _load_default_child_rows(self):
+        return load_json_file(DEFAULT_CHILD_ROWS_FILE)
+
+    def _save_default_child_rows(self):
+        try:
+            with open(DEFAULT_CHILD_ROWS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(self.default_child_rows, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            messagebox.showerror("Save error", str(e))
+
+    def _build_ui(self):
+        self.title("Device bulk manager")
+        self.geometry('900x700')
+        top = ttk.Frame(self); top.pack(fill='x', padx=6, pady=6)
+        # buttons that must not be used while a job is running
+        self.job_buttons = [
+            ttk.Button(top, text='Bulk Insert (Excel)', command=self.bulk_insert_dialog),
+            ttk.Button(top, text='Bulk Update (Excel)', command=self.bulk_update_dialog),
+            ttk.Button(top, text='Bulk Upsert (Excel)', command=self.bulk_upsert_dialog),
+            ttk.Button(top, text='Bulk Delete (Excel)', command=self.bulk_delete_dialog),
+            ttk.Button(top, text='Apply saved plan', command=self.apply_plan_dialog),
+            ttk.Button(top, text='Batch (folder)', command=self.batch_dialog),
+            ttk.Button(top, text='Export (Excel/CSV)', command=self.export_dialog),
+            ttk.Button(top, text='Manage default child rows', command=self._manage_default_child_rows),
+        ]
+        for b in self.job_buttons: b.pack(side='left', padx=6)
+        right = [
+            ttk.Button(top, text='Browse data', command=self._open_browser),
+            ttk.Button(top, text='Show/Hide fields', command=self._open_visibility_editor),
+            ttk.Button(top, text='Reload changed CSVs', command=self._refresh_tables),
+            ttk.Button(top, text='Edit defaults', command=self._open_defaults_editor),
+        ]
+        for b in right: b.pack(side='right', padx=6)
+        self.job_buttons += right
+        self.dry_run = tk.BooleanVar(value=False)
+        preview = ttk.Checkbutton(top, text='Dry run', variable=self.dry_run)
+        preview.pack(side='left', padx=6)
+        ToolTip(preview, 'Compute the changes and show them without writing; the plan can be saved and applied.')
+        self.job_buttons.append(preview)
+        info = ttk.Label(self, text='Bulk operations write all tables or none; an interrupted run is completed on next start.')
+        info.pack(fill='x', padx=6)
+
+        # small status area
+        self.status = tk.StringVar(value='Ready')
+        ttk.Label(self, textvariable=self.status).pack(fill='x', padx=6, pady=(6,0))
+        prog = ttk.Frame(self); prog.pack(fill='x', padx=6, pady=4)
+        self.progress = ttk.Progressbar(prog, mode='determinate')
+        self.progress.pack(side='left', fill='x', expand=True)
+        self.cancel_button = ttk.Button(prog, text='Cancel', command=self._cancel_job, state='disabled')
+        self.cancel_button.pack(side='left', padx=6)
+        self.job = None
+        self.browser = None
+
+    # ---------- Bulk operations ----------
+    def bulk_insert_dialog(self):
+        path = filedialog.askopenfilename(title='Select Excel for bulk insert', filetypes=[('Excel', '*.xlsx;*.xls')])
+        if not path: return
+        self._run_bulk_file('Bulk insert', 'insert', path)
+
+    def bulk_update_dialog(self):
+        path = filedialog.askopenfilename(title='Select Excel for bulk update', filetypes=[('Excel', '*.xlsx;*.xls')])
+        if not path: return
+        self._run_bulk_file('Bulk update', 'update', path)
+
+    def bulk_upsert_dialog(self):
+        path = filedialog.askopenfilename(title='Select Excel for bulk upsert (new and existing devices)', filetypes=[('Excel', '*.xlsx;*.xls')])
+        if not path: return
+        self._run_bulk_file('Bulk upsert', 'upsert', path)
+
+    def bulk_delete_dialog(self):
+        path = filedialog.askopenfilename(title='Select Excel for bulk delete (device PK list expected)', filetypes=[('Excel', '*.xlsx;*.xls')])
+        if not path: return
+        self._run_bulk_file('Bulk delete', 'delete', path)
+
+    def batch_dialog(self):
+        folder = filedialog.askdirectory(title='Select the folder of Excel files (names tagged insert/update/upsert/delete)')
+        if not folder: return
+        self._run_bulk('Batch', 'batch', BatchSpec(folder), source=os.path.basename(folder))
+
+    def apply_plan_dialog(self):
+        path = filedialog.askopenfilename(title='Select a saved change plan', filetypes=[('CSV', '*.csv')])
+        if not path: return
+        try:
+            plan = ChangePlan.load(path)
+        except BulkError as e:
+            messagebox.showerror('Apply plan', str(e)); return
+        self._run_bulk('Apply plan', 'apply', plan, source=os.path.basename(path))
+
+    def export_dialog(self, keys=None, title='Export devices'):
+        """Export every device (or those with `keys`) with their child rows, leaving out
+        hidden tables and columns; the file can be edited and fed back to Bulk Update."""
+        path = filedialog.asksaveasfilename(title=title, defaultextension='.xlsx',
+                                            filetypes=[('Excel', '*.xlsx'), ('CSV', '*.csv')])
+        if not path: return
+        tables = [t for t in self.schema.tables.keys() if self.visibility.get(t, {}).get('__table_visible', True)]
+        project = hidden_columns_projection(self.visibility)
+        columns = {t: project(t, self.schema.columns(t)) for t in tables}
+        spec = ExportSpec(path, keys=keys, tables=[t for t in tables if t != self.root_norm],
+                          columns={t: c for t, c in columns.items() if c is not None})
+        total = len(keys) if keys is not None else len(self.schema.peek(normalize_table_name(self.schema.root_table))[0])
+        self._run_bulk(title, 'export', spec, total, os.path.basename(path))
+
+    def _engine(self):
+        if self.service is not None:
+            self.service.user_defaults, self.service.default_child_rows = self.user_defaults, self.default_child_rows
+            return self.service
+        return BulkEngine(self.schema, self.user_defaults, None, self.default_child_rows)
+
+    def _run_bulk(self, title, op, chunks, total_rows=None, source=''):
+        """Run a bulk operation on a worker thread; the UI stays responsive and
+        polls the job's event queue. Only one job runs at a time."""
+        if self.job is not None: return
+        dry_run = op in BULK_OPS and self.dry_run.get()
+        if dry_run:
+            title += ' (dry run)'
+        engine = self._engine()
+        self.job = BulkJob(engine, op, chunks, dry_run=dry_run)
+        self.job.title, self.job.source, self.job.total_rows = title, source, total_rows
+        for b in self.job_buttons: b.configure(state='disabled')
+        # a service job can't be cancelled and reports no progress
+        self.cancel_button.configure(state='normal' if self.service is None else 'disabled')
+        if total_rows and self.service is None:
+            self.progress.configure(mode='determinate', maximum=total_rows, value=0)
+        else:
+            self.progress.configure(mode='indeterminate'); self.progress.start(50)
+        self.status.set(f'{title}: reading {source}' if source else f'{title}: running')
+        self.job.start()
+        self.after(JOB_POLL_MS, self._poll_job)
+
+    def _poll_job(self):
+        job = self.job
+        if job is None: return
+        last = None
+        for kind, payload in job.drain():
+            if kind == 'progress':
+                last = payload
+            else:
+                self._finish_job(kind, payload); return
+        if last is not None:
+            rows, chunks = last
+            if job.total_rows: self.progress.configure(value=rows)
+            self.status.set(f'{job.title}: {rows} rows processed' + (f' from {job.source}' if job.source else '') + f' (chunk {chunks})')
+        self.after(JOB_POLL_MS, self._poll_job)
+
+    def _finish_job(self, kind, payload):
+        title = self.job.title
+        self.job = None
+        changed = kind == 'done' and not payload.dry_run and payload.op != 'export'
+        if changed and self.service is not None:
+            self.schema.refresh(changed_only=True)   # the service wrote the CSVs
+        if changed and self.browser is not None and self.browser.winfo_exists():
+            self.browser.reload()
+        self.progress.stop(); self.progress.configure(mode='determinate', value=0)
+        self.cancel_button.configure(state='disabled')
+        for b in self.job_buttons: b.configure(state='normal')
+        if kind == 'cancelled':
+            self.status.set(f'{title}: cancelled, nothing was written.'); return
+        if kind == 'error' and isinstance(payload, ValidationError):
+            self.status.set(f'{title}: input rejected, nothing was written.')
+            if messagebox.askyesno(title, str(payload) + '\n\nSave the full error report (CSV)?', icon='error'):
+                path = filedialog.asksaveasfilename(title='Save error report', defaultextension='.csv', filetypes=[('CSV', '*.csv')])
+                if path: payload.report.save(path)
+            return
+        if kind == 'error':
+            self.status.set(f'{title}: failed.')
+            messagebox.showerror(title, str(payload)); return
+        result = payload
+        if result.warnings:
+            messagebox.showwarning(title, '\n'.join(result.warnings))
+        self.status.set(result.summary())
+        if result.dry_run:
+            return self._review_plan(title, result)
+        if result.devices or result.child_rows or result.changes or result.files or result.entries:
+            messagebox.showinfo(title, result.summary())
+
+    def _review_plan(self, title, result):
+        # after a dry run: optionally save the diff, then optionally apply it
+        if not len(result.plan):
+            messagebox.showinfo(title, 'Dry run: nothing would change.'); return
+        if messagebox.askyesno(title, result.summary() + '\n\nSave the change plan (diff CSV)?'):
+            path = filedialog.asksaveasfilename(title='Save change plan', defaultextension='.csv', filetypes=[('CSV', '*.csv')])
+            if path: result.plan.save(path)
+        if messagebox.askyesno(title, 'Apply these changes now?'):
+            self._run_bulk(title.replace('(dry run)', '').strip(), 'apply', result.plan, source='plan')
+
+    def _cancel_job(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.status.set(f'{self.job.title}: cancelling after the current chunk...')
+
+    def _run_bulk_file(self, title, op, path):
+        # stream the sheet chunk by chunk; progress is reported per chunk
+        # (a service reads the file itself)
+        chunks = path if self.service is not None else iter_excel_chunks(path)
+        return self._run_bulk(title, op, chunks, excel_row_count(path), os.path.basename(path))
+
+    def bulk_insert_from_df(self, exdf: pd.DataFrame):
+        return self._run_bulk('Bulk insert', 'insert', [exdf], len(exdf))
+
+    def bulk_update_from_df(self, exdf: pd.DataFrame):
+        return self._run_bulk('Bulk update', 'update', [exdf], len(exdf))
+
+    def bulk_upsert_from_df(self, exdf: pd.DataFrame):
+        return self._run_bulk('Bulk upsert', 'upsert', [exdf], len(exdf))
+
+    def bulk_delete_from_df(self, exdf: pd.DataFrame):
+        return self._run_bulk('Bulk delete', 'delete', [exdf], len(exdf))
+
+    def _refresh_tables(self):
+        reloaded = self.schema.refresh(changed_only=True)
+        self.status.set('Reloaded: ' + ', '.join(sorted(reloaded)) if reloaded else 'All tables up to date.')
+
+    # ---------- default child rows manager ----------
+    def _manage_default_child_rows(self):
+        dialog = DefaultChildRowsDialog(self, 'Manage default child rows', list(self.schema.tables.keys()), self.default_child_rows)
+        if dialog.ok:
+            self.default_child_rows = dialog.result
+            self._save_default_child_rows()
+            messagebox.showinfo('Defaults', 'Default child row templates saved.')
+
+    # ---------- UI helpers (visibility, defaults) ----------
+    def _open_visibility_editor(self):
+        dialog = VisibilityDialog(self, 'Show/Hide fields + tables', list(self.schema.tables.keys()), self.schema, self.visibility)
+        if dialog.ok:
+            self.visibility = dialog.result
+            with open(VISIBILITY_FILE, 'w', encoding='utf-8') as f:
+                json.dump(self.visibility, f, indent=2, ensure_ascii=False)
+            messagebox.showinfo('Visibility', 'Saved.')
+
+    def _open_browser(self):
+        if self.browser is not None and self.browser.winfo_exists():
+            self.browser.lift(); return
+        self.browser = DataBrowser(self, self.schema, self.visibility)
+
+    def _open_defaults_editor(self):
+        # defaults and statistics are computed per table as it is opened in the editor
+        dialog = DefaultsEditor(self, 'Edit defaults', list(self.schema.tables.keys()), self.schema.table_defaults,
+                                self.user_defaults, stats=self.schema.column_summary)
+        if dialog.ok:
+            self.user_defaults = dialog.result
+            with open(DEFAULTS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(self.user_defaults, f, indent=2, ensure_ascii=False)
+            messagebox.showinfo('Defaults', 'Saved.')
+
+# ---------- Data browser ----------
+class TableView:
+    """Filtered, sorted window onto one table, for the data browser.
+
+    Filtering and sorting run in pandas over the whole table and leave an array of
+    row positions; only the rows of the page being shown are ever formatted. The
+    sort order of a column is computed once and reused. The schema's indexes are
+    only used under its read lock, since a commit on the worker thread remaps them.
+    """
+    def __init__(self, schema, norm, columns=None):
+        self.schema, self.norm = schema, norm
+        with schema.lock.read():
+            df, _ = schema.peek(norm)
+            if columns is not None and any(c not in df.columns for c in columns):
+                df, _ = schema.tables[norm]   # a hidden-column projection may lack some
+        self.df = df
+        self.columns = [c for c in (columns if columns is not None else df.columns) if c in df.columns]
+        self.title = norm
+        self.restriction = None   # (column, keys) from a drill-down
+        self.filter = None        # (column, text, exact)
+        self.sort = None          # (column, ascending)
+        self._base = None
+        self._mask = None
+        self._orders = {}
+        self.rows = np.arange(len(df))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def restrict(self, column, keys):
+        """Only rows whose `column` is one of `keys` (the child rows of a parent row)."""
+        self.restriction = (column, list(keys))
+        with self.schema.lock.read():
+            if self.df is self.schema.peek(self.norm)[0]:
+                self._base = np.zeros(len(self.df), dtype=bool)
+                self._base[self.schema.fk_index(self.norm, column).rows(keys)] = True
+            else:
+                self._base = key_isin(self.df[column], keys)
+        self._update()
+
+    def set_filter(self, column, text, exact=False):
+        """Rows whose `column` equals `text` (exact) or contains it, ignoring case."""
+        self.filter = (column, text, exact) if text else None
+        if not text:
+            self._mask = None
+        elif exact and column == self.df.columns[0]:
+            with self.schema.lock.read():
+                if self.df is self.schema.peek(self.norm)[0]:
+                    pos = self.schema.lookup_rows(self.norm, [text])   # PK index
+                    self._mask = np.zeros(len(self.df), dtype=bool)
+                    self._mask[pos[pos >= 0]] = True
+                else:
+                    self._mask = text_match(self.df[column], text, exact)
+        else:
+            self._mask = text_match(self.df[column], text, exact)
+        self._update()
+
+    def sort_by(self, column, ascending=True):
+        self.sort = (column, ascending) if column else None
+        self._update()
+
+    def _order(self, column):
+        order = self._orders.get(column)
+        if order is None:
+            s = self.df[column].reset_index(drop=True)
+            if not isinstance(s.dtype, pd.Int64Dtype):
+                t = text_values(s)
+                num = pd.to_numeric(t, errors='coerce')
+                # numeric order when every non-blank value is a number
+                s = num if num.notna().sum() == int((t != '').sum()) else t
+            order = s.sort_values(kind='stable', na_position='last').index.to_numpy()
+            self._orders[column] = order
+        return order
+
+    def _update(self):
+        keep = np.ones(len(self.df), dtype=bool)
+        if self._base is not None: keep &= self._base
+        if self._mask is not None: keep &= self._mask
+        if self.sort:
+            column, ascending = self.sort
+            order = self._order(column)
+            if not ascending: order = order[::-1]
+            self.rows = order[keep[order]]
+        else:
+            self.rows = np.flatnonzero(keep)
+
+    def page(self, start, count):
+        """(row positions, rows as tuples of text) for rows start .. start+count."""
+        pos = self.rows[start:start + count]
+        sub = self.df.iloc[pos]
+        cols = [text_values(sub[c]).to_numpy() for c in self.columns]
+        return pos, list(zip(*cols)) if cols else [() for _ in pos]
+
+    def value(self, pos, column):
+        return text_values(self.df[column].iloc[[pos]]).iloc[0]
+
+    def reloaded(self):
+        """A fresh view of the current table with the same restriction, filter and sort."""
+        view = TableView(self.schema, self.norm, self.columns)
+        view.title = self.title
+        if self.restriction: view.restrict(*self.restriction)
+        if self.filter: view.set_filter(*self.filter)
+        if self.sort: view.sort_by(*self.sort)
+        return view
+
+
+class DataBrowser(tk.Toplevel):
+    """Virtual-scrolling view of the schema tables. The Treeview only ever holds the
+    rows that fit on screen and is refilled as the scrollbar moves, so the size of
+    the table doesn't matter. Hidden tables and columns (VisibilityDialog) are left out."""
+    def __init__(self, parent, schema: DeviceSchema, visibility):
+        super().__init__(parent); self.title('Browse tables'); self.geometry('1100x650')
+        self.schema, self.visibility = schema, visibility or {}
+        self.view = None; self.top = 0; self.history = []; self.positions = []
+        bar = ttk.Frame(self); bar.pack(fill='x', padx=6, pady=(6, 0))
+        ttk.Label(bar, text='Table:').pack(side='left')
+        self.table_box = ttk.Combobox(bar, state='readonly', width=32, values=self._tables())
+        self.table_box.pack(side='left', padx=4)
+        self.table_box.bind('<<ComboboxSelected>>', lambda e: self.open_table(self.table_box.get()))
+        ttk.Label(bar, text='Filter:').pack(side='left', padx=(12, 0))
+        self.filter_col = ttk.Combobox(bar, state='readonly', width=24)
+        self.filter_col.pack(side='left', padx=4)
+        self.filter_text = ttk.Entry(bar, width=24); self.filter_text.pack(side='left', padx=4)
+        self.filter_text.bind('<Return>', lambda e: self._apply_filter())
+        self.exact = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bar, text='Exact', variable=self.exact).pack(side='left')
+        ttk.Button(bar, text='Apply', command=self._apply_filter).pack(side='left', padx=4)
+        ttk.Button(bar, text='Clear', command=self._clear_filter).pack(side='left')
+        nav = ttk.Frame(self); nav.pack(fill='x', padx=6, pady=6)
+        self.back_button = ttk.Button(nav, text='Back', command=self._back, state='disabled')
+        self.back_button.pack(side='left')
+        ttk.Label(nav, text='Child table:').pack(side='left', padx=(12, 0))
+        self.child_box = ttk.Combobox(nav, state='readonly', width=44)
+        self.child_box.pack(side='left', padx=4)
+        ttk.Button(nav, text='Show child rows', command=self._drill).pack(side='left')
+        self.export_button = ttk.Button(nav, text='Export these devices', command=self._export)
+        self.export_button.pack(side='left', padx=(12, 0))
+        ToolTip(self.export_button, 'Export the devices listed (as filtered) with their child rows, for Bulk Update.')
+        self.info = tk.StringVar()
+        ttk.Label(nav, textvariable=self.info).pack(side='right')
+        body = ttk.Frame(self); body.pack(fill='both', expand=True, padx=6, pady=(0, 6))
+        self.tree = ttk.Treeview(body, show='headings', selectmode='browse')
+        self.vbar = ttk.Scrollbar(body, orient='vertical', command=self._on_scroll)
+        hbar = ttk.Scrollbar(body, orient='horizontal', command=self.tree.xview)
+        self.tree.configure(xscrollcommand=hbar.set)
+        self.tree.grid(row=0, column=0, sticky='nsew'); self.vbar.grid(row=0, column=1, sticky='ns')
+        hbar.grid(row=1, column=0, sticky='ew')
+        body.rowconfigure(0, weight=1); body.columnconfigure(0, weight=1)
+        self.tree.bind('<Configure>', lambda e: self._render())
+        for seq in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.tree.bind(seq, self._on_wheel)
+        for seq, step in (('<Prior>', -1), ('<Next>', 1)):
+            self.tree.bind(seq, lambda e, s=step: self._on_scroll('scroll', s, 'pages'))
+        self.tree.bind('<Double-1>', lambda e: self._drill())
+        tables = self._tables()
+        if tables:
+            self.open_table(tables[0])
+
+    def _tables(self):
+        order = self.schema.graph.order(normalize_table_name(self.schema.root_table))
+        names = [t for t in order if t in self.schema.tables]
+        names += [t for t in self.schema.tables.keys() if t not in names]
+        return [t for t in names if self.visibility.get(t, {}).get('__table_visible', True)]
+
+    def _columns(self, norm):
+        vis = self.visibility.get(norm, {})
+        return [c for c in self.schema.columns(norm) if vis.get(c, True)]
+
+    def open_table(self, norm, restrict=None, title=None):
+        self.configure(cursor='watch'); self.update_idletasks()
+        try:
+            view = TableView(self.schema, norm, self._columns(norm))
+            if restrict:
+                view.restrict(*restrict)
+                view.title = title or norm
+        finally:
+            self.configure(cursor='')
+        self._show(view)
+
+    def _show(self, view, top=0):
+        self.view, self.top = view, top
+        self.table_box.set(view.norm)
+        self.tree.delete(*self.tree.get_children())
+        self.tree['columns'] = view.columns
+        for c in view.columns:
+            mark = ''
+            if view.sort and view.sort[0] == c: mark = ' \u25b2' if view.sort[1] else ' \u25bc'
+            self.tree.heading(c, text=human_label(c) + mark, command=lambda c=c: self._sort(c))
+            self.tree.column(c, width=130, stretch=False)
+        self.filter_col.configure(values=view.columns)
+        if view.columns and self.filter_col.get() not in view.columns:
+            self.filter_col.set(view.columns[0])
+        tables = set(self._tables())
+        self.children_rel = [m for m in self.schema.graph.children.get(view.norm, []) if m['Parent_norm'] in tables]
+        labels = [f"{m['Parent_norm']} ({m['ParentColumn']})" for m in self.children_rel]
+        self.child_box.configure(values=labels)
+        self.child_box.set(labels[0] if labels else '')
+        self.back_button.configure(state='normal' if self.history else 'disabled')
+        root = view.norm == normalize_table_name(self.schema.root_table)
+        self.export_button.configure(state='normal' if root and hasattr(self.master, 'export_dialog') else 'disabled')
+        self._render()
+
+    def _page_rows(self):
+        try:
+            height = int(ttk.Style().lookup('Treeview', 'rowheight') or 20)
+        except (TypeError, ValueError):
+            height = 20
+        return max(1, (self.tree.winfo_height() - 28) // height)
+
+    def _render(self):
+        view = self.view
+        if view is None: return
+        n, total = self._page_rows(), len(view)
+        self.top = max(0, min(self.top, total - n))
+        self.positions, rows = view.page(self.top, n)
+        items = self.tree.get_children()
+        for i in range(len(items), len(rows)):
+            self.tree.insert('', 'end', iid=f'r{i}')
+        if len(items) > len(rows):
+            self.tree.delete(*items[len(rows):])
+        for i, values in enumerate(rows):
+            self.tree.item(f'r{i}', values=values)
+        if total:
+            self.vbar.set(self.top / total, (self.top + len(rows)) / total)
+            self.info.set(f'{view.title}: rows {self.top + 1:,}-{self.top + len(rows):,} of {total:,}')
+        else:
+            self.vbar.set(0, 1); self.info.set(f'{view.title}: no rows')
+
+    def _on_scroll(self, action, amount, unit=None):
+        if self.view is None: return
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.view))
+        else:
+            self.top += int(amount) * (self._page_rows() if unit == 'pages' else 1)
+        self._render()
+        return 'break'
+
+    def _on_wheel(self, e):
+        up = getattr(e, 'num', None) == 4 or getattr(e, 'delta', 0) > 0
+        return self._on_scroll('scroll', -3 if up else 3)
+
+    def _sort(self, column):
+        view = self.view
+        ascending = not (view.sort == (column, True))
+        self.configure(cursor='watch'); self.update_idletasks()
+        try:
+            view.sort_by(column, ascending)
+        finally:
+            self.configure(cursor='')
+        self._show(view)
+
+    def _apply_filter(self):
+        if self.view is None or not self.filter_col.get(): return
+        self.view.set_filter(self.filter_col.get(), self.filter_text.get(), self.exact.get())
+        self._show(self.view)
+
+    def _clear_filter(self):
+        self.filter_text.delete(0, 'end')
+        if self.view is not None:
+            self.view.set_filter(None, '')
+            self._show(self.view)
+
+    def _drill(self):
+        sel = self.tree.selection()
+        label = self.child_box.get()
+        if not sel or not label:
+            self.info.set('Select a row and a child table first.'); return
+        m = self.children_rel[list(self.child_box['values']).index(label)]
+        pos = self.positions[int(sel[0][1:])]
+        ref = m['ReferencedColumn'] if m['ReferencedColumn'] in self.view.df.columns else self.view.df.columns[0]
+        key = self.view.value(pos, ref)
+        self.history.append((self.view, self.top))
+        self.open_table(m['Parent_norm'], (m['ParentColumn'], [key]), f"{m['Parent_norm']} where {m['ParentColumn']} = {key}")
+
+    def _export(self):
+        view = self.view
+        if view is None or not len(view): return
+        keys = text_values(view.df[view.df.columns[0]].iloc[view.rows]).tolist()
+        self.master.export_dialog(keys, f'Export {len(keys):,} devices')
+
+    def _back(self):
+        if self.history:
+            self._show(*self.history.pop())
+
+    def reload(self):
+        """Re-read the current view after the tables changed (drill-down history is dropped)."""
+        if self.view is None: return
+        self.history.clear()
+        self.table_box.configure(values=self._tables())
+        self._show(self.view.reloaded(), self.top)
+
+# ---------- Dialogs (Defaults, Visibility, DefaultChildRows) ----------
+class DefaultsEditor(tk.Toplevel):
+    """Defaults per table. Only the selected table's columns are listed (and their
+    detected defaults and statistics computed); tables never opened keep the
+    saved user defaults."""
+    def __init__(self, parent, title, tables, detected, user_defaults, stats=None):
+        # detected(table) -> {column: detected default}; stats(table, col) -> DeviceSchema.column_summary
+        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
+        self.result = {}; self.ok = False
+        self.detected, self.user_defaults, self.stats = detected, user_defaults, stats
+        self.values = {}   # table -> {column: text}, for the tables opened so far
+        self.table = None
+        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
+        self.tables = tk.Listbox(body, exportselection=False, width=28)
+        for t in tables: self.tables.insert('end', t)
+        self.tables.pack(side='left', fill='y')
+        self.tables.bind('<<ListboxSelect>>', lambda e: self._show_selected())
+        right = ttk.Frame(body); right.pack(side='left', fill='both', expand=True, padx=(8, 0))
+        cols = ('column', 'default', 'distinct', 'top')
+        self.tree = ttk.Treeview(right, columns=cols, show='headings', selectmode='browse', height=20)
+        for c, text, w in zip(cols, ('Column', 'Default', 'Distinct', 'Most common'), (180, 220, 70, 220)):
+            self.tree.heading(c, text=text); self.tree.column(c, width=w, stretch=c != 'distinct')
+        vs = ttk.Scrollbar(right, orient='vertical', command=self.tree.yview)
+        self.tree.configure(yscrollcommand=vs.set)
+        vs.pack(side='right', fill='y'); self.tree.pack(fill='both', expand=True)
+        self.tree.bind('<<TreeviewSelect>>', lambda e: self._load_entry())
+        edit = ttk.Frame(right); edit.pack(fill='x', pady=(6, 0))
+        ttk.Label(edit, text='Default:').pack(side='left')
+        self.entry = ttk.Entry(edit, width=60); self.entry.pack(side='left', padx=6, fill='x', expand=True)
+        self.entry.bind('<Return>', lambda e: self._set_value())
+        ttk.Button(edit, text='Set', command=self._set_value).pack(side='left')
+        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
+        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
+        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
+        if tables:
+            self.tables.selection_set(0); self._show_selected()
+        self.grab_set(); self.wait_window(self)
+    def _show_selected(self):
+        sel = self.tables.curselection()
+        if not sel: return
+        table = self.tables.get(sel[0])
+        if table not in self.values:
+            det, user = self.detected(table), self.user_defaults.get(table, {})
+            self.values[table] = {}
+            for col, d in det.items():
+                val = user.get(col, d if d is not None else '')
+                self.values[table][col] = '' if val is None else str(val)
+        self.table = table
+        self.tree.delete(*self.tree.get_children())
+        for col, val in self.values[table].items():
+            distinct = top = ''
+            if self.stats:
+                st = self.stats(table, col)
+                distinct = st['distinct']
+                if st['top'] is not None: top = f"{st['top']!r} ({st['top_count']})"
+            self.tree.insert('', 'end', iid=col, values=(human_label(col), val, distinct, top))
+        self.entry.delete(0, 'end')
+    def _load_entry(self):
+        sel = self.tree.selection()
+        if not sel: return
+        self.entry.delete(0, 'end'); self.entry.insert(0, self.values[self.table][sel[0]])
+    def _set_value(self):
+        sel = self.tree.selection()
+        if not sel or self.table is None: return
+        val = self.entry.get()
+        self.values[self.table][sel[0]] = val
+        self.tree.set(sel[0], 'default', val)
+    def on_ok(self):
+        res = {t: dict(v) for t, v in self.user_defaults.items()}
+        for table, colmap in self.values.items():
+            res[table] = {col: v.strip() for col, v in colmap.items() if v.strip() != ''}
+        self.result = res; self.ok = True; self.destroy()
+    def on_cancel(self):
+        self.ok = False; self.destroy()
+
+class VisibilityDialog(tk.Toplevel):
+    """Table and column visibility. Columns are listed for the selected table only;
+    double-click or Space toggles a column."""
+    def __init__(self, parent, title, table_list, schema: DeviceSchema, current_visibility):
+        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
+        self.result = {}; self.ok = False
+        self.schema = schema
+        self.tables_shown = [t for t in table_list if t in schema.tables]
+        # table -> {column or '__table_visible': bool}; columns not listed are visible
+        self.state = {t: dict(current_visibility.get(t, {})) for t in self.tables_shown}
+        self.table = None
+        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
+        self.tables = tk.Listbox(body, exportselection=False, width=28)
+        for t in self.tables_shown: self.tables.insert('end', t)
+        self.tables.pack(side='left', fill='y')
+        self.tables.bind('<<ListboxSelect>>', lambda e: self._show_selected())
+        right = ttk.Frame(body); right.pack(side='left', fill='both', expand=True, padx=(8, 0))
+        self.table_visible = tk.BooleanVar(value=True)
+        ttk.Checkbutton(right, text='Show this table', variable=self.table_visible,
+                        command=self._set_table_visible).pack(anchor='w')
+        self.tree = ttk.Treeview(right, columns=('column', 'visible'), show='headings', selectmode='extended', height=20)
+        self.tree.heading('column', text='Column'); self.tree.heading('visible', text='Visible')
+        self.tree.column('column', width=260); self.tree.column('visible', width=70, stretch=False)
+        vs = ttk.Scrollbar(right, orient='vertical', command=self.tree.yview)
+        self.tree.configure(yscrollcommand=vs.set)
+        vs.pack(side='right', fill='y'); self.tree.pack(fill='both', expand=True)
+        self.tree.bind('<Double-1>', lambda e: self._toggle())
+        self.tree.bind('<space>', lambda e: self._toggle())
+        row = ttk.Frame(right); row.pack(fill='x', pady=(6, 0))
+        ttk.Button(row, text='Show all', command=lambda: self._set_all(True)).pack(side='left')
+        ttk.Button(row, text='Hide all', command=lambda: self._set_all(False)).pack(side='left', padx=6)
+        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
+        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
+        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
+        if self.tables_shown:
+            self.tables.selection_set(0); self._show_selected()
+        self.grab_set(); self.wait_window(self)
+    def _show_selected(self):
+        sel = self.tables.curselection()
+        if not sel: return
+        self.table = self.tables.get(sel[0])
+        vis = self.state[self.table]
+        self.table_visible.set(vis.get('__table_visible', True))
+        self.tree.delete(*self.tree.get_children())
+        for col in self.schema.columns(self.table):
+            self.tree.insert('', 'end', iid=col, values=(human_label(col), 'yes' if vis.get(col, True) else 'no'))
+    def _set_table_visible(self):
+        if self.table is not None:
+            self.state[self.table]['__table_visible'] = bool(self.table_visible.get())
+    def _set(self, col, visible):
+        self.state[self.table][col] = visible
+        self.tree.set(col, 'visible', 'yes' if visible else 'no')
+    def _toggle(self):
+        for col in self.tree.selection():
+            self._set(col, not self.state[self.table].get(col, True))
+        return 'break'
+    def _set_all(self, visible):
+        if self.table is None: return
+        for col in self.tree.get_children():
+            self._set(col, visible)
+    def on_ok(self):
+        res = {}
+        for table, vis in self.state.items():
+            res[table] = {'__table_visible': bool(vis.get('__table_visible', True))}
+            for col in self.schema.columns(table):
+                res[table][col] = bool(vis.get(col, True))
+        self.result = res; self.ok = True; self.destroy()
+    def on_cancel(self):
+        self.ok = False; self.destroy()
+
+class DefaultChildRowsDialog(tk.Toplevel):
+    """Simple dialog to add/edit default child row templates."""
+    def __init__(self, parent, title, tables, current_templates):
+        super().__init__(parent); self.transient(parent); self.title(title); self.parent = parent
+        self.result = {}; self.ok = False
+        body = ttk.Frame(self); body.pack(padx=12, pady=12, fill='both', expand=True)
+        canvas = tk.Canvas(body, height=520); vs = ttk.Scrollbar(body, orient='vertical', command=canvas.yview)
+        canvas.configure(yscrollcommand=vs.set); vs.pack(side='right', fill='y'); canvas.pack(side='left', fill='both', expand=True)
+        inner = ttk.Frame(canvas); canvas.create_window((0,0), window=inner, anchor='nw')
+        def on_conf(e): canvas.configure(scrollregion=canvas.bbox('all'))
+        inner.bind('<Configure>', on_conf)
+        self.editors = {}
+        row = 0
+        for t in tables:
+            df, _ = parent.schema.tables.get(t, (None, None))
+            if df is None: continue
+            ttk.Label(inner, text=f'Table: {t}', font=('Segoe UI', 10, 'bold')).grid(row=row, column=0, sticky='w', pady=(8,4), padx=6); row+=1
+            # show existing templates as JSON text (simple UX)
+            txt = tk.Text(inner, height=4, width=80)
+            cur = current_templates.get(t, [])
+            txt.insert('1.0', json.dumps(cur, indent=2, ensure_ascii=False))
+            txt.grid(row=row, column=0, padx=6, pady=4)
+            self.editors[t] = txt
+            row += 1
+        btns = ttk.Frame(self); btns.pack(fill='x', pady=8)
+        ttk.Button(btns, text='OK', command=self.on_ok).pack(side='right', padx=6)
+        ttk.Button(btns, text='Cancel', command=self.on_cancel).pack(side='right')
+        self.grab_set(); self.wait_window(self)
+    def on_ok(self):
+        res = {}
+        try:
+            for t, txt in self.editors.items():
+                raw = txt.get('1.0', 'end').strip()
+                if raw:
+                    parsed = json.loads(raw)
+                    res[t] = parsed
+            self.result = res; self.ok = True; self.destroy()
+        except Exception as e:
+            messagebox.showerror('Parse error', f'Failed to parse JSON: {e}')
+    def on_cancel(self):
+        self.ok = False; self.destroy()
+
+# ---------- command line ----------
+def build_arg_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data-folder', default=DATA_FOLDER, help='folder holding the table CSVs')
+    common.add_argument('--relations', default=RELATION_FILE, help='path to relations.csv')
+    common.add_argument('--root-table', default=ROOT_TABLE)
+    common.add_argument('--defaults', default=DEFAULTS_FILE, help='user defaults JSON (as saved by the UI)')
+    common.add_argument('--child-rows', default=DEFAULT_CHILD_ROWS_FILE, help='default child-row templates JSON')
+    common.add_argument('--no-cache', action='store_true', help="don't use or write the binary table cache")
+    common.add_argument('--compact', action='store_true', default=COMPACT_TABLES, help='hold tables in compact dtypes to save memory')
+    common.add_argument('--json', action='store_true', help='print the result as JSON')
+    common.add_argument('--metrics', metavar='FILE', default=METRICS_FILE, help='append per-phase timings to FILE (JSON lines)')
+    common.add_argument('--profile', metavar='FILE', default=PROFILE_FILE, help='write cProfile stats of the run to FILE')
+    common.add_argument('--service', metavar='URL', default=SERVICE_URL,
+                        help='send the operation to a running `serve` (http://HOST:PORT or unix:PATH) instead of loading the CSVs')
+    parser = argparse.ArgumentParser(prog='whatsup', description='Headless bulk operations on the Device CSVs.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('insert', 'bulk insert devices from Excel'),
+                            ('update', 'bulk update devices from Excel'),
+                            ('upsert', 'insert new and update existing devices from one Excel sheet'),
+                            ('delete', 'bulk delete devices listed in Excel')):
+        p = sub.add_parser(name, parents=[common], help=help_text)
+        p.add_argument('excel', help='input .xlsx/.xls file (or .csv as written by export)')
+        p.add_argument('--chunk-rows', type=int, default=EXCEL_CHUNK_ROWS, help='Excel rows processed per chunk')
+        p.add_argument('--dry-run', action='store_true', help='compute the changes without writing anything')
+        p.add_argument('--plan', metavar='FILE', help='save the change plan (diff CSV) to FILE; implies --dry-run')
+        p.add_argument('--no-validate', dest='validate', action='store_false',
+                       help='skip the pre-flight input checks (bad rows are skipped or reported as warnings)')
+        p.add_argument('--report', metavar='FILE', help='if the input fails validation, write the error report CSV to FILE')
+    p = sub.add_parser('apply', parents=[common], help='apply a change plan saved with --plan')
+    p.add_argument('plan_file', help='change plan CSV')
+    p = sub.add_parser('lookup', parents=[common], help='print devices with all their child rows')
+    p.add_argument('keys', nargs='+', help='Device PKs')
+    p = sub.add_parser('batch', parents=[common], help='apply a folder or manifest of input files in order, writing each table once')
+    p.add_argument('source', help='folder of files tagged by name (e.g. 0412_update.xlsx), or a manifest CSV/JSON with file and op')
+    p.add_argument('--checkpoint', metavar='FILE', help='progress file (default: .whatsup_batch.csv in the folder, <manifest>.checkpoint.csv)')
+    p.add_argument('--keep-going', action='store_true', help='skip files that fail instead of stopping at the first one')
+    p.add_argument('--commit-every', type=int, default=BATCH_COMMIT_FILES, metavar='N',
+                   help='also write the tables after every N files (default: once, at the end)')
+    p.add_argument('--no-validate', dest='validate', action='store_false', help='skip the pre-flight input checks')
+    p = sub.add_parser('export', parents=[common], help='write devices and their child rows to .xlsx/.csv for Bulk Update')
+    p.add_argument('output', help='output .xlsx or .csv file')
+    p.add_argument('--keys', nargs='+', metavar='PK', help='export only these Device PKs')
+    p.add_argument('--keys-file', metavar='FILE', help='export only the Device PKs listed in FILE (one per line)')
+    p.add_argument('--where', nargs='+', default=[], metavar='COLUMN=TEXT', help='only devices whose COLUMN equals TEXT')
+    p.add_argument('--contains', nargs='+', default=[], metavar='COLUMN=TEXT',
+                   help='only devices whose COLUMN contains TEXT (ignoring case)')
+    p.add_argument('--tables', nargs='+', help='child tables to include (default: every table below Device)')
+    p = sub.add_parser('serve', parents=[common], help='keep the tables loaded and serve bulk operations as a local JSON API')
+    p.add_argument('--listen', default=SERVICE_LISTEN, metavar='ADDRESS', help='HOST:PORT, or unix:PATH for a Unix socket')
+    p = sub.add_parser('shard', parents=[common], help='store tables as shard files partitioned by their Device key')
+    p.add_argument('tables', nargs='+', help='tables to convert (a sharded table is re-sharded)')
+    p.add_argument('--shards', type=int, default=16, help='number of shards')
+    p.add_argument('--scheme', choices=('hash', 'range'), default='hash', help='partition by key hash or by key ranges')
+    p.add_argument('--column', help='key column (default: the FK to the root table, the PK for the root)')
+    p.add_argument('--bounds', type=float, nargs='+', help="range boundaries (default: quantiles of the keys)")
+    p = sub.add_parser('unshard', parents=[common], help='turn sharded tables back into single CSV files')
+    p.add_argument('tables', nargs='+', help='tables to convert')
+    return parser
+
+
+def run_cli(argv):
+    args = build_arg_parser().parse_args(argv)
+    if args.metrics: METRICS.enable(args.metrics)
+    return profiled(args.profile, _run_command, args)
+
+
+def _run_command(args):
+    if args.command in ('shard', 'unshard'):
+        return _run_conversion(args)
+    try:
+        if args.service and args.command != 'serve':
+            # a thin client: the service holds the tables and does the work
+            engine = ServiceClient(args.service, validate=getattr(args, 'validate', VALIDATE_INPUT))
+            if args.command == 'lookup':
+                return _print_bundles(engine.lookup(args.keys), args.json)
+        else:
+            cache_dir = None if args.no_cache or not USE_TABLE_CACHE else default_cache_dir(args.data_folder)
+            # a delete only needs PK and FK columns
+            columns = 'keys' if args.command == 'delete' else None
+            schema = DeviceSchema(args.data_folder, args.relations, root_table=args.root_table, cache_dir=cache_dir,
+                                  columns=columns, compact=args.compact)
+            if args.command == 'lookup':
+                return _print_bundles(schema.get_device_bundles(args.keys), args.json)
+            if args.command == 'serve':
+                return _run_service(schema, args)
+            engine = BulkEngine(schema, load_json_file(args.defaults), None, load_json_file(args.child_rows),
+                                validate=getattr(args, 'validate', VALIDATE_INPUT))
+        if args.command == 'export':
+            result = engine.export(_export_spec(args))
+        elif args.command == 'batch':
+            result = engine.run_batch(BatchSpec(args.source, args.checkpoint, args.keep_going, args.commit_every))
+        elif args.command == 'apply':
+            result = engine.apply_plan(ChangePlan.load(args.plan_file))
+        else:
+            dry_run = args.dry_run or bool(args.plan)
+            if isinstance(engine, ServiceClient):
+                result = engine.run(args.command, args.excel, dry_run=dry_run, chunk_rows=args.chunk_rows)
+            else:
+                result = engine.run(args.command, iter_excel_chunks(args.excel, args.chunk_rows), dry_run=dry_run)
+            if args.plan:
+                result.plan.save(args.plan)
+    except ValidationError as e:
+        if getattr(args, 'report', None):
+            e.report.save(args.report)
+        if args.json:
+            print(json.dumps({'error': 'validation', 'problems': e.report.errors.to_dict('records')}, indent=2, ensure_ascii=False))
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    except (BulkError, FileNotFoundError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps(result.to_dict(), indent=2, ensure_ascii=False))
+    else:
+        for w in result.warnings:
+            print(f'warning: {w}', file=sys.stderr)
+        print(result.summary())
+    return 1 if any(e['status'] == 'failed' for e in result.entries) else 0
+
+def _run_service(schema, args):
+    service = BulkService(schema, load_json_file(args.defaults), load_json_file(args.child_rows))
+    print(f'Serving {schema.data_folder} on {args.listen} (Ctrl+C to stop).', flush=True)
+    try:
+        serve(service, args.listen)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def _export_spec(args):
+    keys = None
+    if args.keys or args.keys_file:
+        keys = list(args.keys or [])
+        if args.keys_file:
+            with open(args.keys_file, encoding='utf-8-sig') as f:
+                keys += [line.strip() for line in f if line.strip()]
+    filters = []
+    for exact, items in ((True, args.where), (False, args.contains)):
+        for item in items:
+            column, sep, text = item.partition('=')
+            if not sep:
+                raise ValueError(f'expected COLUMN=TEXT, not {item}')
+            filters.append((column, text, exact))
+    return ExportSpec(args.output, keys=keys, filters=filters, tables=args.tables)
+
+
+def bundle_records(bundles):
+    """get_device_bundles() as JSON-ready dict table -> list of rows (column -> text)."""
+    return {norm: pd.DataFrame({c: text_values(df[c]) for c in df.columns}).to_dict('records') for norm, df in bundles.items()}
+
+
+def _print_bundles(bundles, as_json):
+    frames = {norm: pd.DataFrame({c: text_values(df[c]) for c in df.columns}) for norm, df in bundles.items()}
+    if as_json:
+        print(json.dumps(bundle_records(bundles), indent=2, ensure_ascii=False))
+        return 0
+    for norm, df in frames.items():
+        if len(df):
+            print(f'{norm} ({len(df)} rows)')
+            print(df.to_string(index=False), end='\n\n')
+    return 0
+
+
+def _run_conversion(args):
+    try:
+        # only the table paths and relations are needed
+        schema = DeviceSchema(args.data_folder, args.relations, root_table=args.root_table, columns='keys')
+        for name in args.tables:
+            norm = normalize_table_name(name)
+            path = schema.get_table_path(norm)
+            if path is None:
+                raise ValueError(f'Table {name} not found in {args.data_folder}')
+            layout = schema.shard_layout(norm)
+            if args.command == 'unshard':
+                if layout is None:
+                    print(f'{norm}: not sharded'); continue
+                print(f'{norm}: wrote {os.path.basename(unshard_table(path))}')
+                continue
+            if layout is not None:
+                # re-shard: from a CSV dropped next to the shards if there is one
+                csv_path = path[:-len(SHARD_SUFFIX)] + '.csv'
+                path = csv_path if os.path.exists(csv_path) else unshard_table(path)
+            layout = shard_table(path, args.column or schema.default_shard_column(norm),
+                                 args.shards, args.scheme, args.bounds)
+            print(f'{norm}: {layout.count} shards by {layout.scheme} of {layout.column} in {os.path.basename(layout.folder)}')
+    except (BulkError, FileNotFoundError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    return 0
+
+# ---------- run ----------
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_cli(argv)
+    if not os.path.exists(DATA_FOLDER):
+        print('Data folder not found:', DATA_FOLDER); return
+    if not os.path.exists(RELATION_FILE):
+        print('relations.csv not found:', RELATION_FILE); return
+    cache_dir = default_cache_dir(DATA_FOLDER) if USE_TABLE_CACHE else None
+    # hidden columns are only parsed when something needs them; with a service doing
+    # the bulk work, the rest of a table is only read when it is browsed
+    columns = 'keys' if SERVICE_URL else hidden_columns_projection(load_json_file(VISIBILITY_FILE))
+    schema = DeviceSchema(DATA_FOLDER, RELATION_FILE, root_table=ROOT_TABLE, cache_dir=cache_dir,
+                          columns=columns, compact=COMPACT_TABLES)
+    app = DeviceBulkApp(schema, ServiceClient(SERVICE_URL) if SERVICE_URL else None)
+    app.mainloop()
+
+if __name__ == '__main__':
+    sys.exit(main())